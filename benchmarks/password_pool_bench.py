@@ -0,0 +1,96 @@
+"""
+Mixed load against a gateway shaped server: logins (scrypt verify) running next to a cheap image style route.
+Run once with --mode inline (hashing on the event loop, as before) and once with --mode pool to compare
+login throughput and image route latency.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import sys
+from argparse import ArgumentParser
+from os.path import dirname, abspath
+from time import perf_counter, sleep
+
+import gevent
+from gevent.pywsgi import WSGIServer
+from flask import Flask, request
+from requests import Session
+from werkzeug.security import generate_password_hash, check_password_hash
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from internal.PasswordPool import PasswordPool, PoolOverloaded
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def buildApp(mode: str, passwordPool: PasswordPool) -> Flask:
+    app = Flask("bench")
+    storedHash = generate_password_hash("password", "scrypt", 50)
+
+    @app.route("/login", methods=["POST"])
+    def login():
+        password = request.form.get("password", "")
+        if mode == "inline":
+            return ("", 200) if check_password_hash(storedHash, password) else ("", 403)
+        try:
+            return ("", 200) if passwordPool.verify(storedHash, password) else ("", 403)
+        except PoolOverloaded:
+            return "", 503
+
+    @app.route("/img", methods=["POST"])
+    def img():
+        sleep(0.005)
+        return str(len(request.get_data())), 200
+
+    return app
+
+
+def worker(url: str, route: str, body, deadline: float, latencies: list[float], statuses: dict[int, int]) -> None:
+    session = Session()
+    while perf_counter() < deadline:
+        start = perf_counter()
+        try:
+            statusCode = session.post(url + route, data=body, timeout=30).status_code
+        except Exception:
+            statusCode = 0
+        latencies.append(perf_counter() - start)
+        statuses[statusCode] = statuses.get(statusCode, 0) + 1
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--mode", choices=["inline", "pool"], default="pool")
+    parser.add_argument("--port", type=int, default=60290)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--login-clients", type=int, default=16)
+    parser.add_argument("--img-clients", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max-queued", type=int, default=32)
+    args = parser.parse_args()
+
+    passwordPool = PasswordPool(args.workers, args.max_queued)
+    server = WSGIServer(("127.0.0.1", args.port), buildApp(args.mode, passwordPool), log=None)
+    server.start()
+    url = f"http://127.0.0.1:{args.port}"
+
+    loginLatencies, imgLatencies = [], []
+    loginStatuses, imgStatuses = {}, {}
+    deadline = perf_counter() + args.duration
+    greenlets = [gevent.spawn(worker, url, "/login", {"password": "password"}, deadline, loginLatencies, loginStatuses) for _ in range(args.login_clients)]
+    greenlets += [gevent.spawn(worker, url, "/img", b"x" * 32768, deadline, imgLatencies, imgStatuses) for _ in range(args.img_clients)]
+    gevent.joinall(greenlets)
+    server.stop()
+
+    print(f"mode={args.mode} duration={args.duration}s")
+    print(f"login: {loginStatuses.get(200, 0) / args.duration:.1f} ok/s statuses={loginStatuses} p50={percentile(loginLatencies, 0.5) * 1000:.1f}ms p99={percentile(loginLatencies, 0.99) * 1000:.1f}ms")
+    print(f"img:   {len(imgLatencies) / args.duration:.1f} req/s p50={percentile(imgLatencies, 0.5) * 1000:.1f}ms p99={percentile(imgLatencies, 0.99) * 1000:.1f}ms")
+    print(f"pool:  {passwordPool.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+"""
+Load test of the full stack: gateway.py and core.py run from a throwaway copy of the tree against a local MySQL
+(benchmarks/docker-compose.yml) and fake_openai.py, with the dummy recogniser and expiry switched off.
+Virtual users drive a weighted mix of register, authraw, renewauth, imgrecv and newitemuid, and the run is written
+to benchmarks/results/ as JSON. Pass --compare with an earlier result to see the change per route.
+
+    python benchmarks/run_bench.py --users 50 --duration 60 --mix register=1,authraw=1,renewauth=4,imgrecv=3,newitemuid=1
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import socket
+import subprocess
+import sys
+from argparse import ArgumentParser, BooleanOptionalAction
+from datetime import datetime
+from io import BytesIO
+from json import dumps, loads
+from pathlib import Path
+from random import choice, choices, randrange, random
+from re import search, sub, MULTILINE
+from secrets import token_hex, token_urlsafe
+from shutil import copytree, ignore_patterns, rmtree
+from tempfile import mkdtemp
+from time import perf_counter, sleep, time
+
+import gevent
+from cryptography.fernet import Fernet
+from PIL import Image, ImageDraw
+from customisedLogs import Manager as LogManager
+from requests import Session
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from internal.Database import MySQLDatabase
+from internal.Metrics import Metrics
+
+
+BENCH_FOLDER = Path(__file__).resolve().parent
+REPO_FOLDER = BENCH_FOLDER.parent
+ROUTES = {"register": "/bbb_register", "authraw": "/bbb_authraw", "renewauth": "/bbb_renewauth", "imgrecv": "/bbb_imgrecv", "newitemuid": "/bbb_newitemuid", "jobresult": "/bbb_jobresult"}
+ITEM_NAMES = ["Apple", "apples", "Banana", "Milk", "whole milk", "Eggs", "Bread", "Greek Yoghurt", "Cheddar Cheese", "Tomatoes", "Chicken Breast", "Spinach", "Carrots", "Butter", "Scallions"]
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarise(latencies: list[float], measured: float) -> dict:
+    """
+    Throughput and latency percentiles of a list of seconds
+    :return: dictionary with milliseconds
+    """
+    return {
+        "COUNT": len(latencies),
+        "THROUGHPUT": round(len(latencies) / measured, 3) if measured else 0,
+        "MEAN_MS": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0,
+        "P50_MS": round(percentile(latencies, 0.50) * 1000, 2),
+        "P95_MS": round(percentile(latencies, 0.95) * 1000, 2),
+        "P99_MS": round(percentile(latencies, 0.99) * 1000, 2),
+        "MAX_MS": round(max(latencies) * 1000, 2) if latencies else 0,
+    }
+
+
+def parseMix(mix: str) -> dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        route, weight = part.split("=")
+        if route not in ROUTES or route == "jobresult":
+            raise SystemExit(f"unknown route in mix: {route}")
+        weights[route] = float(weight)
+    return weights
+
+
+def readConstant(enumFile: Path, name: str) -> int:
+    found = search(rf"^\s+{name} = (\d+)", enumFile.read_text(), MULTILINE)
+    return int(found.group(1))
+
+
+def setSwitches(pythonFile: Path, switches: dict[str, bool]) -> None:
+    """
+    Rewrite module level switches of a copied server file
+    :return: None
+    """
+    source = pythonFile.read_text()
+    for name, value in switches.items():
+        source = sub(rf"^{name} = .*$", f"{name} = {value}", source, flags=MULTILINE)
+    pythonFile.write_text(source)
+
+
+def sqlStatements(sqlFile: Path) -> list[str]:
+    lines = [line for line in sqlFile.read_text().splitlines() if not line.strip().startswith("--")]
+    return [statement.strip() for statement in "\n".join(lines).split(";") if statement.strip()]
+
+
+def prepareDatabase(host: str, password: str, dbName: str) -> None:
+    """
+    Drop every table and build the schema again from benchmarks/schema.sql and migrations/ in order, through the same MySQL pool the servers use
+    :return: None
+    """
+    deadline = time() + 120
+    while True:
+        try:
+            mysqlPool = MySQLDatabase(host, "root", password, dbName, LogManager(), Metrics("bbb_bench", [1]), 1, 1, 5)
+            existing = mysqlPool.fetchSQL("SHOW TABLES", [])
+            break
+        except Exception as e:
+            if time() > deadline:
+                raise SystemExit(f"database not reachable: {repr(e)}")
+            sleep(2)
+    for table, in existing:
+        mysqlPool.executeSQL(f"DROP TABLE IF EXISTS `{table}`", [])
+    for sqlFile in [BENCH_FOLDER / "schema.sql"] + sorted((REPO_FOLDER / "migrations").glob("*.sql")):
+        for statement in sqlStatements(sqlFile):
+            mysqlPool.executeSQL(statement, [])
+        print(f"applied {sqlFile.name}")
+
+
+def prepareWorkFolder(dbHost: str, dbPassword: str, dbName: str) -> Path:
+    """
+    Copy the tree to a temporary folder with generated secrets and the real recognition paths switched on
+    :return: folder of the copy
+    """
+    workFolder = Path(mkdtemp(prefix="bbb-bench-")) / "bbb"
+    copytree(REPO_FOLDER, workFolder, ignore=ignore_patterns(".git", "benchmarks", "__pycache__", "savedimages", "savedImages", "thumbnails", "jobSpool", "imageHashCache.jsonl*", "SecretEnum.py"))
+    (workFolder / "internal" / "SecretEnum.py").write_text(f'''from enum import Enum
+
+
+class Secrets(Enum):
+    possibleFolderLocation = [{str(workFolder)!r}]
+    fernetSecret = {Fernet.generate_key()!r}
+    JWTSecret = {token_urlsafe(32)!r}
+    userGatewaySecret = {token_urlsafe(32)!r}
+    adminGatewaySecret = {token_urlsafe(32)!r}
+    internalTrustSecret = {token_urlsafe(32)!r}
+    GPT4APIKey = "sk-bench"
+    DBHosts = [{dbHost!r}]
+    DBPassword = {dbPassword!r}
+    DBName = {dbName!r}
+''')
+    setSwitches(workFolder / "core.py", {"DUMMY_RECOGNISER": False, "DUMMY_EXPIRY": False, "FAKE_GPT": True, "LOGIN_REQUIRED": True})
+    setSwitches(workFolder / "gateway.py", {"LOGIN_REQUIRED": True, "ALLOW_LOCALHOST": True, "FETCH_IMAGE": True, "PENALISE_IP": False})
+    return workFolder
+
+
+def startProcess(workFolder: Path, name: str, arguments: list[str]) -> subprocess.Popen:
+    logFile = open(workFolder / f"{name}.log", "wb")
+    return subprocess.Popen([sys.executable, name] + arguments, cwd=workFolder, stdout=logFile, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+
+
+def waitForPort(port: int, process: subprocess.Popen, workFolder: Path, name: str) -> None:
+    deadline = time() + 120
+    while time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"{name} exited, see {workFolder / (name + '.log')}:\n" + (workFolder / f"{name}.log").read_text()[-2000:])
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            sleep(0.5)
+    raise SystemExit(f"{name} did not open port {port}")
+
+
+def generateImages(count: int, side: int) -> list[bytes]:
+    """
+    Distinct phone-photo-like JPEGs, some carrying an EXIF rotation
+    :return: list of encoded images
+    """
+    images = []
+    for index in range(count):
+        imgObj = Image.new("RGB", (side, side * 3 // 4), (randrange(256), randrange(256), randrange(256)))
+        draw = ImageDraw.Draw(imgObj)
+        for _ in range(40):
+            x, y = randrange(side), randrange(side * 3 // 4)
+            draw.rectangle((x, y, x + randrange(20, side // 4), y + randrange(20, side // 4)), fill=(randrange(256), randrange(256), randrange(256)))
+        imgObj = Image.blend(imgObj, Image.effect_noise(imgObj.size, 40).convert("RGB"), 0.25)
+        exif = imgObj.getexif()
+        if index % 3 == 0:
+            exif[0x0112] = 6
+        output = BytesIO()
+        imgObj.save(output, format="JPEG", quality=90, exif=exif)
+        images.append(output.getvalue())
+    return images
+
+
+class Recorder:
+    def __init__(self, measureFrom: float):
+        self.measureFrom = measureFrom
+        self.latencies: dict[str, list[float]] = {}
+        self.stages: dict[str, dict[str, list[float]]] = {}
+        self.statuses: dict[str, dict[str, int]] = {}
+
+    def record(self, route: str, started: float, stages: dict[str, float], statusCode: int, statusDesc: str) -> None:
+        if started < self.measureFrom:
+            return
+        self.latencies.setdefault(route, []).append(stages["total"])
+        for stage, seconds in stages.items():
+            self.stages.setdefault(route, {}).setdefault(stage, []).append(seconds)
+        key = f"{statusCode} {statusDesc}"
+        self.statuses.setdefault(route, {})[key] = self.statuses.setdefault(route, {}).get(key, 0) + 1
+
+
+class VirtualUser:
+    def __init__(self, baseURL: str, recorder: Recorder, images: list[bytes], asyncJobs: bool):
+        self.baseURL = baseURL
+        self.recorder = recorder
+        self.images = images
+        self.asyncJobs = asyncJobs
+        self.session = Session()
+        self.username = ""
+        self.password = ""
+        self.deviceJWT = ""
+
+    def post(self, route: str, **kwargs) -> tuple[int, str, object]:
+        """
+        POST through the gateway, timing the response headers and the full body separately
+        :return: status code, description and data of the response
+        """
+        started = perf_counter()
+        try:
+            response = self.session.post(self.baseURL + ROUTES[route], stream=True, timeout=120, **kwargs)
+            headersAt = perf_counter()
+            body = response.content
+            finished = perf_counter()
+            try:
+                parsed = loads(body)
+                statusCode, statusDesc, data = response.status_code, parsed.get("STATUS_DESC") or "", parsed.get("DATA")
+            except ValueError:
+                statusCode, statusDesc, data = response.status_code, "NOT_JSON", None
+            stages = {"ttfb": headersAt - started, "body": finished - headersAt, "total": finished - started}
+        except Exception as e:
+            statusCode, statusDesc, data = 0, type(e).__name__, None
+            stages = {"total": perf_counter() - started}
+        self.recorder.record(route, started, stages, statusCode, statusDesc)
+        return statusCode, statusDesc, data
+
+    def authHeaders(self) -> dict[str, str]:
+        return {"USERNAME": self.username, "BEARER-JWT": self.deviceJWT}
+
+    def register(self, keep: bool) -> None:
+        username, password = f"bench_{token_hex(6)}", token_hex(8)
+        statusCode, _, data = self.post("register", data={"username": username, "password": password, "name": "Bench User"})
+        if keep and statusCode == 200:
+            self.username, self.password, self.deviceJWT = username, password, data["JWT"]["DEVICE-JWT"]
+
+    def authraw(self) -> None:
+        statusCode, _, data = self.post("authraw", data={"username": self.username, "password": self.password})
+        if statusCode == 200:
+            self.deviceJWT = data["JWT"]["DEVICE-JWT"]
+
+    def renewauth(self) -> None:
+        self.post("renewauth", headers=self.authHeaders())
+
+    def imgrecv(self) -> None:
+        headers = self.authHeaders()
+        if self.asyncJobs:
+            headers["ASYNC-JOB"] = "1"
+        files = {"IMG_DATA": ("purchase.jpg", choice(self.images), "image/jpeg")}
+        statusCode, _, data = self.post("imgrecv", headers=headers, files=files)
+        if self.asyncJobs and statusCode == 202:
+            while True:
+                statusCode, _, _ = self.post("jobresult", headers=self.authHeaders(), data={"jobuid": data["JOB_UID"], "wait": 25})
+                if statusCode != 202:
+                    break
+
+    def newitemuid(self) -> None:
+        itemName = choice(ITEM_NAMES) if random() < 0.8 else f"Bench Item {randrange(1000)}"
+        self.post("newitemuid", headers=self.authHeaders(), data={"itemname": itemName})
+
+    def run(self, weights: dict[str, float], deadline: float) -> None:
+        self.register(keep=True)
+        if not self.deviceJWT:
+            return
+        routes, routeWeights = list(weights), list(weights.values())
+        while perf_counter() < deadline:
+            route = choices(routes, routeWeights)[0]
+            if route == "register":
+                self.register(keep=False)
+            else:
+                getattr(self, route)()
+
+
+def compare(current: dict, previousFile: Path) -> None:
+    previous = loads(previousFile.read_text())
+    print(f"\nchange against {previousFile.name}")
+    for route, summary in current["ROUTES"].items():
+        old = previous.get("ROUTES", {}).get(route)
+        if not old:
+            continue
+        changes = []
+        for key in ["THROUGHPUT", "P50_MS", "P95_MS", "P99_MS"]:
+            if old[key]:
+                changes.append(f"{key} {(summary[key] - old[key]) / old[key] * 100:+.1f}%")
+        print(f"  {route:<11} " + "  ".join(changes))
+
+
+def scrapeStages(metricsURL: str) -> dict:
+    """
+    Mean time of every server side stage from a /bbb_metrics scrape
+    :return: dictionary of stage and labels to count and mean milliseconds
+    """
+    sums, counts = {}, {}
+    for line in Session().get(metricsURL, timeout=10).text.splitlines():
+        found = search(r"^bbb_(?:gateway|core)_(\w+)_seconds_(sum|count)(\{.*\})? (\S+)$", line)
+        if found:
+            stage = found.group(1) + (found.group(3) or "")
+            (sums if found.group(2) == "sum" else counts)[stage] = float(found.group(4))
+    return {stage: {"COUNT": int(count), "MEAN_MS": round(sums.get(stage, 0) / count * 1000, 2) if count else 0} for stage, count in sorted(counts.items())}
+
+
+def main():
+    parser = ArgumentParser(description="Load test gateway and CORE against a local MySQL and fake OpenAI")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=60, help="seconds measured, after the warmup")
+    parser.add_argument("--warmup", type=float, default=10, help="seconds of load before measuring")
+    parser.add_argument("--mix", default="register=1,authraw=1,renewauth=4,imgrecv=3,newitemuid=1")
+    parser.add_argument("--async-jobs", action="store_true", help="send images as jobs and long-poll the result")
+    parser.add_argument("--images", type=int, default=50, help="distinct images, fewer means more image hash cache hits")
+    parser.add_argument("--image-side", type=int, default=2000)
+    parser.add_argument("--gpt-min-latency", type=float, default=0.5)
+    parser.add_argument("--gpt-max-latency", type=float, default=2.0)
+    parser.add_argument("--gpt-rate-429", type=float, default=0.0)
+    parser.add_argument("--gpt-rate-500", type=float, default=0.0)
+    parser.add_argument("--docker", action=BooleanOptionalAction, default=True, help="start and stop benchmarks/docker-compose.yml")
+    parser.add_argument("--db-host", default="127.0.0.1")
+    parser.add_argument("--db-password", default="bench")
+    parser.add_argument("--db-name", default="bbb_bench")
+    parser.add_argument("--keep", action="store_true", help="leave the database and the work folder behind")
+    parser.add_argument("--output", type=Path, default=None)
+    parser.add_argument("--compare", type=Path, default=None, help="earlier result JSON to compare against")
+    args = parser.parse_args()
+    weights = parseMix(args.mix)
+
+    composeFile = BENCH_FOLDER / "docker-compose.yml"
+    if args.docker:
+        subprocess.run(["docker", "compose", "-f", str(composeFile), "up", "-d", "--wait"], check=True)
+    processes = []
+    workFolder = None
+    try:
+        prepareDatabase(args.db_host, args.db_password, args.db_name)
+        workFolder = prepareWorkFolder(args.db_host, args.db_password, args.db_name)
+        enumFile = workFolder / "internal" / "Enum.py"
+        gatewayPort, fakeGPTPort = readConstant(enumFile, "userGatewayPort"), readConstant(enumFile, "fakeGPTPort")
+        corePort = int(search(r"coreUpstreams = \[\(\"[\d.]+\", (\d+)\)", enumFile.read_text()).group(1))
+        fakeGPT = startProcess(workFolder, "fake_openai.py", ["--port", str(fakeGPTPort), "--min-latency", str(args.gpt_min_latency), "--max-latency", str(args.gpt_max_latency), "--rate-429", str(args.gpt_rate_429), "--rate-500", str(args.gpt_rate_500)])
+        processes.append(fakeGPT)
+        waitForPort(fakeGPTPort, fakeGPT, workFolder, "fake_openai.py")
+        core = startProcess(workFolder, "core.py", [])
+        processes.append(core)
+        waitForPort(corePort, core, workFolder, "core.py")
+        gateway = startProcess(workFolder, "gateway.py", [])
+        processes.append(gateway)
+        waitForPort(gatewayPort, gateway, workFolder, "gateway.py")
+
+        images = generateImages(args.images, args.image_side)
+        print(f"{len(images)} images, {sum(map(len, images)) // len(images) // 1024} KB average")
+        started = perf_counter()
+        recorder = Recorder(started + args.warmup)
+        deadline = started + args.warmup + args.duration
+        users = [VirtualUser(f"http://127.0.0.1:{gatewayPort}", recorder, images, args.async_jobs) for _ in range(args.users)]
+        gevent.joinall([gevent.spawn(user.run, weights, deadline) for user in users])
+
+        gptLatencies = Session().get(f"http://127.0.0.1:{fakeGPTPort}/stats", timeout=10).json()
+        serverStages = {"GATEWAY": scrapeStages(f"http://127.0.0.1:{gatewayPort}/bbb_metrics"), "CORE": scrapeStages(f"http://127.0.0.1:{corePort}/bbb_metrics")}
+        results = {
+            "META": {
+                "TIMESTAMP": datetime.now().isoformat(timespec="seconds"),
+                "COMMIT": subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_FOLDER, capture_output=True, text=True).stdout.strip(),
+                "ARGUMENTS": {key: str(value) for key, value in vars(args).items()},
+            },
+            "ROUTES": {route: summarise(latencies, args.duration) for route, latencies in recorder.latencies.items()},
+            "STAGES": {route: {stage: summarise(latencies, args.duration) for stage, latencies in stages.items()} for route, stages in recorder.stages.items()},
+            "STATUSES": recorder.statuses,
+            "GPT": {task: summarise(latencies, args.duration + args.warmup) for task, latencies in gptLatencies.items()},
+            "SERVER_STAGES": serverStages,
+        }
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if args.docker and not args.keep:
+            subprocess.run(["docker", "compose", "-f", str(composeFile), "down"], check=False)
+        if workFolder is not None and not args.keep:
+            rmtree(workFolder.parent, ignore_errors=True)
+
+    print(f"\n{'route':<11} {'count':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for route, summary in results["ROUTES"].items():
+        print(f"{route:<11} {summary['COUNT']:>7} {summary['THROUGHPUT']:>8} {summary['P50_MS']:>9} {summary['P95_MS']:>9} {summary['P99_MS']:>9}")
+    for route, statuses in results["STATUSES"].items():
+        print(f"  {route}: {statuses}")
+    output = args.output or BENCH_FOLDER / "results" / f"bench-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(dumps(results, indent=2))
+    print(f"\nresults written to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
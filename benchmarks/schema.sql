@@ -0,0 +1,43 @@
+-- Base tables as the gateway and CORE use them, before migrations/ is applied.
+-- Used by the benchmark harness to build a throwaway database.
+
+CREATE TABLE user_info (
+    user_uid VARCHAR(64) NOT NULL PRIMARY KEY,
+    username VARCHAR(255) NOT NULL,
+    created DATETIME NOT NULL,
+    name VARCHAR(255) NOT NULL
+);
+
+CREATE TABLE user_connection_auth (
+    user_uid VARCHAR(64) NOT NULL PRIMARY KEY,
+    internal_jwt VARCHAR(1024) NOT NULL,
+    pass_hash VARCHAR(255) NOT NULL
+);
+
+CREATE TABLE user_device_auth (
+    device_uid VARCHAR(64) NOT NULL PRIMARY KEY,
+    user_uid VARCHAR(64) NOT NULL,
+    external_jwt VARCHAR(1024) NOT NULL,
+    user_agent VARCHAR(512) NOT NULL,
+    address VARCHAR(64) NOT NULL,
+    INDEX user_device_auth_user (user_uid)
+);
+
+CREATE TABLE ip_penalties (
+    address VARCHAR(64) NOT NULL PRIMARY KEY,
+    expires DATETIME(6) NOT NULL
+);
+
+CREATE TABLE known_items (
+    item_uid VARCHAR(64) NOT NULL PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    duration VARCHAR(16) NULL
+);
+
+CREATE TABLE purchases (
+    purchase_uid VARCHAR(64) NOT NULL PRIMARY KEY,
+    user_uid VARCHAR(64) NOT NULL,
+    items JSON NOT NULL,
+    expiry JSON NOT NULL,
+    INDEX purchases_user (user_uid)
+);
@@ -2,39 +2,52 @@ from gevent import monkey
 monkey.patch_all()
 
 from random import randrange
-from threading import Thread
 from typing import Dict, Any
+from gevent import spawn, signal_handler
 from gevent.pywsgi import WSGIServer
 from flask import Flask, request, Request
-from PIL import Image
-from io import BytesIO
-from base64 import b64encode
-from requests import Session
+from base64 import b64encode, urlsafe_b64encode, urlsafe_b64decode
 from json import loads, dumps
 from functools import wraps
 from dateutil.relativedelta import relativedelta
 from datetime import datetime, date
-from openai import OpenAI
-from pathlib import Path
+from signal import SIGTERM
+from sys import argv
+from time import perf_counter
 from customisedLogs import Manager as LogManager
-from randomisedString import Generator as StrGen
 
-from internal.Enum import Routes, RequestElements, Constants, commonMethods, Tasks, RequiredFiles, Response200Messages, Response422Messages, Response403Messages, Response500Messages
+from internal.Enum import Routes, RequestElements, Constants, Queries, commonMethods, Tasks, RequiredFiles, Response200Messages, Response202Messages, Response404Messages, Response422Messages, Response403Messages, Response500Messages, Response503Messages
 from internal.SecretEnum import Secrets
 from internal.CustomResponse import CustomResponse
+from internal.DurationCoalescer import DurationCoalescer
+from internal.ExpiryScheduler import ExpiryScheduler
+from internal.GPTClient import GPTClient
+from internal.IDAllocator import IDAllocator
+from internal.ImageHashCache import ImageHashCache
+from internal.ImagePreprocessor import ImagePreprocessor
+from internal.ImageStore import ImageStore
+from internal.ItemCatalog import ItemCatalog
+from internal.JobQueue import JobQueue
+from internal.Metrics import Metrics
+from internal.NotificationSink import FileSink
+from internal.SharedSnapshot import SharedSnapshot
+from internal.TrustToken import TrustToken
+from internal.WorkerSupervisor import WorkerSupervisor
 
 
 LOGIN_REQUIRED = True
 COMPRESS_IMAGES = False
 DUMMY_RECOGNISER = True
 DUMMY_EXPIRY = True
+FAKE_GPT = False
+TRUST_TOKEN_AUTH = True
 
 
-clientOPENAI = OpenAI(api_key=Secrets.GPT4APIKey.value)
 logger = LogManager()
-stringGen = StrGen()
+metrics = Metrics("bbb_core", Constants.metricBuckets.value)
+### worker number of this process, set by main() when it serves as one of the supervised workers
+workerIndex = None
 recognitionServer = Flask("RECOGNITION_API")
-mysqlPool = commonMethods.connectDB(logger)
 
 
 def understandGPTResponseImage(responseContent: str) -> tuple[int, str, list]:
@@ -101,12 +114,12 @@ def fetchDurationGPT(itemList: list) -> tuple[int, str, dict]:
     return statusCode, statusDesc, itemsWithExpiryDate
 
 
-def recogniseImageGPT(imgBytes: bytes, userUID: str) -> tuple[int, str, dict]:
+def recogniseItemsGPT(imgBytes: bytes, userUID: str) -> tuple[int, str, list]:
     """
-    Fetch list of items in the image from GPT, or a dummy response if asked for
+    Ask GPT for the list of items in the image
+    :param imgBytes: prepared bytes of the image received from client.
     :param userUID: User ID which sent the image
-    :param imgBytes: raw bytes of the image file received from client.
-    :return:
+    :return: status code, description and list of item names
     """
     payload = {
         "max_tokens": 300,
@@ -141,33 +154,55 @@ def recogniseImageGPT(imgBytes: bytes, userUID: str) -> tuple[int, str, dict]:
             }
         ],
     }
-    statusCode, statusDesc, recognisedItemList = sendGPTRequest(payload, task=Tasks.img_understanding)
-    while True:
-        purchaseUID = stringGen.AlphaNumeric(50, 51)
-        if not mysqlPool.execute(f"SELECT purchase_uid from purchases where purchase_uid=\"{purchaseUID}\""):
-            mysqlPool.execute(f"INSERT INTO purchases values (\"{purchaseUID}\", \"{userUID}\", '{dumps(recognisedItemList)}', '{dumps([])}')")
-            break
-    Thread(target=savePurchaseImage, args=(imgBytes, purchaseUID,)).start()
+    return sendGPTRequest(payload, task=Tasks.img_understanding, userUID=userUID)
+
+
+def recogniseImageGPT(imgBytes: bytes, userUID: str) -> tuple[int, str, dict]:
+    """
+    Fetch list of items in the image from the image hash cache, or from GPT on a miss. The prepared image is what gets hashed, sent and saved
+    :param userUID: User ID which sent the image
+    :param imgBytes: raw bytes of the image file received from client.
+    :return:
+    """
+    try:
+        with metrics.timed("image_prepare"):
+            imgBytes, imageHash = imagePreprocessor.prepare(imgBytes)
+    except Exception as e:
+        logger.failed("IMGPREP", repr(e))
+        return 500, Response500Messages.imageNotFound.value, {"PURCHASE_UID": "", "ITEMS": {}}
+    cachedItemList = imageHashCache.lookup(userUID, imageHash)
+    if cachedItemList is not None:
+        logger.success("IMGHASH", f"{imageHash:016x} cache hit")
+        statusCode, statusDesc, recognisedItemList = 200, Response200Messages.cachedRecogniser.value, cachedItemList
+    else:
+        statusCode, statusDesc, recognisedItemList = recogniseItemsGPT(imgBytes, userUID)
+        if statusCode == 200 and recognisedItemList:
+            imageHashCache.store(userUID, imageHash, recognisedItemList)
+    recognisedItemList = [commonMethods.sqlISafe(itemName) for itemName in recognisedItemList if type(itemName) == str and commonMethods.sqlISafe(itemName)]
+    purchaseUID = idAllocator.new()
+    imageContentHash = imageStore.submit(imgBytes)
+    mysqlPool.execute(Queries.insertPurchase, (purchaseUID, userUID, imageContentHash))
+    nameToUID = itemCatalog.resolveUIDs(recognisedItemList)
     itemDict = {}
     for itemName in recognisedItemList:
-        _, __, itemUID = itemNameToUID(itemName)
-        itemDict[itemUID] = itemName
+        if itemName in nameToUID:
+            itemDict[nameToUID[itemName]] = itemCatalog.canonicalName(itemName)
     return statusCode, statusDesc, {"PURCHASE_UID":purchaseUID, "ITEMS": itemDict}
 
 
-def sendGPTRequest(payload: Dict[str, Any], task: Tasks) -> tuple[int, str, list | dict[str, date]]:
+def sendGPTRequest(payload: Dict[str, Any], task: Tasks, userUID: str = "") -> tuple[int, str, list | dict[str, date]]:
     """
     Common method to send request to GPT.
     :param payload: Data to send
     :param task: Purpose of sending
+    :param userUID: User on whose behalf the request is sent, empty if shared across users
     :return:
     """
     statusCode, statusDesc = 500, Response500Messages.dummy.value
     response:list|dict[str, date] = []
     try:
-        gtpSession = Session()
-        gtpSession.headers = RequestElements.GPTHeaders.value
-        responseJSON = gtpSession.post("https://api.openai.com/v1/chat/completions", json=payload).json()
+        with metrics.timed("gpt_request", task=task.value):
+            responseJSON = gptClient.chatCompletion(payload, task.value, userUID)
         responseContent = responseJSON["choices"][0]["message"]["content"]
         match task:
             case Tasks.img_understanding:
@@ -182,45 +217,39 @@ def sendGPTRequest(payload: Dict[str, Any], task: Tasks) -> tuple[int, str, list
     return statusCode, statusDesc, response
 
 
+@metrics.timed("item_name_to_uid")
 def itemNameToUID(itemName:str):
     """
     Fetch UID for any item name, or generate a new one if name not exists
     :param itemName: Name of the item to ask for UID
     :return:
     """
-    itemUIDTupList =  mysqlPool.execute(f"SELECT item_uid from known_items where name=\"{itemName}\"")
-    if not itemUIDTupList or not itemUIDTupList[0]:
-        while True:
-            itemUID = stringGen.AlphaNumeric(50, 51)
-            if not mysqlPool.execute(f"SELECT item_uid from known_items where item_uid=\"{itemUID}\""):
-                mysqlPool.execute(f"INSERT INTO known_items (item_uid, name) values (\"{itemUID}\", \"{itemName}\")")
-                break
-    else:
-        itemUID = itemUIDTupList[0][0].decode()
+    itemName = commonMethods.sqlISafe(itemName)
+    if not itemName:
+        return 422, Response422Messages.itemNameMissing.value, ""
+    itemUID = itemCatalog.resolveUIDs([itemName]).get(itemName, "")
+    if not itemUID:
+        return 500, Response500Messages.itemNotCreated.value, ""
     return 200, "", itemUID
 
 
+@metrics.timed("catalog_duration")
 def fetchDurationDB(itemName: str) -> tuple[int, str, str]:
     """
-    Fetch Duration from database or return None
+    Fetch Duration from the item catalog, which falls back to database only for unseen names
     :param itemName:
     :return:
     """
     statusCode = 500
     statusDesc = Response500Messages.durationNotFound.value
-    itemDuration = ""
-    itemUIDTupList = mysqlPool.execute(f"SELECT item_uid from known_items where name=\"{itemName}\"")
-    if itemUIDTupList and itemUIDTupList[0][0]:
-        itemUID = itemUIDTupList[0][0].decode()
-        itemDurationTupList = mysqlPool.execute(f"SELECT duration from known_items where item_uid=\"{itemUID}\"")
-        if itemDurationTupList and itemUIDTupList[0][0]:
-            itemDuration = itemDurationTupList[0][0]
-            if itemDuration is not None:
-                statusCode = 200
-                statusDesc = Response200Messages.correct.value
-    return statusCode, statusDesc, itemDuration
+    itemDuration = itemCatalog.fetchDuration(itemName)
+    if itemDuration:
+        statusCode = 200
+        statusDesc = Response200Messages.correct.value
+    return statusCode, statusDesc, itemDuration or ""
 
 
+@metrics.timed("attach_expiry")
 def attachExpiry(purchaseItemDict: dict) -> tuple[int, str, dict]:
     itemDict = purchaseItemDict["ITEMS"]
     if DUMMY_EXPIRY:
@@ -234,28 +263,43 @@ def attachExpiry(purchaseItemDict: dict) -> tuple[int, str, dict]:
         statusCode, statusDesc = 200, Response200Messages.correct.value
         expiryDict = {}
         unknownItems = []
-        nameToUID = {}
+        nameToUIDs = {}
         for itemUID in itemDict:
             itemName = itemDict[itemUID]
-            nameToUID[itemName] = itemUID
             expiryDict[itemUID] = {"NAME":itemName}
-            statusCode, statusDesc, duration = fetchDurationDB(itemName)
-            if expiryDict == 200:
+            durationStatusCode, _, duration = fetchDurationDB(itemName)
+            if durationStatusCode == 200:
                 expiryDict[itemUID]["EXPIRES"] = durationStrToExpiryStr(duration)
             else:
-                unknownItems.append(itemName)
+                canonicalName = itemCatalog.canonicalName(itemName)
+                if canonicalName not in nameToUIDs:
+                    unknownItems.append(canonicalName)
+                nameToUIDs.setdefault(canonicalName, []).append(itemUID)
         if unknownItems:
-            statusCode, statusDesc, GPTFetchedExpiry = fetchDurationGPT(unknownItems)
-            if statusCode == 200:
-                for itemName in GPTFetchedExpiry:
-                    mysqlPool.execute(f"UPDATE known_items set duration=\"{GPTFetchedExpiry[itemName]}\" where item_uid=\"{nameToUID[itemName]}\"")
-                    expiryDict[nameToUID[itemName]]["EXPIRES"] = durationStrToExpiryStr(GPTFetchedExpiry[itemName])
+            statusCode, statusDesc, GPTFetchedExpiry = durationCoalescer.fetch(unknownItems)
+            for itemName in GPTFetchedExpiry:
+                for itemUID in nameToUIDs[itemName]:
+                    expiryDict[itemUID]["EXPIRES"] = durationStrToExpiryStr(GPTFetchedExpiry[itemName])
 
     expiryAttachedDict = purchaseItemDict
     expiryAttachedDict["ITEMS"] = expiryDict
     return statusCode, statusDesc, expiryAttachedDict
 
 
+def storeGPTDurations(nameToDuration: dict[str, str]) -> None:
+    """
+    Persist one coalesced batch of GPT fetched durations into the item catalog
+    :param nameToDuration: dictionary of item name to duration string
+    :return: None
+    """
+    uidToDuration = {}
+    for itemName in nameToDuration:
+        itemUID = itemCatalog.fetchUID(itemName)
+        if itemUID is not None:
+            uidToDuration[itemUID] = commonMethods.sqlISafe(nameToDuration[itemName])
+    itemCatalog.storeDurations(uidToDuration)
+
+
 def durationStrToExpiryStr(duration_str) -> str:
     """
     Parses a duration string (e.g., "30 D", "2 W", "3 M", "2 Y") and returns a datetime object.
@@ -283,28 +327,6 @@ def durationStrToExpiryStr(duration_str) -> str:
     return f"{str(expires.year).zfill(4)}-{str(expires.month).zfill(2)}-{str(expires.day).zfill(2)}"
 
 
-def savePurchaseImage(imgBytes, purchaseUID) -> None:
-    """
-    Save the image for future reference
-    :param purchaseUID: purchase UID or image UID
-    :param imgBytes: bytes received from the client
-    :return: None
-    """
-    if imgBytes:
-        imgObj = Image.open(BytesIO(imgBytes))
-        imgObj = imgObj.convert("RGB")
-        pathToSave = Path(RequiredFiles.purchaseImageFolder.value, purchaseUID).with_suffix(".jpg")
-        imgObj.save(
-            pathToSave,
-            optimize=True,
-            quality=50 if COMPRESS_IMAGES else 100,
-            format="JPEG",
-        )
-        logger.success("IMGSAVE", f"{purchaseUID} saved")
-    else:
-        logger.info("IMGSAVE", f"Dummy image")
-
-
 def baseRecognise(requestObj: Request|bytes) -> tuple[int, str, dict]:
     """
     All image processing starts here. Fetches files from flask request and starts the recognizing process.
@@ -314,15 +336,175 @@ def baseRecognise(requestObj: Request|bytes) -> tuple[int, str, dict]:
     imgBytes = requestObj.data
     userUID = requestObj.environ.get('USER-UID')
     logger.success("IMAGE_EXTRACT", f"SIZE: {len(imgBytes)}")
+    return recogniseWithExpiry(imgBytes, userUID)
+
+
+def recogniseWithExpiry(imgBytes: bytes, userUID: str) -> tuple[int, str, dict]:
+    """
+    Recognise the items of an image and attach their expiry, shared by direct requests and queued jobs
+    :param imgBytes: raw bytes of the image file received from client.
+    :param userUID: User ID which sent the image
+    :return: statusCode and the final processed json/dict
+    """
     if DUMMY_RECOGNISER: statusCode, statusDescRecogniser, purchaseItemDict = 200, Response200Messages.dummyRecogniser.value, {"PURCHASE_UID":"", "ITEMS": {"1":"APPLE", "2":"BANANA", "3":"MILK", "4":"MEAT"}}
     else: statusCode, statusDescRecogniser, purchaseItemDict = recogniseImageGPT(imgBytes, userUID)
-    statusCode, statusDescExpiry, itemDict = attachExpiry(purchaseItemDict)
+    if statusCode == 200:
+        statusCode, statusDescExpiry, itemDict = attachExpiry(purchaseItemDict)
+        if itemDict["PURCHASE_UID"]:
+            try:
+                storePurchaseItems(userUID, itemDict)
+            except Exception as e:
+                logger.failed("ITEMS", f"{itemDict['PURCHASE_UID']} items not stored {repr(e)}")
+    else:
+        statusDescExpiry, itemDict = "", purchaseItemDict
     return statusCode, f"{statusDescRecogniser}_{statusDescExpiry}", itemDict
 
 
+def storePurchaseItems(userUID: str, purchaseItemDict: dict) -> None:
+    """
+    Write the line items of a purchase with one batched INSERT and schedule their expiry notifications
+    :param userUID: User ID owning the purchase
+    :param purchaseItemDict: {"PURCHASE_UID", "ITEMS"} as attachExpiry returns it
+    :return: None
+    """
+    rows = expiryScheduler.itemRows(userUID, purchaseItemDict["PURCHASE_UID"], purchaseItemDict["ITEMS"])
+    if rows:
+        mysqlPool.executeMany(Queries.insertPurchaseItem, rows)
+        expiryScheduler.track(rows)
+
+
+def parseConfirmedItems(itemsJSON: str) -> tuple[dict[str, str | None], dict[str, str | None]] | None:
+    """
+    Split the final item list of a purchase into existing UIDs and new names, each with the expiry the user chose if any
+    :param itemsJSON: JSON list of {"UID"} or {"NAME"} objects, either optionally with "EXPIRES" as YYYY-MM-DD
+    :return: UID to chosen expiry and name to chosen expiry, None if the list is malformed or too long
+    """
+    try:
+        items = loads(itemsJSON)
+    except (TypeError, ValueError):
+        return None
+    if type(items) != list or len(items) > Constants.confirmItemCap.value:
+        return None
+    uidToExpiry, nameToExpiry = {}, {}
+    for item in items:
+        if type(item) != dict:
+            return None
+        expires = item.get("EXPIRES") or None
+        try:
+            if expires is not None:
+                expires = date.fromisoformat(expires).isoformat()
+        except (TypeError, ValueError):
+            return None
+        if type(item.get("UID")) == str and item["UID"]:
+            uidToExpiry[item["UID"]] = expires
+        elif type(item.get("NAME")) == str and commonMethods.sqlISafe(item["NAME"]):
+            nameToExpiry[commonMethods.sqlISafe(item["NAME"])] = expires
+        else:
+            return None
+    return uidToExpiry, nameToExpiry
+
+
+def confirmPurchase(userUID: str, purchaseUID: str, itemsJSON: str) -> tuple[int, str, dict]:
+    """
+    Replace the items of a purchase with the list the user confirmed. New names are resolved in bulk, expiry is attached to items the user gave none,
+    then the line items and the purchase are written in one transaction
+    :param userUID: User ID owning the purchase
+    :param purchaseUID: ID of the purchase to confirm
+    :param itemsJSON: final item list, see parseConfirmedItems()
+    :return: status code, description, EXPIRY_PARTIAL if some expiry could not be found, and {"PURCHASE_UID", "ITEMS"} as stored
+    """
+    parsedItems = parseConfirmedItems(itemsJSON)
+    if parsedItems is None:
+        return 422, Response422Messages.invalidItemList.value, {}
+    uidToExpiry, nameToExpiry = parsedItems
+    if not purchaseUID or mysqlPool.fetchOne(Queries.purchaseOfUser, (purchaseUID, userUID)) is None:
+        return 404, Response404Messages.purchaseNotFound.value, {}
+    itemDict, chosenExpiry = {}, {}
+    if uidToExpiry:
+        uids = list(uidToExpiry)
+        for itemUID, itemName, _ in mysqlPool.fetch(Queries.knownItemsByUIDs, uids, expand=len(uids)):
+            itemDict[itemUID] = itemName
+        if len(itemDict) != len(uidToExpiry):
+            return 422, Response422Messages.invalidItemList.value, {}
+        chosenExpiry.update({itemUID: expires for itemUID, expires in uidToExpiry.items() if expires})
+    if nameToExpiry:
+        nameToUID = itemCatalog.resolveUIDs(list(nameToExpiry))
+        if len(nameToUID) != len(nameToExpiry):
+            return 500, Response500Messages.itemNotCreated.value, {}
+        for itemName, itemUID in nameToUID.items():
+            itemDict[itemUID] = itemCatalog.canonicalName(itemName)
+            if nameToExpiry[itemName]:
+                chosenExpiry[itemUID] = nameToExpiry[itemName]
+    statusCode, statusDesc, expiryDict = attachExpiry({"PURCHASE_UID": purchaseUID, "ITEMS": {itemUID: itemName for itemUID, itemName in itemDict.items() if itemUID not in chosenExpiry}})
+    for itemUID, expires in chosenExpiry.items():
+        expiryDict["ITEMS"][itemUID] = {"NAME": itemDict[itemUID], "EXPIRES": expires}
+    rows = expiryScheduler.itemRows(userUID, purchaseUID, expiryDict["ITEMS"])
+    mysqlPool.transaction([(Queries.deletePurchaseItems, [(purchaseUID,)]), (Queries.insertPurchaseItem, rows), (Queries.confirmPurchase, [(datetime.now(), purchaseUID)])])
+    expiryScheduler.untrack(purchaseUID)
+    expiryScheduler.track(rows)
+    if statusCode != 200:
+        # the list is stored either way, items whose expiry could not be found are kept without one and never notified
+        statusDesc = Response200Messages.expiryPartial.value
+    return 200, statusDesc, expiryDict
+
+
+def encodeCursor(expires: str, purchaseUID: str, itemUID: str) -> str:
+    """
+    Opaque page cursor pointing at the last row of a page of expiringItems()
+    :param expires: expiry date of the row as YYYY-MM-DD
+    :param purchaseUID: purchase ID of the row
+    :param itemUID: item ID of the row
+    :return: URL safe base64 of the key as JSON
+    """
+    return urlsafe_b64encode(dumps([expires, purchaseUID, itemUID]).encode()).decode()
+
+
+def decodeCursor(cursor: str) -> tuple[date, str, str]:
+    """
+    Key of the row a cursor from encodeCursor() points at
+    :param cursor: NEXT_CURSOR sent back by the client
+    :return: expiry date, purchase ID and item ID, raises TypeError or ValueError if the cursor is malformed
+    """
+    expires, purchaseUID, itemUID = loads(urlsafe_b64decode(cursor.encode()))
+    return date.fromisoformat(expires), str(purchaseUID), str(itemUID)
+
+
+def expiringItems(userUID: str, fromDate: str, toDate: str, cursor: str, limit: str) -> tuple[int, str, dict]:
+    """
+    One page of the items of a user expiring between two dates, earliest first. Pages continue from the last row of the previous page, so each costs one index range read of its own size
+    :param userUID: User ID asking
+    :param fromDate: first expiry date included, YYYY-MM-DD
+    :param toDate: last expiry date included, YYYY-MM-DD
+    :param cursor: NEXT_CURSOR of the previous page, empty for the first page
+    :param limit: items per page, at least 1 and capped
+    :return: status code, description and {"ITEMS", "NEXT_CURSOR"}, NEXT_CURSOR empty on the last page
+    """
+    try:
+        fromDate, toDate = date.fromisoformat(fromDate), date.fromisoformat(toDate)
+    except ValueError:
+        return 422, Response422Messages.invalidDateRange.value, {}
+    if fromDate > toDate:
+        return 422, Response422Messages.invalidDateRange.value, {}
+    try:
+        limit = int(limit) if limit else Constants.expiringPageSize.value
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        return 422, Response422Messages.invalidLimit.value, {}
+    limit = min(limit, Constants.expiringPageCap.value)
+    try:
+        afterExpires, afterPurchaseUID, afterItemUID = decodeCursor(cursor) if cursor else (fromDate, "", "")
+    except (TypeError, ValueError):
+        return 422, Response422Messages.invalidCursor.value, {}
+    rows = mysqlPool.fetch(Queries.itemsExpiringBetween, (userUID, fromDate, toDate, afterExpires, afterExpires, afterPurchaseUID, afterExpires, afterPurchaseUID, afterItemUID, limit + 1))
+    items = [{"PURCHASE_UID": purchaseUID, "ITEM_UID": itemUID, "NAME": itemName, "EXPIRES": str(expires)} for purchaseUID, itemUID, itemName, expires in rows[:limit]]
+    nextCursor = encodeCursor(items[-1]["EXPIRES"], items[-1]["PURCHASE_UID"], items[-1]["ITEM_UID"]) if len(rows) > limit else ""
+    return 200, Response200Messages.correct.value, {"ITEMS": items, "NEXT_CURSOR": nextCursor}
+
+
 def matchInternalJWT(flaskFunction):
     """
-    Authentication Decorator to allow only matching (internalJWT, userUID, deviceUID, username) values
+    Authentication Decorator to allow only matching (internalJWT, userUID, deviceUID, username) values, or a gateway signed trust envelope
     :param flaskFunction: the function to switch context to if auth succeeds
     :return:
     """
@@ -336,13 +518,23 @@ def matchInternalJWT(flaskFunction):
         deviceUID = commonMethods.sqlISafe(request.headers.get("DEVICE-UID"))
         userUID = commonMethods.sqlISafe(request.headers.get("USER-UID"))
         internalJWT = commonMethods.sqlISafe(request.headers.get("INTERNAL-JWT"))
-        userUIDExpectedTupList  = mysqlPool.execute(f"SELECT user_uid from user_connection_auth where internal_jwt=\"{internalJWT}\" and user_uid=\"{userUID}\"")
+        userUIDExpectedTupList  = mysqlPool.fetch(Queries.userUIDByInternalJWT, (internalJWT, userUID))
         userUIDReal = ""
         if len(userUIDExpectedTupList) == 1:
-            userUIDReal = userUIDExpectedTupList[0][0].decode()
+            userUIDReal = userUIDExpectedTupList[0][0]
         if username and deviceUID and userUID and internalJWT and userUIDReal and userUIDReal == userUID:
             return True, userUID, deviceUID
         return False, "", ""
+    def __checkTrustToken(request:Request):
+        """
+        Verify the gateway signed envelope locally, without any DB access
+        :param request: Flask Request object
+        :return: bool stating if envelope is trusted and matches the headers
+        """
+        trusted, userUID, deviceUID, username = trustToken.verify(request.headers.get("TRUST-TOKEN"))
+        if trusted and userUID == request.headers.get("USER-UID") and deviceUID == request.headers.get("DEVICE-UID") and username == request.headers.get("USERNAME"):
+            return True, userUID, deviceUID
+        return False, "", ""
     @wraps(flaskFunction)
     def wrapper():
         """
@@ -350,7 +542,8 @@ def matchInternalJWT(flaskFunction):
         :return: Flask response object
         """
         if LOGIN_REQUIRED:
-            jwtCorrect, userUID, deviceUID = __checkJWTCorrectness(request)
+            if TRUST_TOKEN_AUTH: jwtCorrect, userUID, deviceUID = __checkTrustToken(request)
+            else: jwtCorrect, userUID, deviceUID = __checkJWTCorrectness(request)
             if not jwtCorrect:
                 logger.failed("JWT", f"{request.url_rule} incorrect")
                 statusCode = 403
@@ -374,7 +567,14 @@ def recogniseRoute(userUID, deviceUID):
     logger.skip("RECV", f"{request.url_rule} {request.remote_addr}")
     request.environ["USER-UID"] = userUID
     request.environ["DEVICE-UID"] = deviceUID
-    statusCode, statusDesc, recognisedData = baseRecognise(request)
+    if request.headers.get("ASYNC-JOB"):
+        jobUID = idAllocator.new()
+        if jobQueue.submit(jobUID, userUID, request.data):
+            statusCode, statusDesc, recognisedData = 202, Response202Messages.jobAccepted.value, {"JOB_UID": jobUID}
+        else:
+            statusCode, statusDesc, recognisedData = 503, Response503Messages.jobQueueFull.value, ""
+    else:
+        statusCode, statusDesc, recognisedData = baseRecognise(request)
     logger.success("SENT",f"{request.url_rule} response [{statusCode}: {statusDesc}] sent to {request.remote_addr}",)
     return CustomResponse().readValues(statusCode, statusDesc, recognisedData).createFlaskResponse()
 
@@ -396,5 +596,174 @@ def createNewItemUIDRoute(userUID, deviceUID):
     return CustomResponse().readValues(statusCode, statusDesc, newUID).createFlaskResponse()
 
 
-print(f"CORE: {Constants.coreServerPort.value}")
-WSGIServer(("127.0.0.1",Constants.coreServerPort.value,),recognitionServer,log=None,).serve_forever()
+@recognitionServer.route(f"{Routes.jobResult.value}", methods=["POST"])
+@matchInternalJWT
+def jobResultRoute(userUID, deviceUID):
+    """
+    Result of a queued recognition job, long-polling up to WAIT seconds while it is unfinished
+    :param userUID:
+    :param deviceUID:
+    :return:
+    """
+    logger.skip("RECV", f"{request.url_rule} {request.remote_addr}")
+    jobUID = commonMethods.sqlISafe(request.form.get("JOB_UID", ""))
+    try:
+        wait = min(max(float(request.form.get("WAIT", 0)), 0), Constants.jobLongPollCap.value)
+    except ValueError:
+        wait = 0
+    jobState = jobQueue.result(jobUID, userUID, wait) if jobUID else None
+    if jobState is None:
+        statusCode, statusDesc, jobData = 404, Response404Messages.jobNotFound.value, ""
+    elif jobState[0] != "DONE":
+        statusCode, statusDesc, jobData = 202, Response202Messages.jobPending.value, {"JOB_UID": jobUID, "STATE": jobState[0]}
+    else:
+        statusCode, statusDesc, jobData = jobState[1], jobState[2], jobState[3]
+    logger.success("SENT",f"{request.url_rule} response [{statusCode}: {statusDesc}] sent to {request.remote_addr}",)
+    return CustomResponse().readValues(statusCode, statusDesc, jobData).createFlaskResponse()
+
+
+@recognitionServer.route(f"{Routes.confirmPurchase.value}", methods=["POST"])
+@matchInternalJWT
+def confirmPurchaseRoute(userUID, deviceUID):
+    """
+    Store the final item list of a purchase
+    :param userUID:
+    :param deviceUID:
+    :return:
+    """
+    logger.skip("RECV", f"{request.url_rule} {request.remote_addr}")
+    statusCode, statusDesc, purchaseData = confirmPurchase(userUID, commonMethods.sqlISafe(request.form.get("PURCHASE_UID", "")), request.form.get("ITEMS", ""))
+    logger.success("SENT",f"{request.url_rule} response [{statusCode}: {statusDesc}] sent to {request.remote_addr}",)
+    return CustomResponse().readValues(statusCode, statusDesc, purchaseData).createFlaskResponse()
+
+
+@recognitionServer.route(f"{Routes.expiringItems.value}", methods=["POST"])
+@matchInternalJWT
+def expiringItemsRoute(userUID, deviceUID):
+    """
+    Items of the user expiring between FROM and TO, paged by CURSOR
+    :param userUID:
+    :param deviceUID:
+    :return:
+    """
+    logger.skip("RECV", f"{request.url_rule} {request.remote_addr}")
+    statusCode, statusDesc, pageData = expiringItems(userUID, request.form.get("FROM", ""), request.form.get("TO", ""), request.form.get("CURSOR", ""), request.form.get("LIMIT", ""))
+    logger.success("SENT",f"{request.url_rule} response [{statusCode}: {statusDesc}] sent to {request.remote_addr}",)
+    return CustomResponse().readValues(statusCode, statusDesc, pageData).createFlaskResponse()
+
+
+@recognitionServer.route(f"{Routes.metrics.value}", methods=["GET"])
+def metricsRoute():
+    """
+    Prometheus scrape target, CORE listens on localhost only but the caller is checked too
+    :return:
+    """
+    if request.remote_addr != "127.0.0.1":
+        return CustomResponse().readValues(403, Response403Messages.internalOnly.value, "").createFlaskResponse()
+    if workerIndex is None:
+        return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+    return metrics.renderWorkers(workerIndex, workerMetricsPorts), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+def stopWorker() -> None:
+    """
+    Stop taking requests, finish the open ones and exit, the supervisor starts a fresh worker in its place
+    :return: None
+    """
+    spawn(recognitionServerWSGI.stop, Constants.coreReadTimeout.value)
+
+
+@recognitionServer.before_request
+def coreBeforeRequest():
+    """
+    Before any request goes to any route, count it in flight against its route
+    :return:
+    """
+    request.environ["METRICS-ROUTE"] = request.url_rule.rule if request.url_rule else "unmatched"
+    request.environ["METRICS-START"] = perf_counter()
+    metrics.add("requests_in_flight", 1, route=request.environ["METRICS-ROUTE"])
+
+
+@recognitionServer.teardown_request
+def coreTeardownRequest(exception):
+    """
+    After any request is answered, record its latency against its route
+    :return:
+    """
+    route = request.environ.get("METRICS-ROUTE")
+    if route is not None:
+        metrics.add("requests_in_flight", -1, route=route)
+        metrics.observe("request", perf_counter() - request.environ["METRICS-START"], route=route)
+
+
+@recognitionServer.route(f"{Routes.coreHealth.value}", methods=["GET"])
+def healthRoute():
+    """
+    Health check for the gateway forwarder, no auth required
+    :return:
+    """
+    return CustomResponse().readValues(200, Response200Messages.correct.value, "").createFlaskResponse()
+
+
+def main() -> None:
+    """
+    Fork the supervised workers when configured to, else build every component of this process and serve until stopped
+    :return: None
+    """
+    global workerIndex, workerMetricsPorts, gptClient, idAllocator, mysqlPool, itemCatalog, durationCoalescer, imageHashCache, imagePreprocessor, imageStore, trustToken, expiryScheduler, jobQueue, recognitionServerWSGI
+    coreServerPort = int(argv[1]) if len(argv) > 1 and argv[1].isdigit() else Constants.coreUpstreams.value[0][1]
+    workerIndex = WorkerSupervisor.workerIndex(argv)
+    coreUpstreamIndex = next((index for index, (_, port) in enumerate(Constants.coreUpstreams.value) if port == coreServerPort), 0)
+    ### node IDs and metrics ports come from the block of this CORE upstream, whatever the worker count
+    firstNodeID, workerMetricsPorts = commonMethods.workerLayout(coreUpstreamIndex, Constants.coreWorkers.value)
+    if workerIndex is None and Constants.coreWorkers.value > 1:
+        if WorkerSupervisor.supported():
+            WorkerSupervisor(argv[0], [str(coreServerPort)], Constants.coreWorkers.value, logger, Constants.workerRestartDelay.value, Constants.workerRestartCap.value, Constants.workerStableAfter.value).run()
+            return
+        logger.failed("SUPERVISOR", "SO_REUSEPORT not available, serving from a single process")
+    gptClient = GPTClient(f"http://127.0.0.1:{Constants.fakeGPTPort.value}/v1" if FAKE_GPT else Constants.GPTBaseURL.value, RequestElements.GPTHeaders.value, logger, Constants.GPTPoolSize.value, Constants.GPTGlobalConcurrency.value, Constants.GPTPerUserConcurrency.value, Constants.GPTMaxRetries.value, Constants.GPTBackoffBase.value, Constants.GPTBackoffCap.value, Constants.GPTTaskTimeouts.value)
+    ### worker 0 publishes the read-mostly caches for the other workers of this port to map
+    catalogSnapshot = SharedSnapshot(f"{RequiredFiles.snapshotFolder.value}/catalog_{coreServerPort}.snap") if workerIndex is not None else None
+    imageHashSnapshot = SharedSnapshot(f"{RequiredFiles.snapshotFolder.value}/imageHash_{coreServerPort}.snap") if workerIndex is not None else None
+    idAllocator = IDAllocator(firstNodeID + (workerIndex or 0))
+    mysqlPool = commonMethods.connectDB(logger, metrics)
+    itemCatalog = ItemCatalog(mysqlPool, idAllocator, logger, Constants.catalogRefreshInterval.value, Constants.itemNameMatchThreshold.value, catalogSnapshot, workerIndex == 0, Constants.snapshotWaitTimeout.value)
+    itemCatalog.warm()
+    durationCoalescer = DurationCoalescer(lambda itemNames: fetchDurationGPT(itemNames), lambda nameToDuration: storeGPTDurations(nameToDuration), logger, Constants.durationBatchWindow.value, Constants.durationMaxBatch.value, Constants.durationBatchWindow.value + sum(Constants.GPTTaskTimeouts.value[Tasks.text_gen.value]))
+    imageHashCache = ImageHashCache(RequiredFiles.imageHashCacheFile.value, Constants.recognitionPromptVersion.value, Constants.imageHashThreshold.value, Constants.imageHashMinBits.value, imageHashSnapshot, workerIndex == 0, Constants.snapshotInterval.value)
+    imageHashCache.start()
+    imagePreprocessor = ImagePreprocessor(Constants.visionImageSide.value, 50 if COMPRESS_IMAGES else Constants.visionImageQuality.value, Constants.imagePrepWorkers.value)
+    imageStore = ImageStore(RequiredFiles.purchaseImageFolder.value, RequiredFiles.thumbnailFolder.value, logger, Constants.imageStoreWorkers.value, Constants.imageStoreMaxQueued.value, Constants.thumbnailSize.value, metrics)
+    trustToken = TrustToken(Secrets.internalTrustSecret.value, Constants.trustTokenTTL.value)
+    ### expiry shards are split over every CORE process, by upstream then worker
+    coreProcesses = Constants.coreWorkers.value if workerIndex is not None else 1
+    expiryScheduler = ExpiryScheduler(mysqlPool, FileSink(RequiredFiles.notificationFile.value), logger, Constants.expiryShards.value, len(Constants.coreUpstreams.value) * coreProcesses, coreUpstreamIndex * coreProcesses + (workerIndex or 0), Constants.notifyLeadDays.value, Constants.notifyHour.value, Constants.expiryHorizon.value, Constants.expiryLoadInterval.value, Constants.expiryPageSize.value, Constants.notifyBatchSize.value, Constants.notifyRetryDelay.value)
+    jobQueue = JobQueue(mysqlPool, logger, idAllocator.nodeID, RequiredFiles.jobSpoolFolder.value, lambda imgBytes, userUID: recogniseWithExpiry(imgBytes, userUID), Constants.jobWorkers.value, Constants.jobMaxQueued.value, Constants.jobPollInterval.value, Constants.jobRetention.value)
+
+    jobQueue.start()
+    expiryScheduler.start()
+    metrics.addCollector("item_catalog", itemCatalog.stats)
+    metrics.addCollector("duration_coalescer", durationCoalescer.stats)
+    metrics.addCollector("image_hash_cache", imageHashCache.stats)
+    if catalogSnapshot is not None:
+        metrics.addCollector("catalog_snapshot", catalogSnapshot.stats)
+        metrics.addCollector("image_hash_snapshot", imageHashSnapshot.stats)
+    metrics.addCollector("image_preprocessor", imagePreprocessor.stats)
+    metrics.addCollector("image_store", imageStore.stats)
+    metrics.addCollector("job_queue", jobQueue.stats)
+    metrics.addCollector("expiry_scheduler", expiryScheduler.stats)
+    metrics.addCollector("database", mysqlPool.stats)
+    print(f"CORE: {coreServerPort}")
+    if workerIndex is None:
+        recognitionServerWSGI = WSGIServer(("127.0.0.1",coreServerPort,),recognitionServer,log=None,)
+    else:
+        print(f"WORKER {workerIndex}/{Constants.coreWorkers.value}: node {idAllocator.nodeID}, {'publishing' if workerIndex == 0 else 'mapping'} snapshots")
+        recognitionServerWSGI = WSGIServer(WorkerSupervisor.listener("127.0.0.1", coreServerPort), recognitionServer, log=None)
+        WSGIServer(("127.0.0.1", workerMetricsPorts[workerIndex]), metrics.wsgiApp, log=None).start()
+        signal_handler(SIGTERM, stopWorker)
+        WorkerSupervisor.watchParent(stopWorker)
+    recognitionServerWSGI.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+from gevent import monkey
+monkey.patch_all()
+
+from argparse import ArgumentParser
+from collections import deque
+from ast import literal_eval
+from json import dumps
+from random import random, uniform, choice, randrange
+from re import search, DOTALL
+from time import sleep, time
+from gevent.pywsgi import WSGIServer
+from flask import Flask, request, make_response
+
+from internal.Enum import Constants
+
+
+GROCERIES = ["Apple", "Banana", "Milk", "Egg", "Bread", "Yogurt", "Cheese", "Tomato", "Chicken", "Spinach", "Carrot", "Butter"]
+
+
+parser = ArgumentParser(description="Local stand-in for the OpenAI chat completions API, with injected latency and errors")
+parser.add_argument("--port", type=int, default=Constants.fakeGPTPort.value)
+parser.add_argument("--min-latency", type=float, default=0.5, help="seconds")
+parser.add_argument("--max-latency", type=float, default=2.0, help="seconds")
+parser.add_argument("--rate-429", type=float, default=0.0, help="fraction of requests answered with 429")
+parser.add_argument("--rate-500", type=float, default=0.0, help="fraction of requests answered with 500")
+parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with 429")
+parser.add_argument("--kept-latencies", type=int, default=100000, help="latencies kept per task for /stats, the oldest are dropped beyond it")
+arguments = parser.parse_args()
+
+fakeServer = Flask("FAKE_OPENAI")
+servedLatencies: dict[str, deque[float]] = {task: deque(maxlen=arguments.kept_latencies) for task in ("img_understanding", "text_gen", "error")}
+
+
+def completion(content: str) -> dict:
+    """
+    Wrap content in the chat completion response shape
+    :param content: message content
+    :return: response dictionary
+    """
+    return {
+        "id": f"chatcmpl-fake-{int(time() * 1000)}",
+        "object": "chat.completion",
+        "created": int(time()),
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+    }
+
+
+def recognisedContent() -> str:
+    """
+    Answer of an image understanding request, a random list of groceries
+    :return: message content
+    """
+    items = list({choice(GROCERIES) for _ in range(randrange(2, 8))})
+    return f"groceries = {dumps(items)}"
+
+
+def durationContent(prompt: str) -> str:
+    """
+    Answer of a duration request, a duration for every item of the list found in the prompt
+    :param prompt: text sent to GPT
+    :return: message content
+    """
+    found = search(r"Input list of groceries.*?(\[.*?\])", prompt, DOTALL)
+    try:
+        items = literal_eval(found.group(1)) if found else []
+    except:
+        items = []
+    return dumps({item: f"{randrange(1, 12)} {choice('DWMY')}" for item in items})
+
+
+@fakeServer.route("/v1/chat/completions", methods=["POST"])
+def completionsRoute():
+    latency = uniform(arguments.min_latency, arguments.max_latency)
+    sleep(latency)
+    roll = random()
+    if roll < arguments.rate_429:
+        servedLatencies["error"].append(latency)
+        response = make_response({"error": {"message": "Rate limit reached", "type": "requests"}}, 429)
+        response.headers["Retry-After"] = str(arguments.retry_after)
+        return response
+    if roll < arguments.rate_429 + arguments.rate_500:
+        servedLatencies["error"].append(latency)
+        return make_response({"error": {"message": "The server had an error", "type": "server_error"}}, 500)
+    contents = request.json["messages"][0]["content"]
+    if any(part.get("type") == "image_url" for part in contents):
+        servedLatencies["img_understanding"].append(latency)
+        return completion(recognisedContent())
+    servedLatencies["text_gen"].append(latency)
+    return completion(durationContent(" ".join(part.get("text", "") for part in contents)))
+
+
+@fakeServer.route("/stats", methods=["GET"])
+def statsRoute():
+    """
+    Injected latency of the latest requests served per task, read by the benchmark harness
+    :return:
+    """
+    return {task: list(latencies) for task, latencies in servedLatencies.items()}
+
+
+print(f"FAKE OPENAI: {arguments.port}")
+WSGIServer(("127.0.0.1", arguments.port,), fakeServer, log=None,).serve_forever()
@@ -1,23 +1,34 @@
 from gevent import monkey
 monkey.patch_all()
 
-from werkzeug.security import generate_password_hash, check_password_hash
-from base64 import b64decode
+from gevent import spawn, signal_handler
 from gevent.pywsgi import WSGIServer
 from flask import Flask, request, Request
-from requests import post
 from functools import wraps
 from flask_jwt_extended import create_access_token, JWTManager
 from cryptography.fernet import Fernet
-import datetime
-from json import loads
-from datetime import timedelta, datetime
-from time import sleep
+from datetime import timedelta
+from time import sleep, perf_counter
+from random import randrange
+from signal import SIGTERM
+from sqlite3 import IntegrityError as SQLiteIntegrityError
+from sys import argv
+from mysql.connector.errors import IntegrityError as MySQLIntegrityError
+from requests.exceptions import RequestException
+from werkzeug.exceptions import ClientDisconnected
 from customisedLogs import Manager as LogManager
-from randomisedString import Generator as StrGen
 
+from internal.AuthCache import AuthCache, AuthEntry
+from internal.CoreForwarder import CoreForwarder
 from internal.CustomResponse import CustomResponse
-from internal.Enum import Routes, Constants, commonMethods, Response403Messages, Response200Messages, Response500Messages
+from internal.IDAllocator import IDAllocator
+from internal.IPGuard import IPGuard
+from internal.ImageRelay import ImageRelay, UploadTooLarge
+from internal.Metrics import Metrics
+from internal.PasswordPool import PasswordPool, PoolOverloaded
+from internal.TrustToken import TrustToken
+from internal.WorkerSupervisor import WorkerSupervisor
+from internal.Enum import Routes, Constants, Queries, commonMethods, Response403Messages, Response200Messages, Response413Messages, Response429Messages, Response500Messages, Response503Messages
 from internal.SecretEnum import Secrets
 
 ### switches
@@ -27,32 +38,31 @@ UNBLOCK_ALL_IP = True
 ALLOW_LOCALHOST = True
 FETCH_IMAGE = True
 PENALISE_IP = False
+RATE_LIMIT_IP = False
+SIGN_CORE_REQUESTS = True
 
 ### internal checker
 DBReady = False
 
 logger = LogManager()
-fernetObj = Fernet(Secrets.fernetSecret.value)
-stringGen = StrGen()
+metrics = Metrics("bbb_gateway", Constants.metricBuckets.value)
+### worker number of this process, set by main() when it serves as one of the supervised workers
+workerIndex = None
+workerRequests = 0
 userGateway = Flask("RECOGNITION_API", template_folder="templates")
 userGateway.config["JWT_SECRET_KEY"] = Secrets.JWTSecret.value
 userGateway.config["SECRET_KEY"] = Secrets.userGatewaySecret.value
 jwt = JWTManager(userGateway)
-mysqlPool = commonMethods.connectDB(logger)
-
 
 def penaliseIP(address:str, second:int=5):
     """
-    Penalise any address for misuse of service
+    Penalise any address for misuse of service, held in memory and flushed to DB in batches
     :param second:
     :param address: IP to penalise
     :return:
     """
     if PENALISE_IP and address:
-        try:
-            mysqlPool.execute(f"INSERT INTO ip_penalties values(\"{address}\", DATE_ADD(now(), INTERVAL {second} SECOND ))")
-        except:
-            mysqlPool.execute(f"UPDATE ip_penalties set expires=DATE_ADD(now(), INTERVAL {second} SECOND) where address=\"{address}\"")
+        ipGuard.penalise(address, second)
 
 
 def onlyAllowedIPs(flaskFunction):
@@ -63,17 +73,23 @@ def onlyAllowedIPs(flaskFunction):
     """
     def __isIPPenalised(request:Request):
         address = commonMethods.sqlISafe(request.remote_addr)
-        expiryTupList = mysqlPool.execute(f"SELECT address from ip_penalties where address=\"{address}\"")
-        if expiryTupList and expiryTupList[0]: activePenalty = datetime.now()<expiryTupList[0][0]
-        else: activePenalty = False
-        if address in ["BANNED", "LOCAL" if not ALLOW_LOCALHOST else ""] or activePenalty:
+        if address in ["BANNED", "LOCAL" if not ALLOW_LOCALHOST else ""] or ipGuard.isPenalised(address):
             logger.fatal("AUTH", f"address not allowed: {address}")
             return True
         return False
 
+    def __isIPRateLimited(request:Request):
+        address = request.remote_addr
+        if address == "LOCAL" and ALLOW_LOCALHOST:
+            return False
+        return not ipGuard.allow(address)
+
     @wraps(flaskFunction)
     def wrapper():
-        if UNBLOCK_ALL_IP or not __isIPPenalised(request):
+        if RATE_LIMIT_IP and __isIPRateLimited(request):
+            logger.failed("RATELIMIT", f"onlyAllowedIPs: {request.url_rule} from {request.remote_addr}")
+            return CustomResponse().readValues(429, Response429Messages.rateLimited.value, "").createFlaskResponse()
+        elif UNBLOCK_ALL_IP or not __isIPPenalised(request):
             return flaskFunction()
         else:
             logger.failed("UNAUTHORISED", f"onlyAllowedIPs: {request.url_rule} from {request.remote_addr}")
@@ -90,20 +106,39 @@ def onlyAllowedAuth(flaskFunction):
     :param flaskFunction: the function to switch context to if auth succeeds
     :return:
     """
-    def __checkAuthCorrectness(request:Request):
-        username = commonMethods.sqlISafe(request.headers.get("USERNAME"))
-        externalJWT = commonMethods.sqlISafe(request.headers.get("BEARER-JWT"))
-        userUIDTupList = mysqlPool.execute(f"SELECT user_uid from user_info where username=\"{username}\"")
+    def __fetchAuthEntry(username:str, externalJWT:str) -> AuthEntry | None:
+        """
+        Resolve auth of a (username, externalJWT) pair from the cache, or from DB on a miss
+        :param username: username sent by the client
+        :param externalJWT: device JWT sent by the client
+        :return: AuthEntry or None if the pair is unknown
+        """
+        entry = authCache.get(username, externalJWT)
+        if entry is not None:
+            return entry
+        userUIDTupList = mysqlPool.fetch(Queries.userUIDByUsername, (username,))
         if len(userUIDTupList)==1 and userUIDTupList[0]:
-            userUID = userUIDTupList[0][0].decode()
-            addressDeviceUIDTupList = mysqlPool.execute(f"SELECT address, device_uid from user_device_auth where user_uid=\"{userUID}\" and external_jwt=\"{externalJWT}\"")
+            userUID = userUIDTupList[0][0]
+            addressDeviceUIDTupList = mysqlPool.fetch(Queries.deviceByExternalJWT, (userUID, externalJWT))
             if len(addressDeviceUIDTupList)==1 and addressDeviceUIDTupList[0]:
-                if commonMethods.checkRelatedIP(addressDeviceUIDTupList[0][0], request.remote_addr):
-                    deviceUID = addressDeviceUIDTupList[0][1].decode()
-                    return True, username, userUID, deviceUID
-                else: logger.fatal("AUTH", f"address mismatch E:[{addressDeviceUIDTupList[0][0]}] R:[{request.remote_addr}] for {userUID} [{externalJWT}]")
+                internalJWTTupList = mysqlPool.fetch(Queries.internalJWTByUserUID, (userUID,))
+                internalJWT = internalJWTTupList[0][0] if internalJWTTupList and internalJWTTupList[0] else ""
+                address, deviceUID = addressDeviceUIDTupList[0]
+                entry = AuthEntry(userUID, deviceUID, address, internalJWT)
+                authCache.put(username, externalJWT, entry)
+                return entry
             else: logger.fatal("AUTH", f"no address, device_uid for {userUID} [{externalJWT}]")
         else: logger.fatal("AUTH", f"no user_id for {username}")
+        return None
+
+    def __checkAuthCorrectness(request:Request):
+        username = commonMethods.sqlISafe(request.headers.get("USERNAME"))
+        externalJWT = commonMethods.sqlISafe(request.headers.get("BEARER-JWT"))
+        entry = __fetchAuthEntry(username, externalJWT)
+        if entry is not None:
+            if commonMethods.checkRelatedIP(entry.address, request.remote_addr):
+                return True, username, entry.userUID, entry.deviceUID
+            else: logger.fatal("AUTH", f"address mismatch E:[{entry.address}] R:[{request.remote_addr}] for {entry.userUID} [{externalJWT}]")
         return False, "", "", ""
 
     @wraps(flaskFunction)
@@ -164,45 +199,45 @@ def waitForInitDB(flaskFunction):
 
 def registerNewUser(requestObj: Request) -> tuple[int, str, dict]:
     """
-    Upon new registration, add that as a new user, only if username is unique. Also add the device details for immediate login.
+    Upon new registration, add that as a new user, only if username is unique (enforced by the unique index on insert). Also add the device details for immediate login, all in one transaction.
     :param requestObj:
     :return:
     """
     username = commonMethods.sqlISafe(requestObj.form.get("username"))
     password = requestObj.form.get("password")
-    name = requestObj.form.get("name").encode()
+    name = requestObj.form.get("name")
     authData = {}
-    passHash = generate_password_hash(password, "scrypt", 50)
     address = request.remote_addr
-    repeatUsernameTupList = mysqlPool.execute(f"SELECT username from user_info where username=\"{username}\"")
-    if (repeatUsernameTupList and repeatUsernameTupList[0]) or not username:
+    try:
+        passHash = passwordPool.hash(password)
+    except PoolOverloaded:
+        passHash = ""
+    if not passHash:
+        statusCode = 503
+        statusDesc = Response503Messages.authBusy.value
+    elif not username:
         statusCode = 403
         statusDesc = Response403Messages.usernameExists.value
     else:
-        while True:
-            externalJWT = create_access_token(identity=username, expires_delta=timedelta(days=365))
-            if not mysqlPool.execute(f"SELECT external_jwt from user_device_auth where external_jwt=\"{externalJWT}\"") and not mysqlPool.execute(f"SELECT external_jwt from admin_device_auth where external_jwt=\"{externalJWT}\""):
-                break
-        while True:
-            internalJWT = create_access_token(identity=username, expires_delta=timedelta(days=3650))
-            if not mysqlPool.execute(f"SELECT internal_jwt from user_connection_auth where internal_jwt=\"{internalJWT}\"") and not mysqlPool.execute(f"SELECT internal_jwt from admin_connection_auth where internal_jwt=\"{internalJWT}\""):
-                break
-        while True:
-            userUID = stringGen.AlphaNumeric(50, 51)
-            if not mysqlPool.execute(f"SELECT user_uid from user_connection_auth where user_uid=\"{userUID}\"") and not mysqlPool.execute(f"SELECT admin_uid from admin_connection_auth where admin_uid=\"{userUID}\""):
-                mysqlPool.execute(f"INSERT INTO user_info values (\"{userUID}\", \"{username}\", now(), \"{name}\")")
-                mysqlPool.execute(f"INSERT INTO user_connection_auth values (\"{userUID}\", \"{internalJWT}\", \"{passHash}\")")
-                break
-        while True:
-            deviceUID = stringGen.AlphaNumeric(50, 51)
-            if not mysqlPool.execute(f"SELECT device_uid from user_device_auth where device_uid=\"{deviceUID}\"") and not mysqlPool.execute(f"SELECT device_uid from admin_device_auth where device_uid=\"{deviceUID}\""):
-                mysqlPool.execute(f"INSERT INTO user_device_auth values (\"{deviceUID}\", \"{userUID}\", \"{externalJWT}\", \"{str(requestObj.user_agent)}\", \"{address}\")")
-                break
-        statusCode = 200
-        statusDesc = ""
-        authData["JWT"] = {"DEVICE-JWT": externalJWT}
-        authData["DEVICE"] = {"DEVICE-UID": deviceUID}
-        logger.skip("REGNEW", str(authData))
+        externalJWT = create_access_token(identity=username, expires_delta=timedelta(days=365))
+        internalJWT = create_access_token(identity=username, expires_delta=timedelta(days=3650))
+        userUID = idAllocator.new()
+        deviceUID = idAllocator.new()
+        try:
+            # UIDs are freshly allocated, so the only key that can clash is the unique username
+            mysqlPool.transaction([(Queries.insertUser, [(userUID, username, name)]), (Queries.insertConnectionAuth, [(userUID, internalJWT, passHash)]), (Queries.insertDeviceAuth, [(deviceUID, userUID, externalJWT, str(requestObj.user_agent), address)])])
+            usernameTaken = False
+        except (MySQLIntegrityError, SQLiteIntegrityError):
+            usernameTaken = True
+        if usernameTaken:
+            statusCode = 403
+            statusDesc = Response403Messages.usernameExists.value
+        else:
+            statusCode = 200
+            statusDesc = ""
+            authData["JWT"] = {"DEVICE-JWT": externalJWT}
+            authData["DEVICE"] = {"DEVICE-UID": deviceUID}
+            logger.skip("REGNEW", str(authData))
     return statusCode, statusDesc, authData
 
 
@@ -215,29 +250,34 @@ def baseAuthRaw(requestObj: Request) -> tuple[int, str, dict]:
     address = commonMethods.sqlISafe(requestObj.remote_addr)
     username = commonMethods.sqlISafe(requestObj.form.get("username"))
     password = requestObj.form.get("password")
-    userUIDTupList = mysqlPool.execute(f"SELECT user_uid from user_info where username=\"{username}\"")
+    userUIDTupList = mysqlPool.fetch(Queries.userUIDByUsername, (username,))
     authData = {}
     statusCode = 403
     if not userUIDTupList or not userUIDTupList[0]:
         statusDesc = Response403Messages.invalidUsername.value
     else:
-        userUID = userUIDTupList[0][0].decode()
-        passHashTupList = mysqlPool.execute(f"SELECT pass_hash from user_connection_auth where user_uid=\"{userUID}\"")
+        userUID = userUIDTupList[0][0]
+        passHashTupList = mysqlPool.fetch(Queries.passHashByUserUID, (userUID,))
         if not passHashTupList or not passHashTupList[0]:
             statusDesc = Response403Messages.incompleteRegistration.value
         else:
-            passHash = passHashTupList[0][0].decode()
-            if not check_password_hash(passHash, password):
+            passHash = passHashTupList[0][0]
+            try:
+                passwordMatched = passwordPool.verify(passHash, password)
+            except PoolOverloaded:
+                passwordMatched = None
+            if passwordMatched is None:
+                statusCode = 503
+                statusDesc = Response503Messages.authBusy.value
+            elif not passwordMatched:
                 statusDesc = Response403Messages.incorrectAuth.value
             else:
                 statusCode = 200
                 statusDesc = Response200Messages.correct.value
                 externalJWT = create_access_token(identity=username, expires_delta=timedelta(days=365))
-                while True:
-                    deviceUID = stringGen.AlphaNumeric(50, 51)
-                    if not mysqlPool.execute(f"SELECT device_uid from user_device_auth where device_uid=\"{deviceUID}\"") and not mysqlPool.execute(f"SELECT device_uid from admin_device_auth where device_uid=\"{deviceUID}\""):
-                        mysqlPool.execute(f"INSERT INTO user_device_auth values (\"{deviceUID}\", \"{userUID}\", \"{externalJWT}\", \"{str(requestObj.user_agent.string)}\", \"{address}\")")
-                        break
+                deviceUID = idAllocator.new()
+                mysqlPool.execute(Queries.insertDeviceAuth, (deviceUID, userUID, externalJWT, str(requestObj.user_agent.string), address))
+                authCache.invalidateUser(userUID)
                 authData["JWT"] = {"DEVICE-JWT": externalJWT}
                 authData["DEVICE"] = {"DEVICE-UID": deviceUID}
     return statusCode, statusDesc, authData
@@ -245,7 +285,7 @@ def baseAuthRaw(requestObj: Request) -> tuple[int, str, dict]:
 
 def getInternalJWT(userUID:str) -> tuple[int, str, str]:
     """
-    If login success, fetch the internal JWT for the current user to send auth to CORE
+    If login success, fetch the internal JWT for the current user to send auth to CORE, preferring the auth cache
     :param userUID: UserUID of the requestor
     :return:
     """
@@ -256,16 +296,37 @@ def getInternalJWT(userUID:str) -> tuple[int, str, str]:
         statusCode = 200
         statusDesc = Response200Messages.correct.value
     else:
-        JWTTupList = mysqlPool.execute(f"SELECT internal_jwt from user_connection_auth where user_uid=\"{userUID}\"")
-        if not JWTTupList or not JWTTupList[0]: pass
-        else:
-            internalJWTTupList = mysqlPool.execute(f"SELECT internal_jwt from user_connection_auth where user_uid=\"{userUID}\"")
+        internalJWT = authCache.fetchInternalJWT(userUID)
+        if not internalJWT:
+            internalJWTTupList = mysqlPool.fetch(Queries.internalJWTByUserUID, (userUID,))
+            if internalJWTTupList and internalJWTTupList[0]:
+                internalJWT = internalJWTTupList[0][0]
+        if internalJWT:
             statusCode = 200
             statusDesc = Response200Messages.correct.value
-            internalJWT = internalJWTTupList[0][0].decode()
     return statusCode, statusDesc, internalJWT
 
 
+def createCoreHeaders(username:str, userUID:str, deviceUID:str, internalJWT:str) -> dict[str, str]:
+    """
+    Headers to identify the user towards CORE, signed trust envelope attached if enabled
+    :param username: username of the requestor
+    :param userUID: UserUID of the requestor
+    :param deviceUID: DeviceUID of the requestor
+    :param internalJWT: internal JWT of the requestor
+    :return: header dictionary
+    """
+    header = {
+        "INTERNAL-JWT": internalJWT,
+        "USERNAME": username,
+        "USER-UID": userUID,
+        "DEVICE-UID": deviceUID,
+    }
+    if SIGN_CORE_REQUESTS:
+        header["TRUST-TOKEN"] = trustToken.sign(userUID, deviceUID, username)
+    return header
+
+
 @userGateway.route(f"{Routes.register.value}", methods=["POST", "GET"])
 @onlyAllowedMethods
 @onlyAllowedIPs
@@ -302,35 +363,48 @@ def checkOldAuthRoute(username, userUID, deviceUID):
 def recogniseRoute(username, userUID, deviceUID):
     logger.skip("RECV", f"{request.url_rule} {request.remote_addr}")
     statusCode, statusDesc, internalJWT = getInternalJWT(userUID)
-    imgBytes = b""
+    imgBody = b""
     data = CustomResponse().readValues(200, "NO_IMAGE", "").createDataDict()
     if FETCH_IMAGE:
         try:
-            imgBytes = request.files.get("IMG_DATA").stream.read()
+            if request.content_length is not None and request.content_length > Constants.maxUploadBytes.value:
+                raise UploadTooLarge
+            if request.mimetype == "multipart/form-data":
+                imgBody = imageRelay.fromMultipart(request.stream, request.mimetype_params.get("boundary", ""), "IMG_DATA")
+                logger.success("IMAGE_EXTRACT", f"in Files streaming")
+            else:
+                imgBody = imageRelay.fromBase64JSON(request.stream, "IMG_DATA")
+                logger.success("IMAGE_EXTRACT", f"in Data streaming")
             statusCode = 200
-            logger.success("IMAGE_EXTRACT", f"in Files SIZE: {len(imgBytes)}")
+        except UploadTooLarge:
+            statusCode = 413
+            data = CustomResponse().readValues(413, Response413Messages.imageTooLarge.value, "").createDataDict()
+            logger.fatal("IMAGE_EXTRACT", f"too large: {request.content_length}")
         except:
-            try:
-                imgBytes = b64decode(loads(request.data)["IMG_DATA"])
-                statusCode = 200
-                logger.success("IMAGE_EXTRACT", f"in Data Size: {len(imgBytes)}")
-            except:
-                data = CustomResponse().readValues(500, "IMG_NOT_FOUND", "").createDataDict()
-                penaliseIP(commonMethods.sqlISafe(request.remote_addr))
-                logger.fatal("IMAGE_EXTRACT", f"failed")
+            statusCode = 500
+            data = CustomResponse().readValues(500, Response500Messages.imageNotFound.value, "").createDataDict()
+            penaliseIP(commonMethods.sqlISafe(request.remote_addr))
+            logger.fatal("IMAGE_EXTRACT", f"failed")
     if statusCode == 200:
-        header = {
-            "INTERNAL-JWT": internalJWT,
-            "USERNAME": username,
-            "USER-UID": userUID,
-            "DEVICE-UID": deviceUID,
-        }
+        header = createCoreHeaders(username, userUID, deviceUID, internalJWT)
+        if request.headers.get("ASYNC-JOB"):
+            header["ASYNC-JOB"] = "1"
         try:
-            data = post(f"http://127.0.0.1:{Constants.coreServerPort.value}{Routes.imgRecv.value}", headers=header, data=imgBytes).json()
-            logger.success("CORE_FWD", f"{request.url_rule} response [{statusCode}: {statusDesc}] sent to {request.remote_addr}")
-        except:
+            with metrics.timed("core_forward", route=Routes.imgRecv.value):
+                data = coreForwarder.post(Routes.imgRecv.value, header, imgBody)
+            if data is None:
+                data = CustomResponse().readValues(500, Response500Messages.coreDown.value, "").createDataDict()
+            else:
+                logger.success("CORE_FWD", f"{request.url_rule} response [{statusCode}: {statusDesc}] sent to {request.remote_addr} SIZE: {imgBody.size if imgBody else 0}")
+        except UploadTooLarge:
+            data = CustomResponse().readValues(413, Response413Messages.imageTooLarge.value, "").createDataDict()
+            logger.fatal("IMAGE_EXTRACT", f"too large while streaming")
+        except ClientDisconnected:
+            data = CustomResponse().readValues(500, Response500Messages.imageNotFound.value, "").createDataDict()
+            logger.fatal("IMAGE_EXTRACT", f"client disconnected while streaming")
+        except (RequestException, OSError) as e:
             data = CustomResponse().readValues(500, Response500Messages.coreDown.value, "").createDataDict()
-            logger.fatal("CORE_FWD", f"Unable to connect")
+            logger.fatal("CORE_FWD", f"failed while streaming {repr(e)}")
     return CustomResponse().readDict(data).createFlaskResponse()
 
 
@@ -340,21 +414,86 @@ def recogniseRoute(username, userUID, deviceUID):
 @onlyAllowedAuth
 def addNewItemRoute(username, userUID, deviceUID):
     statusCode, statusDesc, internalJWT = getInternalJWT(userUID)
-    try:
-        header = {
-            "INTERNAL-JWT": internalJWT,
-            "USERNAME": username,
-            "USER-UID": userUID,
-            "DEVICE-UID": deviceUID,
-        }
-        data = post(f"http://127.0.0.1:{Constants.coreServerPort.value}/{Routes.requestNewItemUID.value}", headers=header, data={"ITEMNAME": request.form.get("itemname")}).json()
+    header = createCoreHeaders(username, userUID, deviceUID, internalJWT)
+    with metrics.timed("core_forward", route=Routes.requestNewItemUID.value):
+        data = coreForwarder.post(Routes.requestNewItemUID.value, header, {"ITEMNAME": request.form.get("itemname")})
+    if data is None:
+        data = CustomResponse().readValues(500, Response500Messages.coreDown.value, "").createDataDict()
+    else:
         logger.success("CORE_FWD", f"{request.url_rule} response [{statusCode}: {statusDesc}] sent to {request.remote_addr}")
-    except:
-        data = CustomResponse().readValues(500, "CORE_DOWN", "").createDataDict()
-        logger.fatal("CORE_FWD", f"Unable to connect")
     return CustomResponse().readDict(data).createFlaskResponse()
 
 
+@userGateway.route(f"{Routes.jobResult.value}", methods=["POST", "GET"])
+@onlyAllowedMethods
+@onlyAllowedIPs
+@onlyAllowedAuth
+def jobResultRoute(username, userUID, deviceUID):
+    statusCode, statusDesc, internalJWT = getInternalJWT(userUID)
+    header = createCoreHeaders(username, userUID, deviceUID, internalJWT)
+    with metrics.timed("core_forward", route=Routes.jobResult.value):
+        data = coreForwarder.post(Routes.jobResult.value, header, {"JOB_UID": request.form.get("jobuid"), "WAIT": request.form.get("wait", 0)})
+    if data is None:
+        data = CustomResponse().readValues(500, Response500Messages.coreDown.value, "").createDataDict()
+    else:
+        logger.success("CORE_FWD", f"{request.url_rule} response [{statusCode}: {statusDesc}] sent to {request.remote_addr}")
+    return CustomResponse().readDict(data).createFlaskResponse()
+
+
+@userGateway.route(f"{Routes.confirmPurchase.value}", methods=["POST", "GET"])
+@onlyAllowedMethods
+@onlyAllowedIPs
+@onlyAllowedAuth
+def confirmPurchaseRoute(username, userUID, deviceUID):
+    statusCode, statusDesc, internalJWT = getInternalJWT(userUID)
+    header = createCoreHeaders(username, userUID, deviceUID, internalJWT)
+    with metrics.timed("core_forward", route=Routes.confirmPurchase.value):
+        data = coreForwarder.post(Routes.confirmPurchase.value, header, {"PURCHASE_UID": request.form.get("purchaseuid", ""), "ITEMS": request.form.get("items", "")})
+    if data is None:
+        data = CustomResponse().readValues(500, Response500Messages.coreDown.value, "").createDataDict()
+    else:
+        logger.success("SENT", f"{request.url_rule} response sent to {request.remote_addr}")
+    return CustomResponse().readDict(data).createFlaskResponse()
+
+
+@userGateway.route(f"{Routes.expiringItems.value}", methods=["POST", "GET"])
+@onlyAllowedMethods
+@onlyAllowedIPs
+@onlyAllowedAuth
+def expiringItemsRoute(username, userUID, deviceUID):
+    statusCode, statusDesc, internalJWT = getInternalJWT(userUID)
+    header = createCoreHeaders(username, userUID, deviceUID, internalJWT)
+    form = {"FROM": request.form.get("from", ""), "TO": request.form.get("to", ""), "CURSOR": request.form.get("cursor", ""), "LIMIT": request.form.get("limit", "")}
+    with metrics.timed("core_forward", route=Routes.expiringItems.value):
+        data = coreForwarder.post(Routes.expiringItems.value, header, form)
+    if data is None:
+        data = CustomResponse().readValues(500, Response500Messages.coreDown.value, "").createDataDict()
+    else:
+        logger.success("SENT", f"{request.url_rule} response sent to {request.remote_addr}")
+    return CustomResponse().readDict(data).createFlaskResponse()
+
+
+@userGateway.route(f"{Routes.metrics.value}", methods=["GET"])
+def metricsRoute():
+    """
+    Prometheus scrape target, answered only to requests made on this machine without a proxy in between
+    :return:
+    """
+    if request.remote_addr != "LOCAL":
+        return CustomResponse().readValues(403, Response403Messages.internalOnly.value, "").createFlaskResponse()
+    if workerIndex is None:
+        return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+    return metrics.renderWorkers(workerIndex, workerMetricsPorts), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+def stopWorker() -> None:
+    """
+    Stop taking connections, finish the open requests and exit, the supervisor starts a fresh worker in its place
+    :return: None
+    """
+    spawn(userGatewayServer.stop, Constants.gatewayWorkerGraceful.value)
+
+
 @userGateway.before_request
 def userBeforeRequest():
     """
@@ -372,7 +511,72 @@ def userBeforeRequest():
     else:
         address = request.remote_addr
     request.remote_addr = address
+    request.environ["METRICS-ROUTE"] = request.url_rule.rule if request.url_rule else "unmatched"
+    request.environ["METRICS-START"] = perf_counter()
+    metrics.add("requests_in_flight", 1, route=request.environ["METRICS-ROUTE"])
+
+
+@userGateway.teardown_request
+def userTeardownRequest(exception):
+    """
+    After any request is answered, record its latency against its route
+    :return:
+    """
+    route = request.environ.get("METRICS-ROUTE")
+    if route is not None:
+        metrics.add("requests_in_flight", -1, route=route)
+        metrics.observe("request", perf_counter() - request.environ["METRICS-START"], route=route)
+    if workerIndex is not None:
+        global workerRequests
+        workerRequests += 1
+        if workerRequests == workerRequestLimit:
+            logger.info("SUPERVISOR", f"worker {workerIndex} recycling after {workerRequests} requests")
+            stopWorker()
+
+
+def main() -> None:
+    """
+    Fork the supervised workers when configured to, else build every component of this process and serve until stopped
+    :return: None
+    """
+    global workerIndex, workerMetricsPorts, workerRequestLimit, fernetObj, idAllocator, mysqlPool, authCache, coreForwarder, passwordPool, imageRelay, trustToken, ipGuard, userGatewayServer
+    workerIndex = WorkerSupervisor.workerIndex(argv)
+    firstNodeID, workerMetricsPorts = commonMethods.workerLayout(None, Constants.gatewayWorkers.value)
+    if workerIndex is None and Constants.gatewayWorkers.value > 1:
+        if WorkerSupervisor.supported():
+            WorkerSupervisor(argv[0], [], Constants.gatewayWorkers.value, logger, Constants.workerRestartDelay.value, Constants.workerRestartCap.value, Constants.workerStableAfter.value).run()
+            return
+        logger.failed("SUPERVISOR", "SO_REUSEPORT not available, serving from a single process")
+    ### every worker limits its share of the traffic, the kernel spreads connections of a client over all of them
+    workerShare = Constants.gatewayWorkers.value if workerIndex is not None else 1
+    workerRequestLimit = Constants.gatewayWorkerMaxRequests.value + randrange(Constants.gatewayWorkerMaxRequests.value // 10 + 1)
+    fernetObj = Fernet(Secrets.fernetSecret.value)
+    idAllocator = IDAllocator(firstNodeID + (workerIndex or 0))
+    mysqlPool = commonMethods.connectDB(logger, metrics)
+    authCache = AuthCache(Constants.authCacheSize.value, Constants.authCacheTTL.value)
+    coreForwarder = CoreForwarder(Constants.coreUpstreams.value, logger, Routes.coreHealth.value, Constants.corePoolSize.value, Constants.coreConnectTimeout.value, Constants.coreReadTimeout.value, Constants.coreFailureThreshold.value, Constants.coreCircuitOpenPeriod.value, Constants.coreHealthInterval.value)
+    passwordPool = PasswordPool(Constants.passwordWorkers.value, Constants.passwordMaxQueued.value)
+    imageRelay = ImageRelay(Constants.maxImageBytes.value, Constants.uploadChunkSize.value)
+    trustToken = TrustToken(Secrets.internalTrustSecret.value, Constants.trustTokenTTL.value)
+    ipGuard = IPGuard(mysqlPool, logger, Constants.ipRate.value / workerShare, Constants.ipBurst.value, Constants.subnetRate.value / workerShare, Constants.subnetBurst.value, Constants.penaltyFlushInterval.value, Constants.penaltyWheelSlots.value)
+    ipGuard.start()
+    metrics.addCollector("auth_cache", authCache.stats)
+    metrics.addCollector("core_upstream", coreForwarder.stats)
+    metrics.addCollector("password_pool", passwordPool.stats)
+    metrics.addCollector("ip_guard", ipGuard.stats)
+    metrics.addCollector("database", mysqlPool.stats)
+
+    print(f"USER GATEWAY: {Constants.userGatewayPort.value} -> CORE: {', '.join(f'{host}:{port}' for host, port in Constants.coreUpstreams.value)}")
+    if workerIndex is None:
+        userGatewayServer = WSGIServer(("0.0.0.0",Constants.userGatewayPort.value,),userGateway,log=None,)
+    else:
+        print(f"WORKER {workerIndex}/{Constants.gatewayWorkers.value}: node {idAllocator.nodeID}, recycled after {workerRequestLimit} requests")
+        userGatewayServer = WSGIServer(WorkerSupervisor.listener("0.0.0.0", Constants.userGatewayPort.value), userGateway, log=None)
+        WSGIServer(("127.0.0.1", workerMetricsPorts[workerIndex]), metrics.wsgiApp, log=None).start()
+        signal_handler(SIGTERM, stopWorker)
+        WorkerSupervisor.watchParent(stopWorker)
+    userGatewayServer.serve_forever()
 
 
-print(f"USER GATEWAY: {Constants.userGatewayPort.value}")
-WSGIServer(("0.0.0.0",Constants.userGatewayPort.value,),userGateway,log=None,).serve_forever()
+if __name__ == "__main__":
+    main()
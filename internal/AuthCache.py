@@ -0,0 +1,121 @@
+from __future__ import annotations
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+class AuthEntry:
+    def __init__(self, userUID: str, deviceUID: str, address: str, internalJWT: str):
+        self.userUID = userUID
+        self.deviceUID = deviceUID
+        self.address = address
+        self.internalJWT = internalJWT
+
+
+class AuthCache:
+    def __init__(self, maxEntries: int, ttl: float):
+        """
+        Bounded LRU cache with per entry TTL, holding resolved auth of (username, externalJWT) pairs.
+        Every gateway worker process holds its own cache, so an invalidation only reaches the worker that served the request and other workers drop the entry when its TTL runs out
+        :param maxEntries: count of entries to keep before evicting the least recently used
+        :param ttl: seconds an entry stays valid after being stored
+        """
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries: OrderedDict[tuple[str, str], tuple[float, AuthEntry]] = OrderedDict()
+        self.__userKeys: dict[str, set[tuple[str, str]]] = {}
+        self.__lock = Lock()
+
+    def get(self, username: str, externalJWT: str) -> AuthEntry | None:
+        """
+        Fetch a cached entry if present and not expired
+        :param username: username sent by the client
+        :param externalJWT: device JWT sent by the client
+        :return: AuthEntry or None
+        """
+        key = (username, externalJWT)
+        with self.__lock:
+            cached = self.__entries.get(key)
+            if cached is None:
+                self.misses += 1
+                return None
+            expiresAt, entry = cached
+            if expiresAt < time():
+                self.__remove(key)
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, username: str, externalJWT: str, entry: AuthEntry) -> None:
+        """
+        Store a freshly resolved entry, evicting the least recently used ones if full
+        :param username: username sent by the client
+        :param externalJWT: device JWT sent by the client
+        :param entry: resolved AuthEntry
+        :return: None
+        """
+        key = (username, externalJWT)
+        with self.__lock:
+            if key in self.__entries:
+                self.__remove(key)
+            self.__entries[key] = (time() + self.ttl, entry)
+            self.__userKeys.setdefault(entry.userUID, set()).add(key)
+            while len(self.__entries) > self.maxEntries:
+                self.__remove(next(iter(self.__entries)))
+                self.evictions += 1
+
+    def fetchInternalJWT(self, userUID: str) -> str:
+        """
+        Internal JWT of any live entry belonging to the user, internal JWT is per user and not per device
+        :param userUID: UserUID to look for
+        :return: internal JWT or empty string
+        """
+        with self.__lock:
+            for key in self.__userKeys.get(userUID, ()):
+                expiresAt, entry = self.__entries[key]
+                if expiresAt >= time():
+                    return entry.internalJWT
+        return ""
+
+    def invalidateUser(self, userUID: str) -> None:
+        """
+        Drop every entry of a user, to be called whenever device or connection auth of the user is written
+        :param userUID: UserUID whose entries are to be dropped
+        :return: None
+        """
+        with self.__lock:
+            for key in list(self.__userKeys.get(userUID, ())):
+                self.__remove(key)
+
+    def stats(self) -> dict[str, int]:
+        """
+        Counters to size the cache with
+        :return: dictionary of counters
+        """
+        return {
+            "SIZE": len(self.__entries),
+            "HITS": self.hits,
+            "MISSES": self.misses,
+            "EVICTIONS": self.evictions,
+        }
+
+    def __remove(self, key: tuple[str, str]) -> None:
+        """
+        Remove a key from the entries and the user index, lock must be held by the caller
+        :param key: (username, externalJWT) pair
+        :return: None
+        """
+        cached = self.__entries.pop(key, None)
+        if cached is None:
+            return
+        userUID = cached[1].userUID
+        keys = self.__userKeys.get(userUID)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.__userKeys[userUID]
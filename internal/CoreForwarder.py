@@ -0,0 +1,176 @@
+from __future__ import annotations
+from threading import Thread, Lock
+from time import sleep, time
+from requests import Session
+from requests.exceptions import RequestException, ConnectionError as ConnectFailure, Timeout
+from requests.adapters import HTTPAdapter
+from customisedLogs import Manager as LogManager
+
+
+class CoreUpstream:
+    def __init__(self, host: str, port: int, poolSize: int):
+        """
+        One CORE server along with its keep-alive connection pool and health state
+        :param host: host CORE listens on
+        :param port: port CORE listens on
+        :param poolSize: count of keep-alive connections to hold to this CORE
+        """
+        self.host = host
+        self.port = port
+        self.baseURL = f"http://{host}:{port}"
+        self.session = Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=poolSize, pool_block=False, max_retries=0))
+        self.outstanding = 0
+        self.healthy = True
+        self.consecutiveFailures = 0
+        self.openUntil = 0.0
+        self.trialRunning = False
+
+    def available(self, now: float) -> bool:
+        """
+        Upstream can take requests if healthy and its circuit is closed, or half open with no trial request running
+        :param now: current timestamp
+        :return: bool
+        """
+        return self.healthy and self.openUntil <= now and not self.trialRunning
+
+    def halfOpen(self, now: float) -> bool:
+        """
+        Circuit opened and its open period is over, so the next request is a trial deciding whether it closes or opens again
+        :param now: current timestamp
+        :return: bool
+        """
+        return 0 < self.openUntil <= now
+
+
+class CoreForwarder:
+    def __init__(self, upstreams: list[tuple[str, int]], logger: LogManager, healthRoute: str, poolSize: int, connectTimeout: float, readTimeout: float, failureThreshold: int, openPeriod: float, healthInterval: float):
+        """
+        Forward gateway requests to CORE servers over pooled keep-alive connections, balancing on least outstanding requests
+        :param upstreams: list of (host, port) of CORE servers
+        :param logger: LogManager object to log to
+        :param healthRoute: CORE route answering health checks
+        :param poolSize: keep-alive connections per upstream
+        :param connectTimeout: seconds to wait for a connection
+        :param readTimeout: seconds to wait for a response
+        :param failureThreshold: consecutive failures after which the circuit of an upstream opens
+        :param openPeriod: seconds an open circuit rejects requests before a single trial request is let through
+        :param healthInterval: seconds between active health checks
+        """
+        self.upstreams = [CoreUpstream(host, port, poolSize) for host, port in upstreams]
+        self.logger = logger
+        self.healthRoute = healthRoute
+        self.timeout = (connectTimeout, readTimeout)
+        self.failureThreshold = failureThreshold
+        self.openPeriod = openPeriod
+        self.healthInterval = healthInterval
+        self.__lock = Lock()
+        Thread(target=self.__healthChecker, daemon=True).start()
+
+    def post(self, route: str, headers: dict, data=None) -> dict | None:
+        """
+        POST to the least loaded available CORE and return its JSON
+        :param route: CORE route to send to
+        :param headers: headers to send
+        :param data: body to send, bytes, dictionary or a file like/iterable to stream
+        :return: JSON of the response or None if no CORE could answer, errors raised while reading data are passed on
+        """
+        upstream, trial = self.__acquire()
+        if upstream is None:
+            self.logger.fatal("CORE_FWD", "all upstreams unavailable")
+            return None
+        try:
+            response = upstream.session.post(f"{upstream.baseURL}{route}", headers=headers, data=data, timeout=self.timeout)
+        except (ConnectFailure, Timeout) as e:
+            self.__release(upstream, trial, False)
+            self.logger.fatal("CORE_FWD", f"{upstream.baseURL} {repr(e)}")
+            return None
+        except RequestException as e:
+            self.__release(upstream, trial, None)
+            self.logger.fatal("CORE_FWD", f"{upstream.baseURL} {repr(e)}")
+            return None
+        except:
+            self.__release(upstream, trial, None)
+            raise
+        # only an upstream that cannot be reached, times out or fails with a 5xx counts against its circuit, a body that is not JSON does not
+        self.__release(upstream, trial, response.status_code < 500)
+        try:
+            return response.json()
+        except ValueError as e:
+            self.logger.fatal("CORE_FWD", f"{upstream.baseURL} {response.status_code} {repr(e)}")
+            return None
+
+    def stats(self) -> list[dict]:
+        """
+        State of every upstream
+        :return: list of dictionary per upstream
+        """
+        now = time()
+        return [{"UPSTREAM": upstream.baseURL, "HEALTHY": upstream.healthy, "OUTSTANDING": upstream.outstanding, "OPEN": upstream.openUntil > now, "HALF_OPEN": upstream.halfOpen(now)} for upstream in self.upstreams]
+
+    def __acquire(self) -> tuple[CoreUpstream | None, bool]:
+        """
+        Pick the available upstream with the least outstanding requests. A half open upstream goes first, taking one trial request at a time
+        :return: CoreUpstream or None if every circuit is open, and bool stating if the request is the trial of a half open circuit
+        """
+        now = time()
+        with self.__lock:
+            candidates = [upstream for upstream in self.upstreams if upstream.available(now)]
+            if not candidates:
+                return None, False
+            upstream = min(candidates, key=lambda candidate: (not candidate.halfOpen(now), candidate.outstanding))
+            upstream.outstanding += 1
+            trial = upstream.halfOpen(now)
+            if trial:
+                upstream.trialRunning = True
+            return upstream, trial
+
+    def __release(self, upstream: CoreUpstream, trial: bool, succeeded: bool | None) -> None:
+        """
+        Return an upstream after use and update its circuit
+        :param upstream: the upstream used
+        :param trial: if the request was the trial of a half open circuit
+        :param succeeded: if the upstream answered, None if the failure was not the upstream's fault
+        :return: None
+        """
+        with self.__lock:
+            upstream.outstanding -= 1
+            if trial:
+                upstream.trialRunning = False
+            if succeeded is not None:
+                self.__record(upstream, succeeded)
+
+    def __record(self, upstream: CoreUpstream, succeeded: bool) -> None:
+        """
+        Count a success or failure against an upstream, closing its circuit on a success and opening it on too many failures, again at once if a trial fails. Lock must be held by the caller
+        :param upstream: the upstream
+        :param succeeded: if the upstream answered
+        :return: None
+        """
+        if succeeded:
+            upstream.consecutiveFailures = 0
+            upstream.openUntil = 0.0
+        else:
+            upstream.consecutiveFailures += 1
+            if upstream.consecutiveFailures >= self.failureThreshold:
+                upstream.openUntil = time() + self.openPeriod
+                self.logger.failed("CORE_FWD", f"circuit open for {upstream.baseURL}")
+
+    def __healthChecker(self) -> None:
+        """
+        Infinite loop checking every upstream and marking it healthy or not
+        :return: None
+        """
+        while True:
+            for upstream in self.upstreams:
+                try:
+                    healthy = upstream.session.get(f"{upstream.baseURL}{self.healthRoute}", timeout=self.timeout[0]).status_code == 200
+                except:
+                    healthy = False
+                with self.__lock:
+                    if healthy != upstream.healthy:
+                        self.logger.info("CORE_HEALTH", f"{upstream.baseURL} {'up' if healthy else 'down'}")
+                    upstream.healthy = healthy
+                    if healthy and upstream.openUntil:
+                        self.__record(upstream, True)
+            sleep(self.healthInterval)
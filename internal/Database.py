@@ -0,0 +1,309 @@
+from __future__ import annotations
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from enum import Enum
+from queue import Queue, Empty
+from threading import Lock
+from time import time
+import mysql.connector as MySQLConnector
+from mysql.connector.errors import InterfaceError, OperationalError
+from customisedLogs import Manager as LogManager
+
+from internal.Metrics import Metrics
+
+
+class Connection:
+    def __init__(self, raw, cacheSize: int):
+        """
+        One MySQL connection and the prepared statements it holds, one server side statement per cursor
+        :param raw: connected mysql.connector connection
+        :param cacheSize: prepared statements kept before the least recently used is closed
+        """
+        self.raw = raw
+        self.cacheSize = cacheSize
+        self.prepares = 0
+        self.lastUsed = time()
+        self.__cursors: OrderedDict[str, tuple[str, object]] = OrderedDict()
+
+    def prepared(self, sql: str):
+        """
+        Cursor holding the statement prepared on this connection, preparing it on first use
+        :param sql: statement text with %s placeholders
+        :return: the statement text the cursor was prepared with and the cursor
+        """
+        cached = self.__cursors.get(sql)
+        if cached is not None:
+            self.__cursors.move_to_end(sql)
+            return cached
+        # the cursor re-prepares whenever it is handed a different str object, so the cached text is passed back every time
+        cached = self.__cursors[sql] = (sql, self.raw.cursor(prepared=True))
+        self.prepares += 1
+        if len(self.__cursors) > self.cacheSize:
+            _, (_, cursor) = self.__cursors.popitem(last=False)
+            cursor.close()
+        return cached
+
+    def close(self) -> None:
+        try:
+            self.raw.close()
+        except Exception:
+            pass
+
+
+class Database(ABC):
+    def __init__(self, logger: LogManager, metrics: Metrics):
+        """
+        Storage interface the servers talk to. Named, parameterised statements from the Queries enum go in, rows come out as tuples with text columns as str.
+        Backends implement the *SQL methods and may swap the SQL of a statement for their own dialect
+        :param logger: LogManager object to log to
+        :param metrics: Metrics object to time statements into
+        """
+        self.logger = logger
+        self.metrics = metrics
+
+    def fetch(self, statement: Enum, params: tuple | list = (), expand: int = 0) -> list[tuple]:
+        """
+        Rows of a SELECT
+        :param statement: Queries member holding the SQL
+        :param params: values of the placeholders
+        :param expand: values at the end of params filling the "{}" list of the statement, 0 if it has none
+        :return: list of rows
+        """
+        sql, params = self.expand(self.statementSQL(statement), params, expand)
+        with self.metrics.timed("db_query", statement=statement.name):
+            return self.fetchSQL(sql, params)
+
+    def fetchOne(self, statement: Enum, params: tuple | list = ()) -> tuple | None:
+        rows = self.fetch(statement, params)
+        return rows[0] if rows else None
+
+    def execute(self, statement: Enum, params: tuple | list = (), expand: int = 0) -> int:
+        """
+        Run a statement returning no rows
+        :param statement: Queries member holding the SQL
+        :param params: values of the placeholders
+        :param expand: values at the end of params filling the "{}" list of the statement, 0 if it has none
+        :return: rows affected
+        """
+        sql, params = self.expand(self.statementSQL(statement), params, expand)
+        with self.metrics.timed("db_query", statement=statement.name):
+            return self.executeSQL(sql, params)
+
+    def executeMany(self, statement: Enum, paramsList: list[tuple | list]) -> int:
+        """
+        Run a statement once per set of values as one batch
+        :param statement: Queries member holding the SQL
+        :param paramsList: values of the placeholders, one entry per row
+        :return: rows affected
+        """
+        if not paramsList:
+            return 0
+        with self.metrics.timed("db_query", statement=statement.name):
+            return self.executeManySQL(self.statementSQL(statement), paramsList)
+
+    def transaction(self, steps: list[tuple[Enum, list[tuple | list]]]) -> list[int]:
+        """
+        Run several statements as one transaction, either every row of every step is written or none is. Statements repeated over steps are timed under their name once
+        :param steps: Queries member and its placeholder values, one entry per run of the statement, in the order to run them
+        :return: rows affected per step
+        """
+        with self.metrics.timed("db_query", statement="+".join(dict.fromkeys(statement.name for statement, _ in steps))):
+            return self.transactionSQL([(self.statementSQL(statement), paramsList) for statement, paramsList in steps])
+
+    def statementSQL(self, statement: Enum) -> str:
+        return statement.value
+
+    @abstractmethod
+    def fetchSQL(self, sql: str, params: list) -> list[tuple]:
+        ...
+
+    @abstractmethod
+    def executeSQL(self, sql: str, params: list) -> int:
+        ...
+
+    @abstractmethod
+    def executeManySQL(self, sql: str, paramsList: list[tuple | list]) -> int:
+        ...
+
+    @abstractmethod
+    def transactionSQL(self, steps: list[tuple[str, list[tuple | list]]]) -> list[int]:
+        ...
+
+    @abstractmethod
+    def stats(self) -> dict[str, int]:
+        ...
+
+    @staticmethod
+    def expand(sql: str, params: tuple | list, expand: int) -> tuple[str, list]:
+        """
+        Fill the "{}" of a statement with one placeholder per listed value, padding the list to a power of two by repeating its last value so only a few variants get prepared
+        :return: SQL and the padded values
+        """
+        params = list(params)
+        if not expand:
+            return sql, params
+        size = 1
+        while size < expand:
+            size *= 2
+        params += [params[-1]] * (size - expand)
+        return sql.format(", ".join(["%s"] * size)), params
+
+    @staticmethod
+    def decode(value):
+        """
+        Column value as python wants it, text columns returned as bytes become str
+        :param value: value of a column
+        :return: decoded value
+        """
+        if type(value) in (bytes, bytearray):
+            return value.decode()
+        return value
+
+
+class MySQLDatabase(Database):
+    def __init__(self, host: str, user: str, password: str, dbName: str, logger: LogManager, metrics: Metrics, poolSize: int, statementCacheSize: int, pingAfter: float):
+        """
+        Fixed size pool of MySQL connections running every statement as a server side prepared statement, cached per connection
+        :param host: server to connect to
+        :param user: user to log in as
+        :param password: password of the user
+        :param dbName: database to use
+        :param logger: LogManager object to log to
+        :param metrics: Metrics object to time statements into
+        :param poolSize: connections open at most, callers wait for a free one beyond that
+        :param statementCacheSize: prepared statements kept per connection
+        :param pingAfter: seconds a connection may sit idle before it is pinged ahead of a write
+        """
+        super().__init__(logger, metrics)
+        self.host = host
+        self.user = user
+        self.password = password
+        self.dbName = dbName
+        self.poolSize = poolSize
+        self.statementCacheSize = statementCacheSize
+        self.pingAfter = pingAfter
+        self.opened = 0
+        self.failures = 0
+        self.__idle: Queue[Connection] = Queue()
+        self.__lock = Lock()
+
+    def fetchSQL(self, sql: str, params: list) -> list[tuple]:
+        return self.__run(lambda connection: self.__fetch(connection, sql, params), True)
+
+    def executeSQL(self, sql: str, params: list) -> int:
+        return self.__run(lambda connection: self.__execute(connection, sql, params), False)
+
+    def executeManySQL(self, sql: str, paramsList: list[tuple | list]) -> int:
+        """
+        INSERTs are sent as a single multi-row INSERT, anything else reuses one prepared statement on one connection
+        :return: rows affected
+        """
+        return self.__run(lambda connection: self.__executeMany(connection, sql, paramsList), False)
+
+    def transactionSQL(self, steps: list[tuple[str, list[tuple | list]]]) -> list[int]:
+        """
+        Every step on one connection between START TRANSACTION and COMMIT, rolled back if any step fails
+        :return: rows affected per step
+        """
+        return self.__run(lambda connection: self.__transaction(connection, steps), False)
+
+    def stats(self) -> dict[str, int]:
+        return {"OPEN": self.opened, "IDLE": self.__idle.qsize(), "FAILURES": self.failures}
+
+    def __run(self, operation, idempotent: bool):
+        """
+        Run an operation on a pooled connection, once more on a new connection if the old one turned out to be dead.
+        A write may have reached the server before its connection dropped, so it is only run again if the connection failed before the statement was sent
+        :param operation: function taking the Connection
+        :param idempotent: if the operation only reads and can safely run twice
+        :return: whatever the operation returns
+        """
+        for attempt in range(2):
+            connection = self.__acquire()
+            sent = False
+            try:
+                if not idempotent and time() - connection.lastUsed > self.pingAfter:
+                    connection.raw.ping()
+                sent = True
+                result = operation(connection)
+            except (InterfaceError, OperationalError) as e:
+                self.__discard(connection)
+                self.failures += 1
+                if attempt or (sent and not idempotent):
+                    raise
+                self.logger.failed("DB", f"connection dropped {repr(e)}")
+                continue
+            except Exception:
+                self.__release(connection)
+                self.failures += 1
+                raise
+            self.__release(connection)
+            return result
+
+    def __acquire(self) -> Connection:
+        """
+        An idle connection, a new one while under the pool size, else the next one released
+        :return: Connection
+        """
+        try:
+            return self.__idle.get_nowait()
+        except Empty:
+            pass
+        with self.__lock:
+            create = self.opened < self.poolSize
+            if create:
+                self.opened += 1
+        if not create:
+            return self.__idle.get()
+        try:
+            # pure python protocol, so the socket is cooperative under gevent
+            raw = MySQLConnector.connect(host=self.host, user=self.user, password=self.password, database=self.dbName, autocommit=True, use_pure=True)
+        except Exception:
+            with self.__lock:
+                self.opened -= 1
+            raise
+        return Connection(raw, self.statementCacheSize)
+
+    def __release(self, connection: Connection) -> None:
+        connection.lastUsed = time()
+        self.__idle.put(connection)
+
+    def __discard(self, connection: Connection) -> None:
+        connection.close()
+        with self.__lock:
+            self.opened -= 1
+
+    def __fetch(self, connection: Connection, sql: str, params: list) -> list[tuple]:
+        sql, cursor = connection.prepared(sql)
+        cursor.execute(sql, params)
+        return [tuple(self.decode(value) for value in row) for row in cursor.fetchall()]
+
+    @staticmethod
+    def __execute(connection: Connection, sql: str, params: list) -> int:
+        sql, cursor = connection.prepared(sql)
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+    @staticmethod
+    def __executeMany(connection: Connection, sql: str, paramsList: list[tuple | list]) -> int:
+        if sql.lstrip().upper().startswith("INSERT"):
+            cursor = connection.raw.cursor()
+            try:
+                cursor.executemany(sql, paramsList)
+                return cursor.rowcount
+            finally:
+                cursor.close()
+        sql, cursor = connection.prepared(sql)
+        cursor.executemany(sql, paramsList)
+        return cursor.rowcount
+
+    def __transaction(self, connection: Connection, steps: list[tuple[str, list[tuple | list]]]) -> list[int]:
+        connection.raw.start_transaction()
+        try:
+            rowCounts = [self.__executeMany(connection, sql, paramsList) if paramsList else 0 for sql, paramsList in steps]
+            connection.raw.commit()
+        except Exception:
+            # a dead connection fails the rollback too, which __run takes as a dropped connection
+            connection.raw.rollback()
+            raise
+        return rowCounts
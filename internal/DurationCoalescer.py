@@ -0,0 +1,124 @@
+from __future__ import annotations
+from threading import Thread, Lock, Event
+from time import sleep, time
+from typing import Callable
+from customisedLogs import Manager as LogManager
+
+from internal.Enum import Response200Messages, Response500Messages
+
+
+class PendingDuration:
+    def __init__(self):
+        self.done = Event()
+        self.statusCode = 500
+        self.statusDesc = ""
+        self.duration: str | None = None
+
+
+class DurationCoalescer:
+    def __init__(self, fetchBatch: Callable[[list[str]], tuple[int, str, dict]], storeBatch: Callable[[dict[str, str]], None], logger: LogManager, window: float, maxBatch: int, waitTimeout: float):
+        """
+        Single-flight layer over GPT duration lookups. Concurrent misses for a name wait on one in-flight call, and misses arriving within the window are sent as one prompt
+        :param fetchBatch: function sending a list of names to GPT, returning status code, description and dictionary of name to duration
+        :param storeBatch: function persisting a dictionary of name to duration, called once per batch
+        :param logger: LogManager object to log to
+        :param window: seconds to collect names for before sending a batch
+        :param maxBatch: names after which a batch is sent without waiting for the window
+        :param waitTimeout: seconds a caller waits for the batches of its names before giving up on the rest
+        """
+        self.fetchBatch = fetchBatch
+        self.storeBatch = storeBatch
+        self.logger = logger
+        self.window = window
+        self.maxBatch = maxBatch
+        self.waitTimeout = waitTimeout
+        self.batches = 0
+        self.coalesced = 0
+        self.timedOut = 0
+        self.__inFlight: dict[str, PendingDuration] = {}
+        self.__queued: list[str] = []
+        self.__flushScheduled = False
+        self.__lock = Lock()
+
+    def fetch(self, itemNames: list[str]) -> tuple[int, str, dict[str, str]]:
+        """
+        Durations of the names, joining in-flight lookups where possible
+        :param itemNames: names missing a duration
+        :return: status code, description of the batches or of the failure and dictionary of name to duration for the names found
+        """
+        waitingOn: dict[str, PendingDuration] = {}
+        toFlush = []
+        with self.__lock:
+            for itemName in dict.fromkeys(itemNames):
+                pending = self.__inFlight.get(itemName)
+                if pending is not None:
+                    self.coalesced += 1
+                else:
+                    pending = PendingDuration()
+                    self.__inFlight[itemName] = pending
+                    self.__queued.append(itemName)
+                waitingOn[itemName] = pending
+            if len(self.__queued) >= self.maxBatch:
+                toFlush, self.__queued = self.__queued, []
+            elif self.__queued and not self.__flushScheduled:
+                self.__flushScheduled = True
+                Thread(target=self.__flushAfterWindow).start()
+        if toFlush:
+            self.__flush(toFlush)
+        statusCode, statusDesc, durations = 200, "", {}
+        deadline = time() + self.waitTimeout
+        for itemName, pending in waitingOn.items():
+            if not pending.done.wait(max(deadline - time(), 0)):
+                self.timedOut += 1
+                statusCode, statusDesc = 500, Response500Messages.durationNotFound.value
+            elif pending.duration is not None:
+                durations[itemName] = pending.duration
+                if statusCode == 200 and not statusDesc:
+                    statusDesc = pending.statusDesc
+            elif pending.statusCode != 200:
+                statusCode, statusDesc = pending.statusCode, pending.statusDesc
+        return statusCode, statusDesc or Response200Messages.correct.value, durations
+
+    def stats(self) -> dict[str, int]:
+        return {"BATCHES": self.batches, "COALESCED": self.coalesced, "IN_FLIGHT": len(self.__inFlight), "TIMED_OUT": self.timedOut}
+
+    def __flushAfterWindow(self) -> None:
+        """
+        Send whatever got queued during the window
+        :return: None
+        """
+        sleep(self.window)
+        with self.__lock:
+            toFlush, self.__queued = self.__queued, []
+            self.__flushScheduled = False
+        if toFlush:
+            self.__flush(toFlush)
+
+    def __flush(self, itemNames: list[str]) -> None:
+        """
+        Send one batch, store the results once and wake every waiter
+        :param itemNames: names of the batch
+        :return: None
+        """
+        self.batches += 1
+        statusCode, statusDesc, fetched = 500, Response500Messages.durationNotFound.value, {}
+        try:
+            statusCode, statusDesc, fetched = self.fetchBatch(itemNames)
+        except Exception as e:
+            self.logger.fatal("COALESCE", repr(e))
+        durations: dict[str, str] = {}
+        if statusCode == 200:
+            requested = {itemName.casefold(): itemName for itemName in itemNames}
+            for fetchedName, duration in fetched.items():
+                if type(fetchedName) == str and type(duration) == str and fetchedName.casefold() in requested:
+                    durations[requested[fetchedName.casefold()]] = duration
+            try:
+                self.storeBatch(durations)
+            except Exception as e:
+                self.logger.fatal("COALESCE", f"store failed {repr(e)}")
+        with self.__lock:
+            pendings = {itemName: self.__inFlight.pop(itemName) for itemName in itemNames}
+        for itemName, pending in pendings.items():
+            pending.statusCode, pending.statusDesc = statusCode, statusDesc
+            pending.duration = durations.get(itemName)
+            pending.done.set()
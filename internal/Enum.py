@@ -1,11 +1,14 @@
 from enum import Enum
+from ipaddress import IPv6Network
 from pathlib import Path
 from time import sleep
-from pooledMySQL import Manager as MySQLPool
 from customisedLogs import Manager as LogManager
 from ping3 import ping
 
 from internal.SecretEnum import Secrets
+from internal.Database import Database, MySQLDatabase
+from internal.SQLiteDatabase import SQLiteDatabase
+from internal.Metrics import Metrics
 
 
 for location in Secrets.possibleFolderLocation.value:
@@ -18,26 +21,135 @@ else:
 
 class RequiredFiles(Enum):
     common = [
+        r"internal\AuthCache.py",
         r"internal\AutoReRun.py",
+        r"internal\CoreForwarder.py",
         r"internal\CustomResponse.py",
+        r"internal\Database.py",
+        r"internal\DurationCoalescer.py",
         r"internal\Enum.py",
+        r"internal\ExpiryScheduler.py",
+        r"internal\IDAllocator.py",
+        r"internal\GPTClient.py",
+        r"internal\ImageHashCache.py",
+        r"internal\ImagePreprocessor.py",
+        r"internal\ItemCatalog.py",
+        r"internal\ItemNames.py",
+        r"internal\JobQueue.py",
+        r"internal\ImageRelay.py",
+        r"internal\ImageStore.py",
+        r"internal\IPGuard.py",
         r"internal\Logger.py",
+        r"internal\Metrics.py",
         r"internal\MysqlPool.py",
+        r"internal\NotificationSink.py",
+        r"internal\PasswordPool.py",
+        r"internal\SQLiteDatabase.py",
         r"internal\SecretEnum.py",
-        r"internal\StringGenerator.py",
+        r"internal\SharedSnapshot.py",
+        r"internal\TrustToken.py",
+        r"internal\WorkerSupervisor.py",
     ]
     coreFile = r"core.py"
     userGatewayFile = r"gateway.py"
     adminGatewayFile = r"admin_gateway.py"
     purchaseImageFolder = r"savedImages"
     thumbnailFolder = r"thumbnails"
+    imageHashCacheFile = r"imageHashCache.jsonl"
+    jobSpoolFolder = r"jobSpool"
+    snapshotFolder = r"snapshots"
+    sqliteFile = r"bbb.sqlite3"
+    notificationFile = r"notifications.jsonl"
+    sqliteSchemaFile = r"migrations/sqlite/schema.sql"
 
 
 class Constants(Enum):
     logCount = 1000
+    metricBuckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
     userGatewayPort = 60200
     adminGatewayPort = 60201
-    coreServerPort = 60202
+    coreUpstreams = [("127.0.0.1", 60202)]
+    corePoolSize = 50
+    coreConnectTimeout = 2
+    coreReadTimeout = 90
+    coreFailureThreshold = 3
+    coreCircuitOpenPeriod = 10
+    coreHealthInterval = 5
+    maxImageBytes = 15 * 1024 * 1024
+    maxUploadBytes = 21 * 1024 * 1024
+    uploadChunkSize = 64 * 1024
+    fakeGPTPort = 60210
+    GPTBaseURL = "https://api.openai.com/v1"
+    GPTPoolSize = 20
+    GPTGlobalConcurrency = 20
+    GPTPerUserConcurrency = 2
+    GPTMaxRetries = 3
+    GPTBackoffBase = 1
+    GPTBackoffCap = 20
+    recognitionPromptVersion = 1
+    catalogRefreshInterval = 30
+    visionImageSide = 512
+    visionImageQuality = 85
+    imagePrepWorkers = 2
+    jobWorkers = 8
+    jobMaxQueued = 200
+    jobLongPollCap = 25
+    expiringPageSize = 50
+    expiringPageCap = 200
+    confirmItemCap = 200
+    jobPollInterval = 1
+    jobRetention = 24 * 60 * 60
+    notifyLeadDays = 1
+    notifyHour = 9
+    expiryHorizon = 60 * 60
+    expiryLoadInterval = 60
+    expiryPageSize = 1000
+    expiryShards = 1024
+    notifyBatchSize = 500
+    notifyRetryDelay = 30
+    imageStoreWorkers = 2
+    imageStoreMaxQueued = 64
+    thumbnailSize = 256
+    itemNameMatchThreshold = 0.85
+    durationBatchWindow = 0.2
+    durationMaxBatch = 50
+    imageHashThreshold = 6
+    imageHashMinBits = 8
+    GPTTaskTimeouts = {
+        "img_understanding": (5, 60),
+        "text_gen": (5, 30),
+    }
+    gatewayNodeID = 1
+    gatewayWorkers = 1
+    gatewayWorkerMaxRequests = 50000
+    gatewayWorkerGraceful = 10
+    gatewayMetricsPortBase = 60300
+    coreWorkers = 1
+    coreMetricsPortBase = 60320
+    workerSlots = 16
+    workerRestartDelay = 1
+    workerRestartCap = 30
+    workerStableAfter = 60
+    snapshotInterval = 5
+    snapshotWaitTimeout = 30
+    coreNodeIDBase = 512
+    authCacheSize = 10000
+    authCacheTTL = 300
+    trustTokenTTL = 30
+    ipRate = 5
+    ipBurst = 20
+    subnetRate = 50
+    subnetBurst = 200
+    penaltyFlushInterval = 5
+    penaltyWheelSlots = 3600
+    passwordWorkers = 4
+    passwordMaxQueued = 32
+    storageBackend = "MYSQL"
+    dbPoolSize = 20
+    dbStatementCacheSize = 32
+    dbPingAfter = 5
+    sqliteWorkers = 4
+    sqliteBusyTimeout = 5
 
 
 class Routes(Enum):
@@ -48,6 +160,10 @@ class Routes(Enum):
     imgRecv = "/bbb_imgrecv"
     requestNewItemUID = "/bbb_newitemuid"
     confirmPurchase = "/bbb_confirmPurchase"
+    coreHealth = "/bbb_health"
+    metrics = "/bbb_metrics"
+    expiringItems = "/bbb_expiring"
+    jobResult = "/bbb_jobresult"
 
 
 class RequestElements(Enum):
@@ -60,6 +176,52 @@ class RequestElements(Enum):
     }
 
 
+class Queries(Enum):
+    selectDatabase = "SELECT DATABASE()"
+    userUIDByUsername = "SELECT user_uid from user_info where username=%s"
+    deviceByExternalJWT = "SELECT address, device_uid from user_device_auth where user_uid=%s and external_jwt=%s"
+    internalJWTByUserUID = "SELECT internal_jwt from user_connection_auth where user_uid=%s"
+    userUIDByInternalJWT = "SELECT user_uid from user_connection_auth where internal_jwt=%s and user_uid=%s"
+    passHashByUserUID = "SELECT pass_hash from user_connection_auth where user_uid=%s"
+    insertUser = "INSERT INTO user_info values (%s, %s, now(), %s)"
+    insertConnectionAuth = "INSERT INTO user_connection_auth values (%s, %s, %s)"
+    insertDeviceAuth = "INSERT INTO user_device_auth values (%s, %s, %s, %s, %s)"
+    insertPurchase = "INSERT INTO purchases (purchase_uid, user_uid, image_hash) values (%s, %s, %s)"
+    purchaseOfUser = "SELECT purchase_uid from purchases where purchase_uid=%s and user_uid=%s"
+    confirmPurchase = "UPDATE purchases set confirmed_at=%s where purchase_uid=%s"
+    deletePurchaseItems = "DELETE from purchase_items where purchase_uid=%s"
+    insertPurchaseItem = "INSERT INTO purchase_items (purchase_uid, item_uid, user_uid, shard, name, expires, notify_at) values (%s, %s, %s, %s, %s, %s, %s)"
+    itemsExpiringBetween = "SELECT purchase_uid, item_uid, name, expires from purchase_items where user_uid=%s and expires >= %s and expires <= %s and (expires > %s or (expires = %s and purchase_uid > %s) or (expires = %s and purchase_uid = %s and item_uid > %s)) order by expires, purchase_uid, item_uid limit %s"
+    allKnownItems = "SELECT item_uid, name, duration, updated_at from known_items"
+    knownItemsSince = "SELECT item_uid, name, duration, updated_at from known_items where updated_at >= %s"
+    knownItemsByUIDs = "SELECT item_uid, name, duration from known_items where item_uid in ({})"
+    knownItemsByNames = "SELECT item_uid, name, duration from known_items where name in ({})"
+    insertKnownItem = "INSERT IGNORE INTO known_items (item_uid, name) values (%s, %s)"
+    updateItemDuration = "UPDATE known_items set duration=%s where item_uid=%s"
+    activePenalties = "SELECT address, expires from ip_penalties where expires > %s"
+    upsertPenalty = "INSERT INTO ip_penalties values (%s, %s) ON DUPLICATE KEY UPDATE expires=GREATEST(expires, VALUES(expires))"
+    unfinishedJobs = "SELECT job_uid, user_uid from recognition_jobs where node_id=%s and state!='DONE'"
+    insertJob = "INSERT INTO recognition_jobs (job_uid, user_uid, node_id, state) values (%s, %s, %s, 'QUEUED')"
+    jobByUser = "SELECT state, status_code, status_desc, result from recognition_jobs where job_uid=%s and user_uid=%s"
+    markJobRunning = "UPDATE recognition_jobs set state='RUNNING' where job_uid=%s"
+    markJobDone = "UPDATE recognition_jobs set state='DONE', status_code=%s, status_desc=%s, result=%s where job_uid=%s"
+    deleteFinishedJobs = "DELETE from recognition_jobs where state='DONE' and updated_at < %s"
+    expiriesDue = "SELECT purchase_uid, item_uid, user_uid, name, expires, notify_at from purchase_items where notified=0 and notify_at <= %s and shard >= %s and shard < %s and (notify_at > %s or (notify_at = %s and purchase_uid > %s) or (notify_at = %s and purchase_uid = %s and item_uid > %s)) order by notify_at, purchase_uid, item_uid limit %s"
+    claimExpiry = "UPDATE purchase_items set notified=1 where purchase_uid=%s and item_uid=%s and notify_at=%s and notified=0"
+
+
+class SQLiteQueries(Enum):
+    selectDatabase = "SELECT 'main'"
+    insertUser = "INSERT INTO user_info values (%s, %s, strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'), %s)"
+    insertKnownItem = "INSERT OR IGNORE INTO known_items (item_uid, name) values (%s, %s)"
+    upsertPenalty = "INSERT INTO ip_penalties values (%s, %s) ON CONFLICT (address) DO UPDATE set expires=MAX(expires, excluded.expires)"
+
+
+class StorageBackends(Enum):
+    mysql = "MYSQL"
+    sqlite = "SQLITE"
+
+
 class commonMethods:
     @staticmethod
     def waitForNetwork(logger:LogManager):
@@ -93,6 +255,20 @@ class commonMethods:
             return a == b
         return addressA == addressB
 
+    @staticmethod
+    def subnetOf(address: str) -> str:
+        """
+        Subnet an address is grouped under, the */24 for IPv4 as in checkRelatedIP and the */64 for IPv6
+        :param address: IP as string
+        :return: subnet as string, the address itself if it cant be parsed
+        """
+        if address.count(".") == 3:
+            return ".".join(address.split(".")[:-1]) + ".0/24"
+        try:
+            return str(IPv6Network(f"{address}/64", strict=False))
+        except ValueError:
+            return address
+
     @staticmethod
     def sqlISafe(parameter):
         """
@@ -105,15 +281,44 @@ class commonMethods:
         return parameter
 
     @staticmethod
-    def connectDB(logger:LogManager) -> MySQLPool:
+    def workerLayout(coreUpstreamIndex: int | None, workers: int) -> tuple[int, list[int]]:
         """
-        Blocking function to connect to DB
+        Node IDs and private metrics ports of the workers of the gateway or of one CORE upstream. Each of them owns a fixed block of workerSlots node IDs and ports,
+        the gateway first and then one block per CORE upstream, so no resize or upstream shifts what another group holds. Checked at startup so a bad config fails before anything binds
+        :param coreUpstreamIndex: index of the CORE in Constants.coreUpstreams, None for the gateway
+        :param workers: worker processes of the group
+        :return: node ID of worker 0 and metrics port of every worker
+        """
+        slots = Constants.workerSlots.value
+        upstreams = len(Constants.coreUpstreams.value)
+        nodeBlocks = [range(Constants.gatewayNodeID.value, Constants.gatewayNodeID.value + slots)] + [range(Constants.coreNodeIDBase.value + index * slots, Constants.coreNodeIDBase.value + (index + 1) * slots) for index in range(upstreams)]
+        portBlocks = [range(Constants.gatewayMetricsPortBase.value, Constants.gatewayMetricsPortBase.value + slots)] + [range(Constants.coreMetricsPortBase.value + index * slots, Constants.coreMetricsPortBase.value + (index + 1) * slots) for index in range(upstreams)]
+        servicePorts = [Constants.userGatewayPort.value, Constants.adminGatewayPort.value, Constants.fakeGPTPort.value] + [port for _, port in Constants.coreUpstreams.value]
+        if workers > slots:
+            raise ValueError(f"{workers} workers do not fit the {slots} worker slots")
+        if nodeBlocks[0].stop > Constants.coreNodeIDBase.value or nodeBlocks[-1].stop > 1024:
+            raise ValueError(f"node IDs of {upstreams} CORE upstreams with {slots} worker slots do not fit")
+        for index, block in enumerate(portBlocks):
+            clashes = [port for port in servicePorts if port in block] + [port for other in portBlocks[index + 1:] for port in other if port in block]
+            if clashes:
+                raise ValueError(f"metrics ports {block.start}-{block.stop - 1} clash with {clashes}")
+        group = 0 if coreUpstreamIndex is None else 1 + coreUpstreamIndex
+        return nodeBlocks[group].start, list(portBlocks[group])[:workers]
+
+    @staticmethod
+    def connectDB(logger:LogManager, metrics:Metrics) -> Database:
+        """
+        Blocking function to connect to DB, the embedded SQLite file if that backend is chosen
         :return: None
         """
+        if Constants.storageBackend.value == StorageBackends.sqlite.value:
+            tables = SQLiteDatabase.bootstrap(RequiredFiles.sqliteFile.value, RequiredFiles.sqliteSchemaFile.value)
+            logger.success("DB", f"embedded: {RequiredFiles.sqliteFile.value} ({len(tables)} tables)")
+            return SQLiteDatabase(RequiredFiles.sqliteFile.value, SQLiteQueries, logger, metrics, Constants.sqliteWorkers.value, Constants.sqliteBusyTimeout.value)
         for host in Secrets.DBHosts.value:
             try:
-                mysqlPool = MySQLPool(user="root", password=Secrets.DBPassword.value, dbName=Secrets.DBName.value, host=host)
-                mysqlPool.execute(f"SELECT DATABASE();")
+                mysqlPool = MySQLDatabase(host, "root", Secrets.DBPassword.value, Secrets.DBName.value, logger, metrics, Constants.dbPoolSize.value, Constants.dbStatementCacheSize.value, Constants.dbPingAfter.value)
+                mysqlPool.fetch(Queries.selectDatabase)
                 logger.success("DB", f"connected to: {host}")
                 return mysqlPool
             except:
@@ -134,6 +339,13 @@ class Response200Messages(Enum):
     correct = "CORRECT"
     dummyRecogniser = "DUMMY_RECOGNISER"
     dummyExpiry = "DUMMY_EXPIRY"
+    cachedRecogniser = "CACHED_RECOGNISER"
+    expiryPartial = "EXPIRY_PARTIAL"
+
+
+class Response202Messages(Enum):
+    jobAccepted = "JOB_ACCEPTED"
+    jobPending = "JOB_PENDING"
 
 
 class Response403Messages(Enum):
@@ -146,13 +358,35 @@ class Response403Messages(Enum):
     coreRejectedAuth = "CORE_REJECTED_AUTH"
     incompleteRegistration = "INCOMPLETE_REGISTRATION"
     incorrectMethod = "METHOD_INCORRECT"
+    internalOnly = "INTERNAL_ONLY"
+
+class Response404Messages(Enum):
+    jobNotFound = "JOB_NOT_FOUND"
+    purchaseNotFound = "PURCHASE_NOT_FOUND"
+
+class Response413Messages(Enum):
+    imageTooLarge = "IMG_TOO_LARGE"
 
 class Response422Messages(Enum):
     postErrorGPT = "GPT_POST_ERROR"
     parseFailed = "PARSE_FAIL"
+    itemNameMissing = "ITEMNAME_MISSING"
+    invalidDateRange = "DATE_RANGE_INVALID"
+    invalidCursor = "CURSOR_INVALID"
+    invalidLimit = "LIMIT_INVALID"
+    invalidItemList = "ITEM_LIST_INVALID"
+
+class Response429Messages(Enum):
+    rateLimited = "RATE_LIMITED"
 
 class Response500Messages(Enum):
     imageNotFound = "IMG_NOT_FOUND"
     durationNotFound = "DUR_UNAVAILABLE"
+    itemNotCreated = "ITEM_NOT_CREATED"
     coreDown = "CORE_DOWN"
+    jobFailed = "JOB_FAILED"
     dummy = "DUMMY"
+
+class Response503Messages(Enum):
+    authBusy = "AUTH_BUSY"
+    jobQueueFull = "JOB_QUEUE_FULL"
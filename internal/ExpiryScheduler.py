@@ -0,0 +1,237 @@
+from __future__ import annotations
+from datetime import datetime, date, timedelta
+from heapq import heappush, heappop, heapify
+from threading import Thread, Lock
+from time import time, sleep
+from zlib import crc32
+from customisedLogs import Manager as LogManager
+
+from internal.Database import Database
+from internal.Enum import Queries
+from internal.NotificationSink import NotificationSink
+
+
+class ExpiryScheduler:
+    def __init__(self, mysqlPool: Database, sink: NotificationSink, logger: LogManager, shards: int, owners: int, owner: int, leadDays: int, notifyHour: int, horizon: float, loadInterval: float, pageSize: int, batchSize: int, retryDelay: float):
+        """
+        Fires a notification for every tracked item some days before it expires. Only items due within the horizon are held, in a min-heap on notify time,
+        loaded from purchase_items by keyset pages over (notify_at, purchase_uid, item_uid), so no scan ever touches the rest of the table.
+        Every row belongs to a shard of its user, and the shards are split evenly over the running schedulers, so which scheduler loads a row follows from the current count of schedulers and never from who wrote it.
+        Loads continue from the last row loaded, as a row written due within the horizon is scheduled by the process writing it whatever its shard. Once per horizon a load starts over from the oldest unnotified row, picking up rows a writer stopped before sending.
+        A row is claimed in the DB, only if still unnotified with the same notify time, before it is sent, so a stale entry or one held by a second scheduler is never sent twice
+        :param mysqlPool: pool to read and claim purchase_items with
+        :param sink: where batches of notifications are delivered
+        :param logger: LogManager object to log to
+        :param shards: shards rows are spread over by user, the same for every scheduler and never changed once rows are stored
+        :param owners: schedulers running in total
+        :param owner: index of this scheduler among them
+        :param leadDays: days before the expiry date to notify on
+        :param notifyHour: hour of the day to notify at
+        :param horizon: seconds ahead of now held in memory
+        :param loadInterval: seconds between loads of the horizon
+        :param pageSize: rows read per keyset page
+        :param batchSize: notifications sent to the sink at once
+        :param retryDelay: seconds before a batch the sink or DB refused is tried again
+        """
+        self.mysqlPool = mysqlPool
+        self.sink = sink
+        self.logger = logger
+        self.shards = shards
+        self.firstShard = owner * shards // owners
+        self.endShard = (owner + 1) * shards // owners
+        self.leadDays = leadDays
+        self.notifyHour = notifyHour
+        self.horizon = horizon
+        self.loadInterval = loadInterval
+        self.pageSize = pageSize
+        self.batchSize = batchSize
+        self.retryDelay = retryDelay
+        self.tracked = 0
+        self.loaded = 0
+        self.notified = 0
+        self.stale = 0
+        self.retried = 0
+        self.__heap: list[tuple[float, str, str, str, str, str, datetime, bool]] = []
+        self.__scheduled: set[tuple[str, str, datetime]] = set()
+        self.__loadedUpTo: tuple[datetime, str, str] = (datetime(1970, 1, 2), "", "")
+        self.__fullLoadAt = 0.0
+        self.__lock = Lock()
+
+    def start(self) -> None:
+        """
+        Load everything due within the horizon, including items missed while down, and start the loader and the firer, called once at startup
+        :return: None
+        """
+        self.__load()
+        self.logger.success("EXPIRY", f"scheduled {len(self.__heap)} notifications of shards {self.firstShard}-{self.endShard - 1}")
+        Thread(target=self.__loader, daemon=True).start()
+        Thread(target=self.__firer, daemon=True).start()
+
+    def notifyAt(self, expires: str) -> datetime:
+        """
+        When to notify about an item
+        :param expires: expiry date as YYYY-MM-DD
+        :return: datetime to notify at
+        """
+        return datetime.combine(date.fromisoformat(expires) - timedelta(days=self.leadDays), datetime.min.time()).replace(hour=self.notifyHour)
+
+    def shardOf(self, userUID: str) -> int:
+        """
+        Shard of a user, CRC32 so migrations compute the same shard in SQL
+        :param userUID: User ID
+        :return: shard number
+        """
+        return crc32(userUID.encode()) % self.shards
+
+    def itemRows(self, userUID: str, purchaseUID: str, expiryDict: dict[str, dict[str, str]]) -> list[tuple]:
+        """
+        purchase_items rows of a purchase, items without a usable expiry date are kept with no expiry and never notified
+        :param userUID: User ID owning the purchase
+        :param purchaseUID: ID of the purchase
+        :param expiryDict: dictionary of item UID to NAME and EXPIRES, as attachExpiry returns it
+        :return: rows in Queries.insertPurchaseItem order
+        """
+        shard = self.shardOf(userUID)
+        rows = []
+        for itemUID, item in expiryDict.items():
+            expires = item.get("EXPIRES")
+            try:
+                notifyAt = self.notifyAt(expires)
+            except (TypeError, ValueError):
+                expires, notifyAt = None, None
+            rows.append((purchaseUID, itemUID, userUID, shard, item["NAME"], expires, notifyAt))
+        return rows
+
+    def track(self, rows: list[tuple]) -> int:
+        """
+        Schedule at once the just written items due within the horizon, of any shard, as the scheduler owning the shard may have loaded past them already.
+        Items due later are loaded by the scheduler owning their shard once they come within its horizon
+        :param rows: purchase_items rows from itemRows(), already stored
+        :return: number of items with a notification to come
+        """
+        tracked = 0
+        until = time() + self.horizon
+        with self.__lock:
+            for purchaseUID, itemUID, userUID, shard, itemName, expires, notifyAt in rows:
+                if notifyAt is None:
+                    continue
+                tracked += 1
+                if notifyAt.timestamp() <= until:
+                    self.__schedule(purchaseUID, itemUID, userUID, itemName, expires, notifyAt)
+        self.tracked += tracked
+        return tracked
+
+    def untrack(self, purchaseUID: str) -> int:
+        """
+        Drop the pending notifications of a purchase whose items were replaced, before the new rows are tracked. Only a shortcut, a stale entry left anywhere fails its claim
+        :param purchaseUID: ID of the purchase
+        :return: number of notifications dropped
+        """
+        with self.__lock:
+            kept = [entry for entry in self.__heap if entry[1] != purchaseUID]
+            dropped = len(self.__heap) - len(kept)
+            if dropped:
+                heapify(kept)
+                self.__heap = kept
+                self.__scheduled = {scheduled for scheduled in self.__scheduled if scheduled[0] != purchaseUID}
+        return dropped
+
+    def stats(self) -> dict[str, int]:
+        return {"SCHEDULED": len(self.__heap), "TRACKED": self.tracked, "LOADED": self.loaded, "NOTIFIED": self.notified, "STALE": self.stale, "RETRIED": self.retried}
+
+    def __schedule(self, purchaseUID: str, itemUID: str, userUID: str, itemName: str, expires: str, notifyAt: datetime) -> None:
+        if (purchaseUID, itemUID, notifyAt) in self.__scheduled:
+            return
+        self.__scheduled.add((purchaseUID, itemUID, notifyAt))
+        heappush(self.__heap, (notifyAt.timestamp(), purchaseUID, itemUID, userUID, itemName, expires, notifyAt, False))
+
+    def __load(self) -> None:
+        """
+        Page through the unnotified rows of this scheduler's shards from the last row loaded, or once per horizon from the oldest, up to the end of the horizon.
+        Rows written meanwhile behind the last row loaded were due within the horizon of their writer, which scheduled them
+        :return: None
+        """
+        now = time()
+        until = datetime.fromtimestamp(now + self.horizon)
+        if now - self.__fullLoadAt >= self.horizon:
+            self.__loadedUpTo, self.__fullLoadAt = (datetime(1970, 1, 2), "", ""), now
+        while True:
+            notifyAt, purchaseUID, itemUID = self.__loadedUpTo
+            rows = self.mysqlPool.fetch(Queries.expiriesDue, (until, self.firstShard, self.endShard, notifyAt, notifyAt, purchaseUID, notifyAt, purchaseUID, itemUID, self.pageSize))
+            with self.__lock:
+                for rowPurchaseUID, rowItemUID, userUID, itemName, expires, rowNotifyAt in rows:
+                    self.__schedule(rowPurchaseUID, rowItemUID, userUID, itemName, str(expires), rowNotifyAt)
+            self.loaded += len(rows)
+            if rows:
+                self.__loadedUpTo = (rows[-1][5], rows[-1][0], rows[-1][1])
+            if len(rows) < self.pageSize:
+                break
+
+    def __loader(self) -> None:
+        """
+        Infinite loop moving the horizon forward
+        :return: None
+        """
+        while True:
+            sleep(self.loadInterval)
+            try:
+                self.__load()
+            except Exception as e:
+                self.logger.failed("EXPIRY", f"load failed {repr(e)}")
+
+    def __firer(self) -> None:
+        """
+        Infinite loop sending every notification that came due, in batches
+        :return: None
+        """
+        while True:
+            sleep(1)
+            now = time()
+            while True:
+                with self.__lock:
+                    batch = []
+                    while self.__heap and self.__heap[0][0] <= now and len(batch) < self.batchSize:
+                        batch.append(heappop(self.__heap))
+                if not batch:
+                    break
+                self.__fire(batch)
+
+    def __fire(self, batch: list[tuple[float, str, str, str, str, str, datetime, bool]]) -> None:
+        """
+        Claim the rows of a batch in one transaction, marking notified only those still unnotified with the notify time they were scheduled for, and send the claimed ones.
+        Rows that were replaced, re-dated or claimed by another scheduler are dropped, a batch the DB or the sink refused is put back to be tried again
+        :return: None
+        """
+        unclaimed = [entry for entry in batch if not entry[7]]
+        try:
+            rowCounts = self.mysqlPool.transaction([(Queries.claimExpiry, [(purchaseUID, itemUID, notifyAt)]) for _, purchaseUID, itemUID, _, _, _, notifyAt, _ in unclaimed]) if unclaimed else []
+        except Exception as e:
+            self.logger.failed("EXPIRY", f"claim failed {repr(e)}")
+            self.__retry(batch)
+            return
+        claimed = [entry for entry in batch if entry[7]] + [entry for entry, rowCount in zip(unclaimed, rowCounts) if rowCount]
+        self.stale += len(batch) - len(claimed)
+        with self.__lock:
+            for _, purchaseUID, itemUID, _, _, _, notifyAt, _ in batch:
+                self.__scheduled.discard((purchaseUID, itemUID, notifyAt))
+        if not claimed:
+            return
+        notifications = [{"USER_UID": userUID, "PURCHASE_UID": purchaseUID, "ITEM_UID": itemUID, "NAME": itemName, "EXPIRES": expires} for _, purchaseUID, itemUID, userUID, itemName, expires, _, _ in claimed]
+        try:
+            delivered = self.sink.send(notifications)
+        except Exception as e:
+            self.logger.failed("EXPIRY", f"sink failed {repr(e)}")
+            delivered = False
+        if delivered:
+            self.notified += len(claimed)
+        else:
+            # the rows stay claimed, so no other scheduler sends them meanwhile
+            self.__retry([entry[:7] + (True,) for entry in claimed])
+
+    def __retry(self, entries: list[tuple[float, str, str, str, str, str, datetime, bool]]) -> None:
+        self.retried += len(entries)
+        retryAt = time() + self.retryDelay
+        with self.__lock:
+            for entry in entries:
+                self.__scheduled.add((entry[1], entry[2], entry[6]))
+                heappush(self.__heap, (retryAt,) + entry[1:])
@@ -0,0 +1,134 @@
+from __future__ import annotations
+from email.utils import parsedate_to_datetime
+from random import uniform
+from threading import BoundedSemaphore, Lock
+from time import sleep, time
+from requests import Session, Response
+from requests.adapters import HTTPAdapter
+from customisedLogs import Manager as LogManager
+
+
+class GPTRequestFailed(Exception):
+    pass
+
+
+class GPTClient:
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, baseURL: str, headers: dict, logger: LogManager, poolSize: int, globalConcurrency: int, perUserConcurrency: int, maxRetries: int, backoffBase: float, backoffCap: float, taskTimeouts: dict[str, tuple[float, float]]):
+        """
+        Shared client for all GPT calls of CORE, one pooled HTTPS session with concurrency limits and retries
+        :param baseURL: API root, e.g. https://api.openai.com/v1 or a local stand-in
+        :param headers: headers to send with every request
+        :param logger: LogManager object to log to
+        :param poolSize: keep-alive connections to hold
+        :param globalConcurrency: requests allowed in flight across all users
+        :param perUserConcurrency: requests allowed in flight per user
+        :param maxRetries: retries on 429/5xx/connection errors before giving up
+        :param backoffBase: first backoff in seconds, doubled on each retry
+        :param backoffCap: largest backoff in seconds
+        :param taskTimeouts: (connect, read) timeouts keyed by Tasks value
+        """
+        self.baseURL = baseURL.rstrip("/")
+        self.logger = logger
+        self.maxRetries = maxRetries
+        self.backoffBase = backoffBase
+        self.backoffCap = backoffCap
+        self.taskTimeouts = taskTimeouts
+        self.perUserConcurrency = perUserConcurrency
+        self.session = Session()
+        self.session.headers.update(headers)
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=poolSize, max_retries=0))
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=poolSize, max_retries=0))
+        self.__globalSemaphore = BoundedSemaphore(globalConcurrency)
+        self.__userSemaphores: dict[str, list] = {}
+        self.__lock = Lock()
+
+    def chatCompletion(self, payload: dict, task: str, userUID: str = "") -> dict:
+        """
+        POST a chat completion, waiting for a free slot and retrying with backoff
+        :param payload: request JSON
+        :param task: Tasks value deciding the timeouts
+        :param userUID: user on whose behalf the call is made, empty for calls not tied to a user
+        :return: response JSON, raises GPTRequestFailed once retries are exhausted
+        """
+        userSemaphore = self.__acquireUser(userUID)
+        try:
+            return self.__postWithRetries(payload, self.taskTimeouts[task])
+        finally:
+            self.__releaseUser(userUID, userSemaphore)
+
+    def __postWithRetries(self, payload: dict, timeout: tuple[float, float]) -> dict:
+        """
+        POST to the completions endpoint, retrying on retryable failures. A global slot is held only while a request is in flight, never while backing off
+        :param payload: request JSON
+        :param timeout: (connect, read) timeout
+        :return: response JSON
+        """
+        lastError = ""
+        for attempt in range(self.maxRetries + 1):
+            retryAfter = None
+            try:
+                with self.__globalSemaphore:
+                    response = self.session.post(f"{self.baseURL}/chat/completions", json=payload, timeout=timeout)
+                if response.status_code == 200:
+                    return response.json()
+                lastError = f"HTTP {response.status_code}"
+                if response.status_code not in self.RETRY_STATUS:
+                    break
+                retryAfter = self.__retryAfter(response)
+            except Exception as e:
+                lastError = repr(e)
+            if attempt < self.maxRetries:
+                delay = retryAfter if retryAfter is not None else min(self.backoffCap, self.backoffBase * (2 ** attempt)) * uniform(0.5, 1)
+                self.logger.failed("GPTPOST", f"{lastError}, retry {attempt + 1}/{self.maxRetries} in {delay:.2f}s")
+                sleep(delay)
+        raise GPTRequestFailed(lastError)
+
+    def __retryAfter(self, response: Response) -> float | None:
+        """
+        Seconds asked to wait by the server, Retry-After may be seconds or an HTTP date
+        :param response: response received
+        :return: seconds capped to backoffCap or None if not provided
+        """
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                seconds = parsedate_to_datetime(value).timestamp() - time()
+            except:
+                return None
+        return min(self.backoffCap, max(0.0, seconds))
+
+    def __acquireUser(self, userUID: str) -> BoundedSemaphore | None:
+        """
+        Wait for a free slot of the user
+        :param userUID: user to acquire for
+        :return: the semaphore acquired, None if the call is not tied to a user
+        """
+        if not userUID:
+            return None
+        with self.__lock:
+            semaphoreAndUsers = self.__userSemaphores.setdefault(userUID, [BoundedSemaphore(self.perUserConcurrency), 0])
+            semaphoreAndUsers[1] += 1
+        semaphoreAndUsers[0].acquire()
+        return semaphoreAndUsers[0]
+
+    def __releaseUser(self, userUID: str, semaphore: BoundedSemaphore | None) -> None:
+        """
+        Free the slot of the user and forget the user's semaphore once unused
+        :param userUID: user to release for
+        :param semaphore: semaphore returned by __acquireUser
+        :return: None
+        """
+        if semaphore is None:
+            return
+        semaphore.release()
+        with self.__lock:
+            semaphoreAndUsers = self.__userSemaphores[userUID]
+            semaphoreAndUsers[1] -= 1
+            if not semaphoreAndUsers[1]:
+                del self.__userSemaphores[userUID]
@@ -0,0 +1,52 @@
+from __future__ import annotations
+from secrets import randbits
+from threading import Lock
+from time import time, sleep
+
+
+class IDAllocator:
+    ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+    NODE_BITS = 10
+    SEQUENCE_BITS = 12
+    RANDOM_BITS = 30
+
+    def __init__(self, nodeID: int):
+        """
+        Time ordered, node tagged ID generator. IDs of one node never collide, and IDs of different nodes differ in the node bits, so no DB check is needed before inserting.
+        Layout (100 bits, 20 Crockford base32 characters): 48 bit millisecond timestamp | 10 bit node | 12 bit sequence | 30 bit random
+        :param nodeID: ID of this process, unique across every running gateway and CORE process
+        """
+        if not 0 <= nodeID < 2 ** self.NODE_BITS:
+            raise ValueError(f"nodeID must be within 0 and {2 ** self.NODE_BITS - 1}")
+        self.nodeID = nodeID
+        self.__lastMillisecond = 0
+        self.__sequence = 0
+        self.__lock = Lock()
+
+    def new(self) -> str:
+        """
+        Next ID, sorting after every ID this node created before
+        :return: 20 character ID
+        """
+        with self.__lock:
+            millisecond = max(int(time() * 1000), self.__lastMillisecond)
+            if millisecond == self.__lastMillisecond:
+                self.__sequence += 1
+                if self.__sequence >= 2 ** self.SEQUENCE_BITS:
+                    while millisecond <= self.__lastMillisecond:
+                        sleep(0.0005)
+                        millisecond = int(time() * 1000)
+                    self.__sequence = 0
+            else:
+                self.__sequence = 0
+            self.__lastMillisecond = millisecond
+            sequence = self.__sequence
+        value = millisecond
+        value = (value << self.NODE_BITS) | self.nodeID
+        value = (value << self.SEQUENCE_BITS) | sequence
+        value = (value << self.RANDOM_BITS) | randbits(self.RANDOM_BITS)
+        characters = []
+        for _ in range(20):
+            characters.append(self.ALPHABET[value & 31])
+            value >>= 5
+        return "".join(reversed(characters))
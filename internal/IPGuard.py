@@ -0,0 +1,183 @@
+from __future__ import annotations
+from datetime import datetime
+from threading import Thread, Lock
+from time import time, sleep
+from customisedLogs import Manager as LogManager
+
+from internal.Database import Database
+from internal.Enum import Queries, commonMethods
+
+
+class TimingWheel:
+    def __init__(self, slots: int):
+        """
+        Hashed timing wheel of one second slots, expiring keys in O(1) per tick. Keys expiring further out than the wheel turns are carried over on each pass
+        :param slots: seconds covered by one turn of the wheel
+        """
+        self.slots = slots
+        self.__wheel: list[set[str]] = [set() for _ in range(slots)]
+
+    def schedule(self, key: str, expiry: float) -> None:
+        self.__wheel[int(expiry) % self.slots].add(key)
+
+    def due(self, second: int) -> set[str]:
+        """
+        Take every key scheduled in the slot of this second
+        :param second: unix time in seconds
+        :return: keys to check for expiry
+        """
+        index = second % self.slots
+        keys, self.__wheel[index] = self.__wheel[index], set()
+        return keys
+
+
+class IPGuard:
+    def __init__(self, mysqlPool: Database, logger: LogManager, addressRate: float, addressBurst: int, subnetRate: float, subnetBurst: int, flushInterval: float, wheelSlots: int):
+        """
+        In-memory IP limiter and penalty table. Requests are rate limited by token buckets on the address and on its subnet, and penalties are held in memory, expired by a timing wheel and written to ip_penalties in batches
+        :param mysqlPool: pool to load and flush ip_penalties with
+        :param logger: LogManager object to log to
+        :param addressRate: tokens per second refilled for one address
+        :param addressBurst: tokens one address can hold
+        :param subnetRate: tokens per second refilled for one subnet (/24 for IPv4, /64 for IPv6)
+        :param subnetBurst: tokens one subnet can hold
+        :param flushInterval: seconds between batched writes to ip_penalties
+        :param wheelSlots: seconds covered by one turn of the penalty timing wheel
+        """
+        self.mysqlPool = mysqlPool
+        self.logger = logger
+        self.addressRate = addressRate
+        self.addressBurst = addressBurst
+        self.subnetRate = subnetRate
+        self.subnetBurst = subnetBurst
+        self.flushInterval = flushInterval
+        self.limited = 0
+        self.flushed = 0
+        self.__buckets: dict[str, list[float]] = {}
+        self.__penalties: dict[str, float] = {}
+        self.__unflushed: dict[str, float] = {}
+        self.__wheel = TimingWheel(wheelSlots)
+        self.__lock = Lock()
+
+    def start(self) -> None:
+        """
+        Load penalties still active in DB and start the expiry and flush loops, called once at startup
+        :return: None
+        """
+        for address, expires in self.mysqlPool.fetch(Queries.activePenalties, (datetime.now(),)):
+            self.__penalties[address] = expires.timestamp()
+            self.__wheel.schedule(address, expires.timestamp())
+        self.logger.success("IPGUARD", f"loaded {len(self.__penalties)} penalties")
+        Thread(target=self.__ticker, daemon=True).start()
+        Thread(target=self.__flusher, daemon=True).start()
+
+    def allow(self, address: str) -> bool:
+        """
+        Take a token from the buckets of the address and its subnet
+        :param address: IP of the requestor
+        :return: bool stating if the request fits within both limits
+        """
+        now = time()
+        subnet = "/" + commonMethods.subnetOf(address)
+        with self.__lock:
+            # both buckets are checked before either is charged, so a request refused by one does not use up the other
+            addressBucket = self.__refill(address, now, self.addressRate, self.addressBurst)
+            subnetBucket = self.__refill(subnet, now, self.subnetRate, self.subnetBurst)
+            allowed = addressBucket[0] >= 1 and subnetBucket[0] >= 1
+            if allowed:
+                addressBucket[0] -= 1
+                subnetBucket[0] -= 1
+            else:
+                self.limited += 1
+        return allowed
+
+    def penalise(self, address: str, seconds: int) -> None:
+        """
+        Block an address for some seconds, extending any longer penalty it already has
+        :param address: IP to penalise
+        :param seconds: seconds to block for
+        :return: None
+        """
+        with self.__lock:
+            self.__penalise(address, time() + seconds)
+
+    def isPenalised(self, address: str) -> bool:
+        return self.__penalties.get(address, 0) > time()
+
+    def stats(self) -> dict[str, int]:
+        return {"BUCKETS": len(self.__buckets), "PENALTIES": len(self.__penalties), "UNFLUSHED": len(self.__unflushed), "LIMITED": self.limited, "FLUSHED": self.flushed}
+
+    def __refill(self, key: str, now: float, rate: float, burst: int) -> list[float]:
+        """
+        Bucket of a key, refilled for the time passed since it was last used
+        :return: bucket as [tokens, last used]
+        """
+        bucket = self.__buckets.get(key)
+        if bucket is None:
+            bucket = self.__buckets[key] = [burst, now]
+            self.__wheel.schedule(key, now + burst / rate)
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        return bucket
+
+    def __penalise(self, address: str, expiry: float) -> None:
+        if expiry <= self.__penalties.get(address, 0):
+            return
+        self.__penalties[address] = expiry
+        self.__unflushed[address] = expiry
+        self.__wheel.schedule(address, expiry)
+
+    def __ticker(self) -> None:
+        """
+        Infinite loop turning the wheel once a second, dropping expired penalties and buckets idle long enough to be full again
+        :return: None
+        """
+        second = int(time())
+        while True:
+            sleep(1)
+            now = time()
+            with self.__lock:
+                while second <= int(now):
+                    for key in self.__wheel.due(second):
+                        self.__expire(key, now)
+                    second += 1
+
+    def __expire(self, key: str, now: float) -> None:
+        """
+        Drop a key whose slot came up, or schedule it again if it was extended since
+        :return: None
+        """
+        if key.startswith("/"):
+            rate, burst = self.subnetRate, self.subnetBurst
+        else:
+            rate, burst = self.addressRate, self.addressBurst
+            expiry = self.__penalties.get(key)
+            if expiry is not None:
+                if expiry <= now: self.__penalties.pop(key)
+                else: self.__wheel.schedule(key, expiry)
+        bucket = self.__buckets.get(key)
+        if bucket is not None:
+            idleUntil = bucket[1] + (burst - bucket[0]) / rate
+            if idleUntil <= now: self.__buckets.pop(key)
+            else: self.__wheel.schedule(key, idleUntil)
+
+    def __flusher(self) -> None:
+        """
+        Infinite loop writing penalties set since the last flush with one batched upsert
+        :return: None
+        """
+        while True:
+            sleep(self.flushInterval)
+            with self.__lock:
+                unflushed, self.__unflushed = self.__unflushed, {}
+            if not unflushed:
+                continue
+            try:
+                self.mysqlPool.executeMany(Queries.upsertPenalty, [(address, datetime.fromtimestamp(expiry)) for address, expiry in unflushed.items()])
+                self.flushed += len(unflushed)
+            except Exception as e:
+                self.logger.failed("IPGUARD", f"flush failed {repr(e)}")
+                with self.__lock:
+                    for address, expiry in unflushed.items():
+                        self.__unflushed[address] = max(expiry, self.__unflushed.get(address, 0))
@@ -0,0 +1,400 @@
+from __future__ import annotations
+from contextlib import contextmanager
+from io import BytesIO
+from json import dumps, loads
+from os import getpid, replace, stat
+from pathlib import Path
+from queue import Queue, Empty
+from struct import pack, iter_unpack
+from threading import Thread, Lock
+from time import sleep
+from PIL import Image, ImageOps
+
+from internal.SharedSnapshot import SharedSnapshot
+
+try:
+    from fcntl import flock, LOCK_EX, LOCK_UN
+except ImportError:
+    flock = None
+
+
+class BKTree:
+    def __init__(self):
+        """
+        Burkhard-Keller tree over 64-bit hashes, searchable by Hamming distance
+        """
+        self.root: list | None = None
+        self.size = 0
+
+    @staticmethod
+    def distance(hashA: int, hashB: int) -> int:
+        return (hashA ^ hashB).bit_count()
+
+    def add(self, imageHash: int, value) -> None:
+        """
+        Insert a hash, replacing the value if the exact hash is already present
+        :param imageHash: 64-bit hash
+        :param value: value to return on lookups
+        :return: None
+        """
+        node = [imageHash, value, {}]
+        if self.root is None:
+            self.root = node
+            self.size += 1
+            return
+        current = self.root
+        while True:
+            distance = self.distance(imageHash, current[0])
+            if distance == 0:
+                current[1] = value
+                return
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                self.size += 1
+                return
+            current = child
+
+    def nearest(self, imageHash: int, threshold: int, accept=lambda value: True) -> tuple[int, object] | None:
+        """
+        Closest accepted value within the threshold
+        :param imageHash: 64-bit hash to look for
+        :param threshold: largest Hamming distance to consider
+        :param accept: filter on values
+        :return: (distance, value) or None
+        """
+        if self.root is None:
+            return None
+        best = None
+        toVisit = [self.root]
+        while toVisit:
+            node = toVisit.pop()
+            distance = self.distance(imageHash, node[0])
+            if distance <= threshold and (best is None or distance < best[0]) and accept(node[1]):
+                best = (distance, node[1])
+            for childDistance, child in node[2].items():
+                if distance - threshold <= childDistance <= distance + threshold:
+                    toVisit.append(child)
+        return best
+
+    def items(self) -> list[tuple[int, object]]:
+        """
+        Every hash held and its value
+        :return: list of (hash, value)
+        """
+        found = []
+        toVisit = [self.root] if self.root is not None else []
+        while toVisit:
+            node = toVisit.pop()
+            found.append((node[0], node[1]))
+            toVisit += node[2].values()
+        return found
+
+
+class ImageHashCache:
+    def __init__(self, cacheFile: str, promptVersion: int, threshold: int, minBits: int, snapshot: SharedSnapshot | None, publishesSnapshot: bool, refreshInterval: float):
+        """
+        Cache of the items recognised for the images of each user, keyed on the perceptual hash of the image and persisted to a JSON-lines file.
+        A user is only ever served items recognised from their own images, and hashes of flat or evenly shaded images, which carry too few set or unset bits to tell images apart, are neither stored nor looked up.
+        Worker processes of one CORE share it through a snapshot: the publisher follows the file every worker appends to and writes the snapshot, the rest search it in place and hold only what they stored since.
+        Every process appends under an advisory lock on a lock file next to the cache file. The publisher, or a process running alone at load, rewrites the file with one line per hash once superseded lines make up most of it, holding that lock, so no line appended meanwhile is lost.
+        Where the platform has no advisory locks the file is never rewritten.
+        In the snapshot every hash is also listed under each of threshold + 1 bit ranges, one of which a hash within the threshold must match exactly
+        :param cacheFile: file to load from and append to
+        :param promptVersion: version of the recognition prompt, results of other versions are never returned
+        :param threshold: largest Hamming distance still treated as the same image
+        :param minBits: fewest set, and unset, bits a hash needs to be cached
+        :param snapshot: snapshot shared by the workers, None for a CORE running as one process
+        :param publishesSnapshot: bool stating if this process writes the snapshot rather than reading it
+        :param refreshInterval: seconds between publishing or checking for a newer snapshot
+        """
+        self.cacheFile = Path(cacheFile)
+        self.lockFile = self.cacheFile.with_name(f"{self.cacheFile.name}.lock")
+        self.promptVersion = promptVersion
+        self.threshold = threshold
+        self.minBits = minBits
+        self.snapshot = snapshot
+        self.publishesSnapshot = publishesSnapshot
+        self.refreshInterval = refreshInterval
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.__trees: dict[str, BKTree] = {}
+        self.__local: dict[tuple[str, int], tuple[int, list]] = {}
+        self.__readsSnapshot = snapshot is not None and not publishesSnapshot
+        self.__offset = 0
+        self.__inode = None
+        self.__unpublished = False
+        self.__lines = 0
+        self.__pending: Queue[str] = Queue()
+        self.__lock = Lock()
+        self.__fileLock = Lock()
+        if not self.__readsSnapshot:
+            self.__load()
+
+    def start(self) -> None:
+        """
+        Start the writer, and when workers share the cache publish the first snapshot, or map the publisher's, and start refreshing it, called once at startup
+        :return: None
+        """
+        Thread(target=self.__writer, daemon=True).start()
+        if self.snapshot is None:
+            return
+        self.__refresh()
+        Thread(target=self.__refresher, daemon=True).start()
+
+    @staticmethod
+    def dHash(imgBytes: bytes) -> int:
+        """
+        64-bit difference hash of the orientation fixed, greyscale, 9x8 downscaled image
+        :param imgBytes: encoded image
+        :return: hash as integer
+        """
+        imgObj = Image.open(BytesIO(imgBytes))
+        imgObj.draft("L", (64, 64))
+        imgObj = ImageOps.exif_transpose(imgObj).convert("L").resize((9, 8), Image.Resampling.LANCZOS)
+        pixels = imgObj.tobytes()
+        imageHash = 0
+        for row in range(8):
+            for column in range(8):
+                imageHash = (imageHash << 1) | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+        return imageHash
+
+    def informative(self, imageHash: int) -> bool:
+        """
+        Hash has enough set and unset bits to tell the image apart from others, flat and evenly shaded images hash to nearly all 0 or all 1
+        :param imageHash: 64-bit hash
+        :return: bool
+        """
+        return self.minBits <= imageHash.bit_count() <= 64 - self.minBits
+
+    def lookup(self, userUID: str, imageHash: int) -> list | None:
+        """
+        Items recognised for the nearest known image of the user under the current prompt version
+        :param userUID: User ID which sent the image
+        :param imageHash: hash of the new image
+        :return: list of items or None on a miss
+        """
+        if not self.informative(imageHash):
+            with self.__lock:
+                self.skipped += 1
+            return None
+        with self.__lock:
+            tree = self.__trees.get(userUID)
+            found = tree.nearest(imageHash, self.threshold, lambda value: value[0] == self.promptVersion) if tree is not None else None
+            if self.__readsSnapshot:
+                sharedFound = self.__sharedNearest(userUID, imageHash)
+                if sharedFound is not None and (found is None or sharedFound[0] < found[0]):
+                    found = sharedFound
+            if found is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return list(found[1][1])
+
+    def store(self, userUID: str, imageHash: int, items: list) -> None:
+        """
+        Remember the items recognised for an image of the user and queue them to be persisted
+        :param userUID: User ID which sent the image
+        :param imageHash: hash of the image
+        :param items: recognised items
+        :return: None
+        """
+        if not self.informative(imageHash):
+            return
+        with self.__lock:
+            self.__trees.setdefault(userUID, BKTree()).add(imageHash, (self.promptVersion, list(items)))
+            if self.__readsSnapshot:
+                self.__local[(userUID, imageHash)] = (self.promptVersion, list(items))
+        self.__pending.put(self.__line(userUID, imageHash, items))
+
+    def stats(self) -> dict[str, int]:
+        return {"SIZE": sum(tree.size for tree in self.__trees.values()), "SHARED": self.snapshot.stats()["ENTRIES"] if self.snapshot is not None else 0, "HITS": self.hits, "MISSES": self.misses, "SKIPPED": self.skipped}
+
+    def chunks(self, imageHash: int) -> list[int]:
+        """
+        The hash cut into threshold + 1 bit ranges of near equal width
+        :param imageHash: 64-bit hash
+        :return: value of every range
+        """
+        count = self.threshold + 1
+        values = []
+        shift = 64
+        for index in range(count):
+            width = 64 // count + (index < 64 % count)
+            shift -= width
+            values.append((imageHash >> shift) & ((1 << width) - 1))
+        return values
+
+    def __line(self, userUID: str, imageHash: int, items: list) -> str:
+        return dumps({"U": userUID, "H": f"{imageHash:016x}", "V": self.promptVersion, "I": items}) + "\n"
+
+    @contextmanager
+    def __appending(self):
+        """
+        Hold the file for appending or rewriting, against the threads of this process and, through the lock file, against other processes
+        """
+        with self.__fileLock:
+            if flock is None:
+                yield
+                return
+            with self.lockFile.open("a") as lockFile:
+                flock(lockFile, LOCK_EX)
+                try:
+                    yield
+                finally:
+                    flock(lockFile, LOCK_UN)
+
+    def __load(self) -> None:
+        """
+        Rebuild the trees from the persisted file, later lines override earlier ones
+        :return: None
+        """
+        if not self.cacheFile.is_file():
+            return
+        self.__follow()
+        if self.snapshot is None:
+            self.__compact()
+
+    def __follow(self) -> bool:
+        """
+        Add the lines appended to the file since the last read, stopping before a line still being written. A file rewritten since is read again from the start
+        :return: bool stating if any line was added
+        """
+        if not self.cacheFile.is_file():
+            return False
+        added = False
+        with self.cacheFile.open("rb") as cacheFile:
+            inode = stat(cacheFile.fileno()).st_ino
+            if inode != self.__inode:
+                self.__inode, self.__offset, self.__lines = inode, 0, 0
+            cacheFile.seek(self.__offset)
+            for line in cacheFile:
+                if not line.endswith(b"\n"):
+                    break
+                self.__offset += len(line)
+                self.__lines += 1
+                try:
+                    entry = loads(line)
+                    self.__trees.setdefault(entry["U"], BKTree()).add(int(entry["H"], 16), (entry["V"], entry["I"]))
+                    added = True
+                except:
+                    continue
+        return added
+
+    def __writer(self) -> None:
+        """
+        Infinite loop appending the queued lines to the file, all that queued up in one write
+        :return: None
+        """
+        while True:
+            lines = [self.__pending.get()]
+            try:
+                while True:
+                    lines.append(self.__pending.get_nowait())
+            except Empty:
+                pass
+            try:
+                with self.__appending():
+                    with self.cacheFile.open("a") as cacheFile:
+                        cacheFile.write("".join(lines))
+                if self.snapshot is None:
+                    self.__lines += len(lines)
+            except Exception:
+                continue
+
+    def __compact(self) -> None:
+        """
+        Rewrite the file with one line per cached image of the current prompt version once at least half of its lines are superseded, swapping it in place.
+        The lines other processes appended since the trees were copied are carried over while holding the append lock, and the rewrite is skipped if another process rewrote the file first
+        :return: None
+        """
+        if flock is None:
+            return
+        with self.__lock:
+            current = [(userUID, imageHash, items) for userUID, tree in self.__trees.items() for imageHash, (version, items) in tree.items() if version == self.promptVersion]
+            if self.__lines <= 2 * len(current):
+                return
+            offset, inode = self.__offset, self.__inode
+        compacted = "".join(self.__line(userUID, imageHash, items) for userUID, imageHash, items in current).encode()
+        temporaryPath = self.cacheFile.with_name(f"{self.cacheFile.name}.{getpid()}.tmp")
+        with self.__appending():
+            if not self.cacheFile.is_file() or stat(self.cacheFile).st_ino != inode:
+                return
+            with temporaryPath.open("wb") as temporaryFile:
+                temporaryFile.write(compacted)
+                with self.cacheFile.open("rb") as cacheFile:
+                    cacheFile.seek(offset)
+                    tail = cacheFile.read()
+                temporaryFile.write(tail[:tail.rfind(b"\n") + 1])
+            replace(temporaryPath, self.cacheFile)
+            with self.__lock:
+                self.__offset = len(compacted)
+                self.__lines = len(current)
+                self.__inode = stat(self.cacheFile).st_ino
+
+    def __refresher(self) -> None:
+        """
+        Infinite loop publishing what workers appended, or mapping the newest snapshot
+        :return: None
+        """
+        while True:
+            sleep(self.refreshInterval)
+            try:
+                self.__refresh()
+            except Exception:
+                continue
+
+    def __refresh(self) -> None:
+        if self.__readsSnapshot:
+            if self.snapshot.refresh():
+                with self.__lock:
+                    self.__dropPublished()
+            return
+        with self.__lock:
+            self.__unpublished = self.__follow() or self.__unpublished or not self.snapshot.ready()
+            if not self.__unpublished:
+                return
+            self.__unpublished = False
+            entries: dict[str, bytes] = {}
+            postings: dict[str, list[int]] = {}
+            for userUID, tree in self.__trees.items():
+                for imageHash, (version, items) in tree.items():
+                    if version != self.promptVersion:
+                        continue
+                    entries[f"H{userUID}:{imageHash:016x}"] = dumps(items).encode()
+                    for index, chunk in enumerate(self.chunks(imageHash)):
+                        postings.setdefault(f"C{userUID}:{index}:{chunk}", []).append(imageHash)
+        entries.update({key: pack(f"<{len(hashes)}Q", *hashes) for key, hashes in postings.items()})
+        SharedSnapshot.write(self.snapshot.path, entries)
+        self.snapshot.refresh()
+        self.__compact()
+
+    def __sharedNearest(self, userUID: str, imageHash: int) -> tuple[int, tuple[int, list]] | None:
+        """
+        Closest hash of the user in the snapshot within the threshold, looking only at hashes sharing a bit range with this one
+        :return: (distance, (prompt version, items)) or None
+        """
+        candidates = set()
+        for index, chunk in enumerate(self.chunks(imageHash)):
+            hashes = self.snapshot.get(f"C{userUID}:{index}:{chunk}")
+            if hashes:
+                candidates.update(candidate for candidate, in iter_unpack("<Q", hashes))
+        best = None
+        for candidate in candidates:
+            distance = BKTree.distance(imageHash, candidate)
+            if distance <= self.threshold and (best is None or distance < best[0]):
+                best = (distance, candidate)
+        if best is None:
+            return None
+        return best[0], (self.promptVersion, loads(self.snapshot.get(f"H{userUID}:{best[1]:016x}")))
+
+    def __dropPublished(self) -> None:
+        """
+        Forget the entries stored locally that the newly mapped snapshot holds
+        :return: None
+        """
+        self.__local = {(userUID, imageHash): value for (userUID, imageHash), value in self.__local.items() if self.snapshot.get(f"H{userUID}:{imageHash:016x}") is None}
+        self.__trees = {}
+        for (userUID, imageHash), value in self.__local.items():
+            self.__trees.setdefault(userUID, BKTree()).add(imageHash, value)
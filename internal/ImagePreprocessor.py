@@ -0,0 +1,51 @@
+from __future__ import annotations
+from io import BytesIO
+from gevent.threadpool import ThreadPool
+from PIL import Image, ImageOps
+
+from internal.ImageHashCache import ImageHashCache
+
+
+class ImagePreprocessor:
+    def __init__(self, maxSide: int, quality: int, workers: int):
+        """
+        Shrinks uploads to what the vision model actually looks at, on native threads away from the gevent hub
+        :param maxSide: longest side of the prepared image in pixels, the effective resolution of "detail": "low"
+        :param quality: JPEG quality of the prepared image
+        :param workers: native threads preparing images at once
+        """
+        self.maxSide = maxSide
+        self.quality = quality
+        self.prepared = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.__pool = ThreadPool(workers)
+
+    def prepare(self, imgBytes: bytes) -> tuple[bytes, int]:
+        """
+        EXIF stripped, orientation fixed, downscaled JPEG of the upload along with its perceptual hash. Raises if the bytes are not a readable image
+        :param imgBytes: bytes received from the client
+        :return: prepared JPEG bytes, 64-bit dHash of the prepared image
+        """
+        preparedBytes, imageHash = self.__pool.apply(self.__prepare, (imgBytes,))
+        self.prepared += 1
+        self.bytesIn += len(imgBytes)
+        self.bytesOut += len(preparedBytes)
+        return preparedBytes, imageHash
+
+    def stats(self) -> dict[str, int]:
+        return {"PREPARED": self.prepared, "BYTES_IN": self.bytesIn, "BYTES_OUT": self.bytesOut}
+
+    def __prepare(self, imgBytes: bytes) -> tuple[bytes, int]:
+        """
+        Runs on a pool thread. JPEG draft mode lets the decoder skip straight to a scale near the target size
+        :return: prepared JPEG bytes, dHash
+        """
+        with Image.open(BytesIO(imgBytes)) as imgObj:
+            imgObj.draft("RGB", (self.maxSide, self.maxSide))
+            imgObj = ImageOps.exif_transpose(imgObj).convert("RGB")
+            imgObj.thumbnail((self.maxSide, self.maxSide), Image.Resampling.LANCZOS)
+            output = BytesIO()
+            imgObj.save(output, format="JPEG", quality=self.quality, optimize=True)
+        preparedBytes = output.getvalue()
+        return preparedBytes, ImageHashCache.dHash(preparedBytes)
@@ -0,0 +1,192 @@
+from __future__ import annotations
+from binascii import a2b_base64, Error as Base64Error
+from typing import Iterator, BinaryIO
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, File, Data, Epilogue
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class ImageNotFound(Exception):
+    pass
+
+
+class RelayedImage:
+    def __init__(self, chunks: Iterator[bytes], maxBytes: int):
+        """
+        Iterable over the decoded image bytes of a request, counting and limiting its size while being consumed
+        :param chunks: iterator of raw image chunks
+        :param maxBytes: bytes after which UploadTooLarge is raised
+        """
+        self.size = 0
+        self.__chunks = chunks
+        self.__maxBytes = maxBytes
+        self.__firstChunk = b""
+        for chunk in self.__chunks:
+            if chunk:
+                self.__firstChunk = self.__count(chunk)
+                break
+        else:
+            raise ImageNotFound
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield self.__firstChunk
+        self.__firstChunk = b""
+        for chunk in self.__chunks:
+            if chunk:
+                yield self.__count(chunk)
+
+    def __count(self, chunk: bytes) -> bytes:
+        self.size += len(chunk)
+        if self.size > self.__maxBytes:
+            raise UploadTooLarge
+        return chunk
+
+
+class ImageRelay:
+    def __init__(self, maxBytes: int, chunkSize: int):
+        """
+        Pipe an uploaded image out of the request stream chunk by chunk, without holding the whole image in memory
+        :param maxBytes: largest decoded image to accept
+        :param chunkSize: bytes to read from the request at once
+        """
+        self.maxBytes = maxBytes
+        self.chunkSize = chunkSize
+
+    def fromMultipart(self, stream: BinaryIO, boundary: str, fieldName: str) -> RelayedImage:
+        """
+        Stream the file field of a multipart body
+        :param stream: raw request stream
+        :param boundary: multipart boundary from the Content-Type header
+        :param fieldName: name of the file field holding the image
+        :return: RelayedImage, raises ImageNotFound if the field is absent or empty
+        """
+        return RelayedImage(self.__multipartChunks(stream, boundary.encode(), fieldName), self.maxBytes)
+
+    def fromBase64JSON(self, stream: BinaryIO, fieldName: str) -> RelayedImage:
+        """
+        Stream the decoded value of a base64 string field of a JSON body
+        :param stream: raw request stream
+        :param fieldName: JSON key holding the base64 image
+        :return: RelayedImage, raises ImageNotFound if the field is absent or empty
+        """
+        return RelayedImage(self.__base64JSONChunks(stream, fieldName), self.maxBytes)
+
+    def __multipartChunks(self, stream: BinaryIO, boundary: bytes, fieldName: str) -> Iterator[bytes]:
+        """
+        Incrementally parse the multipart body and yield only the data of the required file
+        """
+        decoder = MultipartDecoder(boundary)
+        inField = False
+        while True:
+            event = decoder.next_event()
+            if isinstance(event, NeedData):
+                chunk = stream.read(self.chunkSize)
+                decoder.receive_data(chunk if chunk else None)
+            elif isinstance(event, File):
+                inField = event.name == fieldName
+            elif isinstance(event, Data):
+                if inField:
+                    yield event.data
+                    if not event.more_data:
+                        return
+            elif isinstance(event, Epilogue):
+                return
+
+    def __base64JSONChunks(self, stream: BinaryIO, fieldName: str) -> Iterator[bytes]:
+        """
+        Scan the JSON body for the string value of the field and base64 decode it as it arrives.
+        Only a key of the outermost object matches, nested containers and every other string are stepped over
+        """
+        key = fieldName.encode()
+        buffer, position = b"", 0
+        depth, inObject, expectKey, lastKey, matched = 0, False, False, None, False
+        while True:
+            if position >= len(buffer):
+                buffer, position = stream.read(self.chunkSize), 0
+                if not buffer:
+                    return
+            byte = buffer[position:position + 1]
+            position += 1
+            if byte == b'"':
+                if depth == 1 and matched:
+                    break
+                text, buffer, position = self.__skipString(stream, buffer, position, len(key) + 1)
+                if text is None:
+                    return
+                if depth == 1 and expectKey:
+                    lastKey, expectKey = text, False
+            elif byte in b"{[":
+                depth += 1
+                if depth == 1:
+                    inObject = expectKey = byte == b"{"
+            elif byte in b"}]":
+                depth -= 1
+                if depth <= 0:
+                    return
+            elif depth == 1 and byte == b":":
+                matched, lastKey = lastKey == key, None
+            elif depth == 1 and byte == b",":
+                matched, expectKey = False, inObject
+        buffer = buffer[position:]
+        pending = b""
+        while True:
+            closingAt = buffer.find(b'"')
+            finished = closingAt != -1
+            if finished:
+                buffer = buffer[:closingAt]
+            elif buffer.endswith(b"\\"):
+                buffer, carry = buffer[:-1], b"\\"
+            else:
+                carry = b""
+            if b"\\" in buffer:
+                buffer = buffer.replace(b"\\/", b"/").replace(b"\\n", b"").replace(b"\\r", b"")
+            pending += buffer.replace(b"\n", b"").replace(b"\r", b"").replace(b" ", b"")
+            usable = len(pending) - len(pending) % 4
+            if finished:
+                usable = len(pending)
+            if usable:
+                try:
+                    yield a2b_base64(pending[:usable])
+                except Base64Error:
+                    return
+                pending = pending[usable:]
+            if finished:
+                return
+            chunk = stream.read(self.chunkSize)
+            if not chunk:
+                return
+            buffer = carry + chunk
+
+    def __skipString(self, stream: BinaryIO, buffer: bytes, position: int, keep: int) -> tuple[bytes | None, bytes, int]:
+        """
+        Step over a JSON string whose opening quote is consumed, honouring escapes and reading on from the stream as needed
+        :param stream: raw request stream
+        :param buffer: bytes read and not yet consumed
+        :param position: index in the buffer the string continues at
+        :param keep: count of leading raw bytes of the string to return
+        :return: leading raw bytes of the string or None if the body ended inside it, remaining buffer and the index after the closing quote
+        """
+        text = b""
+        escaped = False
+        while True:
+            if position >= len(buffer):
+                buffer, position = stream.read(self.chunkSize), 0
+                if not buffer:
+                    return None, b"", 0
+            if escaped:
+                text += buffer[position:position + 1][:keep - len(text)]
+                position += 1
+                escaped = False
+                continue
+            end = min((found for found in (buffer.find(b'"', position), buffer.find(b"\\", position)) if found != -1), default=len(buffer))
+            text += buffer[position:end][:keep - len(text)]
+            if end == len(buffer):
+                position = end
+            elif buffer[end:end + 1] == b'"':
+                return text, buffer, end + 1
+            else:
+                text += b"\\"[:keep - len(text)]
+                escaped = True
+                position = end + 1
@@ -0,0 +1,114 @@
+from __future__ import annotations
+from hashlib import sha256
+from io import BytesIO
+from os import replace, getpid
+from pathlib import Path
+from secrets import token_hex
+from threading import Lock
+from gevent.threadpool import ThreadPool
+from PIL import Image
+from customisedLogs import Manager as LogManager
+
+from internal.Metrics import Metrics
+
+
+class ImageStore:
+    def __init__(self, imageFolder: str, thumbnailFolder: str, logger: LogManager, workers: int, maxQueued: int, thumbnailSize: int, metrics: Metrics):
+        """
+        Fixed size pool of native threads saving purchase images and their thumbnails, named by the sha256 of the image bytes so a repeated upload is stored once
+        :param imageFolder: folder to save full images in
+        :param thumbnailFolder: folder to save thumbnails in
+        :param logger: LogManager object to log to
+        :param workers: native threads decoding and encoding at once
+        :param maxQueued: images allowed to wait for a free thread before a submitter waits for its own image to be written
+        :param thumbnailSize: longest side of a thumbnail in pixels
+        :param metrics: Metrics object to time saves into
+        """
+        self.imageFolder = Path(imageFolder)
+        self.thumbnailFolder = Path(thumbnailFolder)
+        self.logger = logger
+        self.workers = workers
+        self.maxQueued = maxQueued
+        self.thumbnailSize = thumbnailSize
+        self.metrics = metrics
+        self.stored = 0
+        self.deduplicated = 0
+        self.throttled = 0
+        self.failed = 0
+        self.peakQueued = 0
+        self.__pending: set[str] = set()
+        self.__pool = ThreadPool(workers)
+        self.__lock = Lock()
+        self.imageFolder.mkdir(parents=True, exist_ok=True)
+        self.thumbnailFolder.mkdir(parents=True, exist_ok=True)
+
+    def submit(self, imgBytes: bytes) -> str | None:
+        """
+        Queue an image to be saved, without waiting for it to be written unless the queue is full, as the hash returned gets recorded against the purchase
+        :param imgBytes: prepared JPEG bytes, saved as they are
+        :return: content hash the image is saved under, None if it was empty
+        """
+        if not imgBytes:
+            return None
+        contentHash = sha256(imgBytes).hexdigest()
+        with self.__lock:
+            if contentHash in self.__pending:
+                self.deduplicated += 1
+                return contentHash
+            full = len(self.__pending) >= self.workers + self.maxQueued
+            if full:
+                self.throttled += 1
+            else:
+                self.__pending.add(contentHash)
+                self.peakQueued = max(self.peakQueued, len(self.__pending))
+        if full:
+            # backpressure, the submitter waits for a thread to write its image
+            self.__pool.apply(self.__save, (imgBytes, contentHash))
+            return contentHash
+        self.__pool.spawn(self.__save, imgBytes, contentHash).rawlink(lambda _: self.__pending.discard(contentHash))
+        return contentHash
+
+    def imagePath(self, contentHash: str) -> Path:
+        return Path(self.imageFolder, contentHash).with_suffix(".jpg")
+
+    def thumbnailPath(self, contentHash: str) -> Path:
+        return Path(self.thumbnailFolder, contentHash).with_suffix(".jpg")
+
+    def stats(self) -> dict[str, int]:
+        return {"QUEUED": len(self.__pending), "PEAK_QUEUED": self.peakQueued, "STORED": self.stored, "DEDUPLICATED": self.deduplicated, "THROTTLED": self.throttled, "FAILED": self.failed}
+
+    def __save(self, imgBytes: bytes, contentHash: str) -> None:
+        """
+        Write the full image as received and a thumbnail of it, skipping files already saved by an earlier upload
+        :return: None
+        """
+        imagePath = self.imagePath(contentHash)
+        thumbnailPath = self.thumbnailPath(contentHash)
+        if imagePath.is_file() and thumbnailPath.is_file():
+            self.deduplicated += 1
+            return
+        try:
+            with self.metrics.timed("image_save"):
+                if not imagePath.is_file():
+                    self.__write(imagePath, imgBytes)
+                with Image.open(BytesIO(imgBytes)) as imgObj:
+                    imgObj.draft("RGB", (self.thumbnailSize, self.thumbnailSize))
+                    imgObj = imgObj.convert("RGB")
+                    imgObj.thumbnail((self.thumbnailSize, self.thumbnailSize))
+                    thumbnailBytes = BytesIO()
+                    imgObj.save(thumbnailBytes, optimize=True, quality=70, format="JPEG")
+                self.__write(thumbnailPath, thumbnailBytes.getvalue())
+            self.stored += 1
+        except Exception as e:
+            self.failed += 1
+            self.logger.failed("IMGSAVE", f"{contentHash} {repr(e)}")
+
+    @staticmethod
+    def __write(path: Path, data: bytes) -> None:
+        """
+        Write to a temporary file and move it in place, so a half written file is never taken as already saved. The temporary name is unique to the process and call, as CORE workers may save the same image at once
+        :return: None
+        """
+        temporaryPath = path.with_suffix(f".{getpid()}.{token_hex(4)}.tmp")
+        temporaryPath.write_bytes(data)
+        replace(temporaryPath, path)
@@ -0,0 +1,270 @@
+from __future__ import annotations
+from threading import Thread
+from time import sleep, time
+from customisedLogs import Manager as LogManager
+
+from internal.Database import Database
+from internal.Enum import Queries
+from internal.IDAllocator import IDAllocator
+from internal.ItemNames import ItemNameNormaliser, TrigramIndex
+from internal.SharedSnapshot import SharedSnapshot
+
+
+class ItemCatalog:
+    def __init__(self, mysqlPool: Database, idAllocator: IDAllocator, logger: LogManager, refreshInterval: float, matchThreshold: float, snapshot: SharedSnapshot | None, publishesSnapshot: bool, snapshotWait: float):
+        """
+        In-memory copy of known_items keyed on canonical item names, resolving names to UIDs in bulk and UIDs to expiry durations.
+        Worker processes of one CORE share the copy through a snapshot: the publisher holds every row and writes the snapshot, the rest read it in place and hold only the rows they fetched since
+        :param mysqlPool: pool to read and write known_items with
+        :param idAllocator: allocator for new item UIDs
+        :param logger: LogManager object to log to
+        :param refreshInterval: seconds between pulls of rows changed by other servers, or between checks for a newer snapshot
+        :param matchThreshold: trigram similarity a name has to exceed to resolve to an existing item
+        :param snapshot: snapshot shared by the workers, None for a CORE running as one process
+        :param publishesSnapshot: bool stating if this process writes the snapshot rather than reading it
+        :param snapshotWait: seconds a reader waits for the first snapshot before loading every row from DB itself
+        """
+        self.mysqlPool = mysqlPool
+        self.idAllocator = idAllocator
+        self.logger = logger
+        self.refreshInterval = refreshInterval
+        self.matchThreshold = matchThreshold
+        self.snapshot = snapshot
+        self.publishesSnapshot = publishesSnapshot
+        self.snapshotWait = snapshotWait
+        self.hits = 0
+        self.misses = 0
+        self.fuzzyMatches = 0
+        self.__keyToUID: dict[str, str] = {}
+        self.__aliasToUID: dict[str, str] = {}
+        self.__uidToDuration: dict[str, str | None] = {}
+        self.__trigrams = TrigramIndex()
+        self.__watermark = None
+        self.__readsSnapshot = snapshot is not None and not publishesSnapshot
+        self.__unpublished = True
+
+    def warm(self) -> None:
+        """
+        Load every known item into memory, or map the snapshot of the publisher if it shows up in time, and start the refresher, called once at startup
+        :return: None
+        """
+        if self.__readsSnapshot:
+            # resolving names without the catalog would create duplicates of items it holds, so wait for the publisher's first snapshot
+            deadline = time() + self.snapshotWait
+            while not self.snapshot.refresh() and not self.snapshot.ready() and time() < deadline:
+                sleep(0.5)
+            if self.snapshot.ready():
+                self.logger.success("CATALOG", f"mapped {self.snapshot.stats()['ENTRIES']} snapshot entries")
+            else:
+                # no publisher in sight, hold and refresh the whole catalog like a single process rather than wait forever
+                self.__readsSnapshot = False
+                self.logger.failed("CATALOG", f"no snapshot after {self.snapshotWait}s, loading from DB")
+        if not self.__readsSnapshot:
+            self.__pullChanges()
+            self.__publish()
+            self.logger.success("CATALOG", f"warmed {len(self.__keyToUID)} items")
+        Thread(target=self.__refresher, daemon=True).start()
+
+    @staticmethod
+    def canonicalName(itemName: str) -> str:
+        """
+        Name an item is stored under in known_items
+        :param itemName: name as received
+        :return: canonical display name, empty if nothing usable is left
+        """
+        return ItemNameNormaliser.display(ItemNameNormaliser.key(itemName))
+
+    def resolveUIDs(self, itemNames: list[str]) -> dict[str, str]:
+        """
+        UID of every name, resolving near-matches to existing items and creating the rest with one SELECT and one multi-row INSERT
+        :param itemNames: names to resolve
+        :return: dictionary of name as received to UID
+        """
+        nameToKey = {itemName: ItemNameNormaliser.key(itemName) for itemName in itemNames}
+        resolved = {}
+        for itemName, key in nameToKey.items():
+            itemUID = self.__resolveKey(key)
+            if itemUID is not None:
+                resolved[itemName] = itemUID
+        missing = list(dict.fromkeys(key for itemName, key in nameToKey.items() if key and itemName not in resolved))
+        for _ in range(3):
+            if not missing:
+                break
+            self.__fetchKeys(missing)
+            missing = [key for key in missing if self.__resolveKey(key) is None]
+            if missing:
+                self.mysqlPool.executeMany(Queries.insertKnownItem, [(self.idAllocator.new(), ItemNameNormaliser.display(key)) for key in missing])
+                self.__fetchKeys(missing)
+                missing = [key for key in missing if self.__resolveKey(key) is None]
+        if missing:
+            self.logger.fatal("CATALOG", f"unable to create {missing}")
+        for itemName, key in nameToKey.items():
+            if itemName not in resolved and key:
+                itemUID = self.__resolveKey(key)
+                if itemUID is not None:
+                    resolved[itemName] = itemUID
+        return resolved
+
+    def fetchDuration(self, itemName: str) -> str | None:
+        """
+        Expiry duration of an item from memory, falling back to DB only for names never seen
+        :param itemName: name of the item
+        :return: duration string or None if unknown
+        """
+        key = ItemNameNormaliser.key(itemName)
+        itemUID = self.__resolveKey(key)
+        if itemUID is not None:
+            self.hits += 1
+            return self.__duration(itemUID)
+        self.misses += 1
+        if key:
+            self.__fetchKeys([key])
+            itemUID = self.__resolveKey(key)
+        return self.__duration(itemUID) if itemUID is not None else None
+
+    def fetchUID(self, itemName: str) -> str | None:
+        """
+        UID of a name already held in memory, exact or near-match
+        :param itemName: name of the item
+        :return: UID or None if not held
+        """
+        return self.__resolveKey(ItemNameNormaliser.key(itemName))
+
+    def storeDurations(self, uidToDuration: dict[str, str]) -> None:
+        """
+        Write durations through to DB with one prepared UPDATE run per item and to memory
+        :param uidToDuration: dictionary of item UID to duration string
+        :return: None
+        """
+        if not uidToDuration:
+            return
+        self.mysqlPool.executeMany(Queries.updateItemDuration, [(duration, itemUID) for itemUID, duration in uidToDuration.items()])
+        self.__uidToDuration.update(uidToDuration)
+        self.__unpublished = True
+
+    def stats(self) -> dict[str, int]:
+        return {"SIZE": len(self.__keyToUID), "SHARED": self.snapshot.stats()["ENTRIES"] if self.snapshot is not None else 0, "HITS": self.hits, "MISSES": self.misses, "FUZZY": self.fuzzyMatches}
+
+    def __resolveKey(self, key: str) -> str | None:
+        """
+        UID of the canonical key, or of the most similar known key above the threshold
+        :param key: canonical key
+        :return: UID or None
+        """
+        if not key:
+            return None
+        itemUID = self.__keyToUID.get(key) or self.__aliasToUID.get(key) or self.__sharedUID(key)
+        if itemUID is not None:
+            return itemUID
+        match = self.__trigrams.best(key, self.matchThreshold)
+        if self.__readsSnapshot:
+            sharedMatch = TrigramIndex.bestOf(key, self.matchThreshold, self.__sharedPostings, lambda candidate: len(TrigramIndex.grams(candidate)))
+            if sharedMatch is not None and (match is None or sharedMatch[1] > match[1]):
+                match = sharedMatch
+        if match is None:
+            return None
+        self.fuzzyMatches += 1
+        itemUID = self.__keyToUID.get(match[0]) or self.__sharedUID(match[0])
+        self.__aliasToUID[key] = itemUID
+        self.logger.info("CATALOG", f"{key} matched {match[0]} ({match[1]:.2f})")
+        return itemUID
+
+    def __index(self, itemUID, itemName, duration) -> None:
+        """
+        Hold a known_items row in memory, the first row of a canonical key wins
+        :return: None
+        """
+        key = ItemNameNormaliser.key(itemName)
+        self.__uidToDuration[itemUID] = duration
+        self.__unpublished = True
+        if key and key not in self.__keyToUID:
+            self.__keyToUID[key] = itemUID
+            self.__aliasToUID.pop(key, None)
+            self.__trigrams.add(key)
+
+    def __pullChanges(self) -> None:
+        """
+        Load rows changed since the last pull, everything on the first call
+        :return: None
+        """
+        if self.__watermark is None:
+            rows = self.mysqlPool.fetch(Queries.allKnownItems)
+        else:
+            rows = self.mysqlPool.fetch(Queries.knownItemsSince, (self.__watermark,))
+        for itemUID, itemName, duration, updatedAt in rows:
+            self.__index(itemUID, itemName, duration)
+            if self.__watermark is None or updatedAt > self.__watermark:
+                self.__watermark = updatedAt
+
+    def __refresher(self) -> None:
+        """
+        Infinite loop pulling rows changed by other servers and publishing them, or mapping the newest snapshot
+        :return: None
+        """
+        while True:
+            sleep(self.refreshInterval)
+            try:
+                if self.__readsSnapshot:
+                    if self.snapshot.refresh():
+                        self.__dropPublished()
+                else:
+                    self.__pullChanges()
+                    self.__publish()
+            except Exception as e:
+                self.logger.failed("CATALOG", f"refresh failed {repr(e)}")
+
+    def __publish(self) -> None:
+        """
+        Write every held row and the trigram index to the snapshot if anything changed since the last write
+        :return: None
+        """
+        if not self.publishesSnapshot or self.snapshot is None or not self.__unpublished:
+            return
+        self.__unpublished = False
+        entries = {f"K{key}": itemUID.encode() for key, itemUID in self.__aliasToUID.items()}
+        entries.update({f"K{key}": itemUID.encode() for key, itemUID in self.__keyToUID.items()})
+        entries.update({f"D{itemUID}": (duration or "").encode() for itemUID, duration in self.__uidToDuration.items()})
+        entries.update({f"G{gram}": "\n".join(keys).encode() for gram, keys in self.__trigrams.postings().items()})
+        SharedSnapshot.write(self.snapshot.path, entries)
+
+    def __dropPublished(self) -> None:
+        """
+        Forget the rows held locally that the newly mapped snapshot holds the same way
+        :return: None
+        """
+        self.__keyToUID = {key: itemUID for key, itemUID in self.__keyToUID.items() if self.__sharedUID(key) != itemUID}
+        self.__aliasToUID = {key: itemUID for key, itemUID in self.__aliasToUID.items() if self.__sharedUID(key) != itemUID}
+        self.__uidToDuration = {itemUID: duration for itemUID, duration in self.__uidToDuration.items() if self.snapshot.get(f"D{itemUID}") != (duration or "").encode()}
+        self.__trigrams = TrigramIndex()
+        for key in self.__keyToUID:
+            self.__trigrams.add(key)
+
+    def __sharedUID(self, key: str) -> str | None:
+        if not self.__readsSnapshot:
+            return None
+        itemUID = self.snapshot.get(f"K{key}")
+        return itemUID.decode() if itemUID is not None else None
+
+    def __sharedPostings(self, gram: str) -> list[str]:
+        keys = self.snapshot.get(f"G{gram}")
+        return keys.decode().split("\n") if keys else []
+
+    def __duration(self, itemUID: str) -> str | None:
+        """
+        Duration of a UID, from the rows held locally before the snapshot
+        :return: duration string or None if unknown
+        """
+        if itemUID in self.__uidToDuration or not self.__readsSnapshot:
+            return self.__uidToDuration.get(itemUID)
+        duration = self.snapshot.get(f"D{itemUID}")
+        return duration.decode() or None if duration is not None else None
+
+    def __fetchKeys(self, keys: list[str]) -> None:
+        """
+        Look the canonical names of the keys up in DB with one query and hold the rows found
+        :param keys: canonical keys to look up
+        :return: None
+        """
+        names = [ItemNameNormaliser.display(key) for key in keys]
+        for itemUID, itemName, duration in self.mysqlPool.fetch(Queries.knownItemsByNames, names, expand=len(names)):
+            self.__index(itemUID, itemName, duration)
@@ -0,0 +1,149 @@
+from __future__ import annotations
+from re import sub
+from typing import Callable, Iterable
+
+
+class ItemNameNormaliser:
+    SYNONYMS = {
+        "granny smith apple": "apple",
+        "gala apple": "apple",
+        "fuji apple": "apple",
+        "yoghurt": "yogurt",
+        "greek yoghurt": "greek yogurt",
+        "scallion": "spring onion",
+        "green onion": "spring onion",
+        "aubergine": "eggplant",
+        "courgette": "zucchini",
+        "capsicum": "bell pepper",
+        "garbanzo bean": "chickpea",
+        "minced beef": "ground beef",
+        "beef mince": "ground beef",
+        "prawn": "shrimp",
+        "rocket": "arugula",
+        "coriander": "cilantro",
+        "whole milk": "milk",
+        "semi skimmed milk": "milk",
+        "chicken egg": "egg",
+        "hen egg": "egg",
+    }
+    IRREGULAR = {
+        "leaves": "leaf",
+        "loaves": "loaf",
+        "halves": "half",
+        "knives": "knife",
+        "cookies": "cookie",
+        "brownies": "brownie",
+        "smoothies": "smoothie",
+        "veggies": "veggie",
+        "pies": "pie",
+        "geese": "goose",
+        "mice": "mouse",
+    }
+    INVARIANT = {"hummus", "asparagus", "couscous", "molasses", "citrus", "octopus", "bass", "swiss", "grits", "oats", "lentils", "hops", "series", "species", "chips", "greens", "sprouts"}
+
+    @classmethod
+    def key(cls, itemName: str) -> str:
+        """
+        Canonical lookup key of a name: case folded, punctuation dropped, head noun singularised and synonyms applied
+        :param itemName: name as received from GPT or the client
+        :return: canonical key, empty if nothing usable is left
+        """
+        cleaned = sub(r"[^\w\s]", " ", itemName.casefold()).replace("_", " ")
+        words = cleaned.split()
+        if not words:
+            return ""
+        words[-1] = cls.singular(words[-1])
+        key = " ".join(words)
+        return cls.SYNONYMS.get(key, key)
+
+    @staticmethod
+    def display(key: str) -> str:
+        """
+        Name to store and show for a canonical key
+        :param key: canonical key
+        :return: title cased name
+        """
+        return key.title()
+
+    @classmethod
+    def singular(cls, word: str) -> str:
+        """
+        Rule based singular of an english grocery noun
+        :param word: lower case word
+        :return: singular form
+        """
+        if word in cls.IRREGULAR:
+            return cls.IRREGULAR[word]
+        if word in cls.INVARIANT or len(word) <= 3:
+            return word
+        if word.endswith("ies") and len(word) > 4:
+            return word[:-3] + "y"
+        if word.endswith(("sses", "shes", "ches", "xes", "zes", "oes")):
+            return word[:-2]
+        if word.endswith("s") and not word.endswith(("ss", "us", "is")):
+            return word[:-1]
+        return word
+
+
+class TrigramIndex:
+    def __init__(self):
+        """
+        Inverted index of character trigrams over canonical keys, for near-match lookups
+        """
+        self.__gramToKeys: dict[str, set[str]] = {}
+        self.__keyGrams: dict[str, set[str]] = {}
+
+    @staticmethod
+    def grams(key: str) -> set[str]:
+        padded = f"  {key} "
+        return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+    def add(self, key: str) -> None:
+        if key in self.__keyGrams:
+            return
+        grams = self.grams(key)
+        self.__keyGrams[key] = grams
+        for gram in grams:
+            self.__gramToKeys.setdefault(gram, set()).add(key)
+
+    def postings(self) -> dict[str, set[str]]:
+        """
+        Keys indexed under every trigram, to be copied into a snapshot
+        :return: trigram to keys
+        """
+        return self.__gramToKeys
+
+    def best(self, key: str, threshold: float) -> tuple[str, float] | None:
+        """
+        Indexed key most similar to the given one, by Dice coefficient over trigrams
+        :param key: canonical key to match
+        :param threshold: similarity a match has to exceed
+        :return: (matched key, similarity) or None
+        """
+        return self.bestOf(key, threshold, lambda gram: self.__gramToKeys.get(gram, ()), lambda candidate: len(self.__keyGrams[candidate]))
+
+    @staticmethod
+    def prefixed(key: str, candidate: str) -> bool:
+        return key != candidate and (key.endswith(candidate) or candidate.endswith(key))
+
+    @classmethod
+    def bestOf(cls, key: str, threshold: float, postings: Callable[[str], Iterable[str]], gramCount: Callable[[str], int]) -> tuple[str, float] | None:
+        """
+        Most similar key of any trigram index, such as one held in a snapshot. A key that is the other one with something put in front, as "salted butter" and "unsalted butter", names a different item however similar
+        :param key: canonical key to match
+        :param threshold: similarity a match has to exceed
+        :param postings: keys indexed under a trigram
+        :param gramCount: number of trigrams of an indexed key
+        :return: (matched key, similarity) or None
+        """
+        grams = cls.grams(key)
+        overlaps: dict[str, int] = {}
+        for gram in grams:
+            for candidate in postings(gram):
+                overlaps[candidate] = overlaps.get(candidate, 0) + 1
+        best = None
+        for candidate, overlap in overlaps.items():
+            similarity = 2 * overlap / (len(grams) + gramCount(candidate))
+            if similarity > threshold and (best is None or similarity > best[1]) and not cls.prefixed(key, candidate):
+                best = (candidate, similarity)
+        return best
@@ -0,0 +1,182 @@
+from __future__ import annotations
+from datetime import datetime, timedelta
+from json import dumps, loads
+from pathlib import Path
+from queue import Queue
+from threading import Thread, Lock, Event
+from time import time, sleep
+from typing import Callable
+from customisedLogs import Manager as LogManager
+
+from internal.Database import Database
+from internal.Enum import Queries, Response500Messages
+
+
+class Job:
+    def __init__(self, jobUID: str, userUID: str):
+        self.jobUID = jobUID
+        self.userUID = userUID
+        self.state = "QUEUED"
+        self.statusCode = 0
+        self.statusDesc = ""
+        self.result = None
+        self.finishedAt = 0.0
+        self.done = Event()
+
+
+class JobQueue:
+    def __init__(self, mysqlPool: Database, logger: LogManager, nodeID: int, spoolFolder: str, process: Callable[[bytes, str], tuple[int, str, dict]], workers: int, maxQueued: int, pollInterval: float, retention: int):
+        """
+        Bounded queue of recognition jobs run by a fixed set of workers. Uploads are spooled to disk and job state is kept in recognition_jobs, so jobs of a restarted CORE are picked up again
+        :param mysqlPool: pool to persist job state with
+        :param logger: LogManager object to log to
+        :param nodeID: IDAllocator node of this CORE, jobs are recovered only by the node that accepted them
+        :param spoolFolder: folder to keep uploads of unfinished jobs in
+        :param process: function turning image bytes and userUID into status code, description and result
+        :param workers: jobs processed at once
+        :param maxQueued: jobs allowed to wait for a worker before new ones are refused
+        :param pollInterval: seconds between DB checks while long-polling a job held by another CORE
+        :param retention: seconds finished jobs are kept for
+        """
+        self.mysqlPool = mysqlPool
+        self.logger = logger
+        self.nodeID = nodeID
+        self.spoolFolder = Path(spoolFolder)
+        self.process = process
+        self.workers = workers
+        self.maxQueued = maxQueued
+        self.pollInterval = pollInterval
+        self.retention = retention
+        self.accepted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.__inFlight = 0
+        self.__jobs: dict[str, Job] = {}
+        self.__queue: Queue[Job] = Queue()
+        self.__lock = Lock()
+        self.spoolFolder.mkdir(parents=True, exist_ok=True)
+
+    def start(self) -> None:
+        """
+        Queue again the unfinished jobs of this node and start the workers and the cleaner, called once at startup
+        :return: None
+        """
+        for jobUID, userUID in self.mysqlPool.fetch(Queries.unfinishedJobs, (self.nodeID,)):
+            job = Job(jobUID, userUID)
+            if self.__spoolPath(job.jobUID).is_file():
+                self.__inFlight += 1
+                self.__jobs[job.jobUID] = job
+                self.__queue.put(job)
+            else:
+                self.__finish(job, 500, Response500Messages.imageNotFound.value, {})
+        self.logger.success("JOBS", f"recovered {self.__inFlight} jobs")
+        for _ in range(self.workers):
+            Thread(target=self.__worker, daemon=True).start()
+        Thread(target=self.__cleaner, daemon=True).start()
+
+    def submit(self, jobUID: str, userUID: str, imgBytes: bytes) -> bool:
+        """
+        Persist and queue a job, without waiting for it to run
+        :param jobUID: ID to store the job under
+        :param userUID: User ID which sent the image
+        :param imgBytes: bytes received from the client
+        :return: bool stating if the job was accepted, False if the queue is full
+        """
+        with self.__lock:
+            if self.__inFlight >= self.workers + self.maxQueued:
+                self.rejected += 1
+                return False
+            self.__inFlight += 1
+        try:
+            self.__spoolPath(jobUID).write_bytes(imgBytes)
+            self.mysqlPool.execute(Queries.insertJob, (jobUID, userUID, self.nodeID))
+        except:
+            with self.__lock:
+                self.__inFlight -= 1
+            self.__spoolPath(jobUID).unlink(missing_ok=True)
+            raise
+        job = Job(jobUID, userUID)
+        self.__jobs[jobUID] = job
+        self.__queue.put(job)
+        self.accepted += 1
+        return True
+
+    def result(self, jobUID: str, userUID: str, wait: float) -> tuple[str, int, str, dict | None] | None:
+        """
+        State of a job, waiting up to some seconds for it to finish
+        :param jobUID: ID of the job
+        :param userUID: User ID asking, only the owner sees a job
+        :param wait: seconds to wait for the job to finish, 0 to return at once
+        :return: state, status code, description and result, or None if the user has no such job
+        """
+        job = self.__jobs.get(jobUID)
+        if job is not None:
+            if job.userUID != userUID:
+                return None
+            if wait > 0:
+                job.done.wait(wait)
+            return job.state, job.statusCode, job.statusDesc, job.result
+        deadline = time() + wait
+        while True:
+            row = self.mysqlPool.fetchOne(Queries.jobByUser, (jobUID, userUID))
+            if row is None:
+                return None
+            state, statusCode, statusDesc, result = row
+            if state == "DONE" or time() + self.pollInterval > deadline:
+                break
+            sleep(self.pollInterval)
+        return state, statusCode or 0, statusDesc or "", loads(result) if result else None
+
+    def stats(self) -> dict[str, int]:
+        return {"IN_FLIGHT": self.__inFlight, "ACCEPTED": self.accepted, "REJECTED": self.rejected, "COMPLETED": self.completed}
+
+    def __spoolPath(self, jobUID: str) -> Path:
+        return Path(self.spoolFolder, jobUID)
+
+    def __worker(self) -> None:
+        """
+        Infinite loop running queued jobs one at a time
+        :return: None
+        """
+        while True:
+            job = self.__queue.get()
+            statusCode, statusDesc, result = 500, Response500Messages.jobFailed.value, {}
+            try:
+                job.state = "RUNNING"
+                self.mysqlPool.execute(Queries.markJobRunning, (job.jobUID,))
+                statusCode, statusDesc, result = self.process(self.__spoolPath(job.jobUID).read_bytes(), job.userUID)
+            except Exception as e:
+                self.logger.fatal("JOBS", f"{job.jobUID} {repr(e)}")
+            try:
+                self.__finish(job, statusCode, statusDesc, result)
+            except Exception as e:
+                self.logger.fatal("JOBS", f"{job.jobUID} not stored {repr(e)}")
+            with self.__lock:
+                self.__inFlight -= 1
+
+    def __finish(self, job: Job, statusCode: int, statusDesc: str, result: dict) -> None:
+        """
+        Wake anyone long-polling a job, then store its outcome and drop its upload. If storing fails the upload stays and the job runs again after a restart
+        :return: None
+        """
+        job.state, job.statusCode, job.statusDesc, job.result = "DONE", statusCode, statusDesc, result
+        job.finishedAt = time()
+        job.done.set()
+        self.completed += 1
+        self.mysqlPool.execute(Queries.markJobDone, (int(statusCode), statusDesc, dumps(result, ensure_ascii=False), job.jobUID))
+        self.__spoolPath(job.jobUID).unlink(missing_ok=True)
+
+    def __cleaner(self) -> None:
+        """
+        Infinite loop forgetting finished jobs older than the retention
+        :return: None
+        """
+        while True:
+            sleep(min(self.retention, 600))
+            expired = time() - self.retention
+            for jobUID in [jobUID for jobUID, job in self.__jobs.items() if job.done.is_set() and job.finishedAt < expired]:
+                self.__jobs.pop(jobUID, None)
+            try:
+                self.mysqlPool.execute(Queries.deleteFinishedJobs, (datetime.now() - timedelta(seconds=self.retention),))
+            except Exception as e:
+                self.logger.failed("JOBS", f"cleanup failed {repr(e)}")
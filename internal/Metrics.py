@@ -0,0 +1,208 @@
+from __future__ import annotations
+from bisect import bisect_left
+from functools import wraps
+from time import perf_counter
+from typing import Callable
+from urllib.request import urlopen
+from gevent.monkey import get_original
+
+
+NativeLock = get_original("threading", "Lock")
+
+
+class Timer:
+    def __init__(self, metrics: Metrics, name: str, labels: dict[str, str]):
+        """
+        Times a block or every call of a function into a histogram, counting raised exceptions separately
+        :param metrics: Metrics object to record into
+        :param name: histogram name, without the prefix
+        :param labels: labels of the series
+        """
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.__started: list[float] = []
+
+    def __enter__(self) -> Timer:
+        self.__started.append(perf_counter())
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback) -> None:
+        self.metrics.observe(self.name, perf_counter() - self.__started.pop(), **self.labels)
+        if exceptionType is not None:
+            self.metrics.increment(f"{self.name}_errors", **self.labels)
+
+    def __call__(self, function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with Timer(self.metrics, self.name, self.labels):
+                return function(*args, **kwargs)
+        return wrapper
+
+
+class Metrics:
+    def __init__(self, prefix: str, buckets: list[float]):
+        """
+        Counters, gauges and histograms rendered in Prometheus text format. Safe to record into from greenlets and native pool threads alike
+        :param prefix: prepended to every metric name
+        :param buckets: upper bounds in seconds of every histogram
+        """
+        self.prefix = prefix
+        self.buckets = sorted(buckets)
+        self.__counters: dict[str, dict[tuple, float]] = {}
+        self.__gauges: dict[str, dict[tuple, float]] = {}
+        self.__histograms: dict[str, dict[tuple, list]] = {}
+        self.__collectors: dict[str, Callable[[], dict | list[dict]]] = {}
+        self.__lock = NativeLock()
+
+    def timed(self, name: str, **labels: str) -> Timer:
+        """
+        Context manager and decorator observing the seconds taken
+        :param name: histogram name, recorded as <prefix>_<name>_seconds
+        :param labels: labels of the series
+        :return: Timer
+        """
+        return Timer(self, name, labels)
+
+    def increment(self, name: str, value: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            series = self.__counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def add(self, name: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            series = self.__gauges.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        index = bisect_left(self.buckets, seconds)
+        with self.__lock:
+            histogram = self.__histograms.setdefault(name, {}).get(key)
+            if histogram is None:
+                histogram = self.__histograms[name][key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def addCollector(self, component: str, collector: Callable[[], dict | list[dict]]) -> None:
+        """
+        Read the stats() of a component on every render, numbers become gauges and strings of a list of dictionaries become labels
+        :param component: name the gauges are grouped under
+        :param collector: function returning the stats
+        :return: None
+        """
+        self.__collectors[component] = collector
+
+    def render(self) -> str:
+        """
+        Every metric in Prometheus text exposition format
+        :return: text body
+        """
+        lines = []
+        with self.__lock:
+            counters = {name: dict(series) for name, series in self.__counters.items()}
+            gauges = {name: dict(series) for name, series in self.__gauges.items()}
+            histograms = {name: {key: [list(value[0]), value[1], value[2]] for key, value in series.items()} for name, series in self.__histograms.items()}
+        for name, series in sorted(counters.items()):
+            lines.append(f"# TYPE {self.prefix}_{name}_total counter")
+            lines += [f"{self.prefix}_{name}_total{self.__labels(key)} {value}" for key, value in series.items()]
+        for name, series in sorted(gauges.items()):
+            lines.append(f"# TYPE {self.prefix}_{name} gauge")
+            lines += [f"{self.prefix}_{name}{self.__labels(key)} {value}" for key, value in series.items()]
+        for name, series in sorted(histograms.items()):
+            lines.append(f"# TYPE {self.prefix}_{name}_seconds histogram")
+            for key, (counts, total, count) in series.items():
+                cumulative = 0
+                for bound, bucketCount in zip(self.buckets + ["+Inf"], counts):
+                    cumulative += bucketCount
+                    lines.append(f"{self.prefix}_{name}_seconds_bucket{self.__labels(key + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{self.prefix}_{name}_seconds_sum{self.__labels(key)} {total}")
+                lines.append(f"{self.prefix}_{name}_seconds_count{self.__labels(key)} {count}")
+        for component, collector in sorted(self.__collectors.items()):
+            try:
+                stats = collector()
+            except Exception:
+                continue
+            for entry in stats if type(stats) == list else [stats]:
+                key = tuple(sorted((label.lower(), str(value)) for label, value in entry.items() if type(value) == str))
+                for stat, value in entry.items():
+                    if type(value) in (int, float, bool):
+                        lines.append(f"{self.prefix}_{component}_{stat.lower()}{self.__labels(key)} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+    def wsgiApp(self, environ, startResponse) -> list[bytes]:
+        """
+        Bare WSGI app answering every request with render(), for a private listener other processes scrape
+        :return: body
+        """
+        startResponse("200 OK", [("Content-Type", "text/plain; version=0.0.4")])
+        return [self.render().encode()]
+
+    def renderWorkers(self, workerIndex: int, ports: list[int]) -> str:
+        """
+        Metrics of every worker of a pool, this one rendered here and the rest read from their private listeners, tagged with the worker index. Workers not answering, as while restarting, are left out
+        :param workerIndex: index of this worker
+        :param ports: private listener port of each worker, by index
+        :return: text body
+        """
+        renders = {}
+        for index, port in enumerate(ports):
+            if index == workerIndex:
+                renders[str(index)] = self.render()
+                continue
+            try:
+                with urlopen(f"http://127.0.0.1:{port}/", timeout=2) as response:
+                    renders[str(index)] = response.read().decode()
+            except Exception:
+                self.increment("worker_scrape_errors", worker=str(index))
+        return self.merge(renders, "worker")
+
+    @staticmethod
+    def merge(renders: dict[str, str], label: str) -> str:
+        """
+        One exposition of the renders of several processes, every sample tagged with the process it came from and the samples of each metric kept together
+        :param renders: render() text of each process, keyed on the label value
+        :param label: label name telling the processes apart
+        :return: text body
+        """
+        types: dict[str, str] = {}
+        families: dict[str, list[str]] = {}
+        for value, text in renders.items():
+            tag = f"{label}=\"{value}\""
+            for line in text.splitlines():
+                if line.startswith("# TYPE "):
+                    _, _, name, metricType = line.split(" ", 3)
+                    types[name] = metricType
+                    continue
+                if not line or line.startswith("#"):
+                    continue
+                name, separator, rest = line.partition("{")
+                if separator:
+                    sample = f"{name}{{{tag},{rest}" if not rest.startswith("}") else f"{name}{{{tag}{rest}"
+                else:
+                    name, _, number = line.partition(" ")
+                    sample = f"{name}{{{tag}}} {number}"
+                family = name
+                for suffix in ("_bucket", "_sum", "_count"):
+                    if name.endswith(suffix) and name[:-len(suffix)] in types:
+                        family = name[:-len(suffix)]
+                families.setdefault(family, []).append(sample)
+        lines = []
+        for family, samples in families.items():
+            if family in types:
+                lines.append(f"# TYPE {family} {types[family]}")
+            lines += samples
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def __labels(key: tuple) -> str:
+        if not key:
+            return ""
+        parts = []
+        for label, value in key:
+            value = str(value).replace("\\", "\\\\").replace("\"", "\\\"")
+            parts.append(f"{label}=\"{value}\"")
+        return "{" + ",".join(parts) + "}"
@@ -0,0 +1,49 @@
+from __future__ import annotations
+from abc import ABC, abstractmethod
+from json import dumps
+from pathlib import Path
+from queue import Queue
+from threading import Lock
+
+
+class NotificationSink(ABC):
+    """
+    Where expiry notifications are delivered, one batch per call. Subclass and implement send() to add a channel
+    """
+    @abstractmethod
+    def send(self, notifications: list[dict]) -> bool:
+        """
+        Deliver a batch of notifications
+        :param notifications: list of dictionaries with USER_UID, PURCHASE_UID, ITEM_UID, NAME and EXPIRES
+        :return: bool stating if the whole batch was delivered, False to have it retried later
+        """
+        ...
+
+
+class FileSink(NotificationSink):
+    def __init__(self, path: str):
+        """
+        Appends every notification as one JSON line to a file, for local runs and for other processes to tail
+        :param path: file to append to
+        """
+        self.path = Path(path)
+        self.__lock = Lock()
+
+    def send(self, notifications: list[dict]) -> bool:
+        lines = "".join(dumps(notification, ensure_ascii=False) + "\n" for notification in notifications)
+        with self.__lock:
+            with self.path.open("a", encoding="utf-8") as file:
+                file.write(lines)
+        return True
+
+
+class QueueSink(NotificationSink):
+    def __init__(self):
+        """
+        Holds delivered batches in memory, for tests to read back with batches.get()
+        """
+        self.batches: Queue[list[dict]] = Queue()
+
+    def send(self, notifications: list[dict]) -> bool:
+        self.batches.put(list(notifications))
+        return True
@@ -0,0 +1,60 @@
+from __future__ import annotations
+from threading import Lock
+from gevent.threadpool import ThreadPool
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PoolOverloaded(Exception):
+    pass
+
+
+class PasswordPool:
+    def __init__(self, workers: int, maxQueued: int):
+        """
+        Bounded pool of native threads running scrypt hashing away from the gevent hub.
+        hashlib.scrypt releases the GIL, so hashing runs in parallel on separate cores while greenlets keep being served
+        :param workers: native threads hashing at once
+        :param maxQueued: hashing jobs allowed to wait for a free thread before callers are turned away
+        """
+        self.workers = workers
+        self.maxQueued = maxQueued
+        self.rejected = 0
+        self.__inFlight = 0
+        self.__pool = ThreadPool(workers)
+        self.__lock = Lock()
+
+    def hash(self, password: str) -> str:
+        """
+        scrypt hash of a password, raises PoolOverloaded if the queue is full
+        :param password: plain password
+        :return: werkzeug formatted hash
+        """
+        return self.__run(generate_password_hash, password, "scrypt", 50)
+
+    def verify(self, passHash: str, password: str) -> bool:
+        """
+        Check a password against its hash, raises PoolOverloaded if the queue is full
+        :param passHash: werkzeug formatted hash
+        :param password: plain password
+        :return: bool stating if the password matched
+        """
+        return self.__run(check_password_hash, passHash, password)
+
+    def stats(self) -> dict[str, int]:
+        return {"IN_FLIGHT": self.__inFlight, "REJECTED": self.rejected}
+
+    def __run(self, function, *args):
+        """
+        Run a function on the pool, blocking only the calling greenlet
+        :return: result of the function
+        """
+        with self.__lock:
+            if self.__inFlight >= self.workers + self.maxQueued:
+                self.rejected += 1
+                raise PoolOverloaded
+            self.__inFlight += 1
+        try:
+            return self.__pool.apply(function, args)
+        finally:
+            with self.__lock:
+                self.__inFlight -= 1
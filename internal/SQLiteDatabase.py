@@ -0,0 +1,130 @@
+from __future__ import annotations
+import sqlite3
+from datetime import datetime
+from enum import Enum
+from pathlib import Path
+from gevent.monkey import get_original
+from gevent.threadpool import ThreadPool
+from customisedLogs import Manager as LogManager
+
+from internal.Database import Database
+from internal.Metrics import Metrics
+
+
+NativeLocal = get_original("threading", "local")
+# DATETIME and TIMESTAMP columns are text in SQLite, written and read back in the layout MySQL returns so both compare the same
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" ", "milliseconds"))
+sqlite3.register_converter("DATETIME", lambda value: datetime.fromisoformat(value.decode()))
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.fromisoformat(value.decode()))
+
+
+class SQLiteDatabase(Database):
+    def __init__(self, path: str, dialect: type[Enum], logger: LogManager, metrics: Metrics, workers: int, busyTimeout: float):
+        """
+        Embedded backend on one SQLite file in WAL mode, shared by the gateway and CORE processes of a single box.
+        Statements run on a fixed set of native threads, each with its own connection, so waiting on the write lock never blocks the gevent hub
+        :param path: database file, created by bootstrap()
+        :param dialect: enum of SQLite versions of statements whose MySQL text does not run on SQLite, by member name
+        :param logger: LogManager object to log to
+        :param metrics: Metrics object to time statements into
+        :param workers: native threads, and so connections, running statements at once
+        :param busyTimeout: seconds a write waits for the lock held by another process before failing
+        """
+        super().__init__(logger, metrics)
+        self.path = path
+        self.dialect = dialect
+        self.workers = workers
+        self.busyTimeout = busyTimeout
+        self.opened = 0
+        self.failures = 0
+        self.__local = NativeLocal()
+        self.__pool = ThreadPool(workers)
+
+    @staticmethod
+    def bootstrap(path: str, schemaFile: str) -> list[str]:
+        """
+        Create the database file if missing, switch it to WAL and create any missing table, index or trigger of the schema
+        :param path: database file
+        :param schemaFile: SQL script of the whole schema, every statement guarded by IF NOT EXISTS
+        :return: names of the tables present afterwards
+        """
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(path)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(Path(schemaFile).read_text())
+            return [row[0] for row in connection.execute("SELECT name from sqlite_master where type='table' order by name")]
+        finally:
+            connection.close()
+
+    def statementSQL(self, statement: Enum) -> str:
+        if statement.name in self.dialect.__members__:
+            return self.dialect[statement.name].value
+        return statement.value
+
+    def fetchSQL(self, sql: str, params: list) -> list[tuple]:
+        return self.__apply(lambda connection: [tuple(self.decode(value) for value in row) for row in connection.execute(sql.replace("%s", "?"), params).fetchall()])
+
+    def executeSQL(self, sql: str, params: list) -> int:
+        return self.__apply(lambda connection: connection.execute(sql.replace("%s", "?"), params).rowcount)
+
+    def executeManySQL(self, sql: str, paramsList: list[tuple | list]) -> int:
+        """
+        Every row inside one transaction, so the batch costs a single commit
+        :return: rows affected
+        """
+        return self.transactionSQL([(sql, paramsList)])[0]
+
+    def transactionSQL(self, steps: list[tuple[str, list[tuple | list]]]) -> list[int]:
+        """
+        Every step between BEGIN IMMEDIATE and COMMIT on one connection, so the write lock is taken once and a failed step rolls back the rest
+        :return: rows affected per step
+        """
+        return self.__apply(lambda connection: self.__transaction(connection, [(sql.replace("%s", "?"), paramsList) for sql, paramsList in steps]))
+
+    def stats(self) -> dict[str, int]:
+        return {"OPEN": self.opened, "WORKERS": self.workers, "FAILURES": self.failures}
+
+    def __apply(self, operation):
+        """
+        Run an operation on a pool thread, raising its error here rather than inside the pool
+        :return: whatever the operation returns
+        """
+        succeeded, result = self.__pool.apply(self.__run, (operation,))
+        if not succeeded:
+            raise result
+        return result
+
+    def __run(self, operation) -> tuple[bool, object]:
+        """
+        Run an operation on the connection of the calling pool thread, opening it on first use
+        :return: bool stating if it succeeded and its result or error
+        """
+        try:
+            connection = getattr(self.__local, "connection", None)
+            if connection is None:
+                connection = self.__local.connection = self.__connect()
+            try:
+                return True, operation(connection)
+            except Exception:
+                if connection.in_transaction:
+                    connection.rollback()
+                raise
+        except Exception as e:
+            self.failures += 1
+            return False, e
+
+    def __connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=self.busyTimeout, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES, cached_statements=256)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA foreign_keys=ON")
+        self.opened += 1
+        return connection
+
+    @staticmethod
+    def __transaction(connection: sqlite3.Connection, steps: list[tuple[str, list[tuple | list]]]) -> list[int]:
+        connection.execute("BEGIN IMMEDIATE")
+        rowCounts = [connection.executemany(sql, paramsList).rowcount if paramsList else 0 for sql, paramsList in steps]
+        connection.execute("COMMIT")
+        return rowCounts
@@ -0,0 +1,115 @@
+from __future__ import annotations
+from hashlib import blake2b
+from mmap import mmap, ACCESS_READ
+from os import replace, stat
+from pathlib import Path
+from struct import Struct
+
+
+HEADER = Struct("<8sQQ")
+SLOT = Struct("<QQ")
+RECORD = Struct("<II")
+MAGIC = b"BBBSNAP1"
+
+
+class SharedSnapshot:
+    def __init__(self, path: str):
+        """
+        Read-only key-value table in a memory-mapped file, written whole by one process and read in place by the others.
+        Every process maps the same pages of the page cache, so the data is held once however many workers read it.
+        Layout: header | open addressing slots of (key hash, record offset) | records of (key length, value length, key, value)
+        :param path: snapshot file, swapped atomically by write()
+        """
+        self.path = Path(path)
+        self.swaps = 0
+        self.__mapped: tuple[mmap, int, int] | None = None
+        self.__stamp = None
+
+    @staticmethod
+    def keyHash(key: bytes) -> int:
+        return int.from_bytes(blake2b(key, digest_size=8).digest(), "little")
+
+    @classmethod
+    def write(cls, path: str, entries: dict[str, bytes]) -> int:
+        """
+        Write a snapshot of the entries next to the path and move it in place, so readers see the old or the new file and never a partial one
+        :param path: snapshot file
+        :param entries: key to value
+        :return: bytes written
+        """
+        slotCount = 8
+        while slotCount < len(entries) * 2:
+            slotCount *= 2
+        slots = [(0, 0)] * slotCount
+        records = bytearray()
+        offset = HEADER.size + SLOT.size * slotCount
+        for key, value in entries.items():
+            key = key.encode()
+            keyHash = cls.keyHash(key)
+            index = keyHash & (slotCount - 1)
+            while slots[index][1]:
+                index = (index + 1) & (slotCount - 1)
+            slots[index] = (keyHash, offset + len(records))
+            records += RECORD.pack(len(key), len(value)) + key + value
+        temporaryPath = Path(path).with_suffix(".tmp")
+        temporaryPath.parent.mkdir(parents=True, exist_ok=True)
+        with temporaryPath.open("wb") as snapshotFile:
+            snapshotFile.write(HEADER.pack(MAGIC, slotCount, len(entries)))
+            snapshotFile.write(b"".join(SLOT.pack(*slot) for slot in slots))
+            snapshotFile.write(records)
+        replace(temporaryPath, path)
+        return offset + len(records)
+
+    def refresh(self) -> bool:
+        """
+        Map the snapshot file again if it was replaced since the last call. The old mapping is released once no lookup holds it
+        :return: bool stating if a new snapshot was mapped
+        """
+        try:
+            fileStat = stat(self.path)
+        except FileNotFoundError:
+            return False
+        stamp = (fileStat.st_ino, fileStat.st_mtime_ns, fileStat.st_size)
+        if stamp == self.__stamp:
+            return False
+        with self.path.open("rb") as snapshotFile:
+            mapped = mmap(snapshotFile.fileno(), 0, access=ACCESS_READ)
+        magic, slotCount, entryCount = HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC:
+            mapped.close()
+            raise ValueError(f"{self.path} is not a snapshot")
+        self.__mapped = (mapped, slotCount, entryCount)
+        self.__stamp = stamp
+        self.swaps += 1
+        return True
+
+    def ready(self) -> bool:
+        return self.__mapped is not None
+
+    def get(self, key: str) -> bytes | None:
+        """
+        Value of a key in the mapped snapshot
+        :param key: key to look up
+        :return: value or None if absent or nothing is mapped yet
+        """
+        mapped = self.__mapped
+        if mapped is None:
+            return None
+        mapped, slotCount, _ = mapped
+        key = key.encode()
+        keyHash = self.keyHash(key)
+        index = keyHash & (slotCount - 1)
+        while True:
+            slotHash, offset = SLOT.unpack_from(mapped, HEADER.size + SLOT.size * index)
+            if not offset:
+                return None
+            if slotHash == keyHash:
+                keyLength, valueLength = RECORD.unpack_from(mapped, offset)
+                start = offset + RECORD.size
+                if mapped[start:start + keyLength] == key:
+                    return mapped[start + keyLength:start + keyLength + valueLength]
+            index = (index + 1) & (slotCount - 1)
+
+    def stats(self) -> dict[str, int]:
+        mapped = self.__mapped
+        return {"ENTRIES": mapped[2] if mapped else 0, "BYTES": len(mapped[0]) if mapped else 0, "SWAPS": self.swaps}
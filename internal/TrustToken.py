@@ -0,0 +1,73 @@
+from __future__ import annotations
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from collections import deque
+from hashlib import sha256
+from hmac import new as newHMAC, compare_digest
+from json import dumps, loads
+from secrets import token_urlsafe
+from threading import Lock
+from time import time
+
+
+class TrustToken:
+    def __init__(self, secret: str | bytes, ttl: float):
+        """
+        Short-lived HMAC signed envelope for the gateway to vouch for a user towards CORE without CORE touching the DB.
+        Replay protection is per process: each CORE process (worker) remembers the nonces it accepted, so an envelope replayed to another process within its ttl is accepted there once
+        :param secret: shared secret known to both gateway and CORE
+        :param ttl: seconds a signed envelope stays valid
+        """
+        self.__secret = secret.encode() if type(secret) == str else secret
+        self.ttl = ttl
+        self.__seenNonces: set[str] = set()
+        self.__nonceExpiries: deque[tuple[float, str]] = deque()
+        self.__lock = Lock()
+
+    def sign(self, userUID: str, deviceUID: str, username: str) -> str:
+        """
+        Create a signed envelope for the user and device
+        :param userUID: UserUID of the requestor
+        :param deviceUID: DeviceUID of the requestor
+        :param username: username of the requestor
+        :return: envelope as "<payload>.<signature>"
+        """
+        payload = dumps({"U": userUID, "D": deviceUID, "N": username, "E": time() + self.ttl, "R": token_urlsafe(12)}, separators=(",", ":")).encode()
+        encodedPayload = urlsafe_b64encode(payload).decode()
+        return f"{encodedPayload}.{self.__signature(encodedPayload)}"
+
+    def verify(self, envelope: str | None) -> tuple[bool, str, str, str]:
+        """
+        Check signature, expiry and single use of an envelope, single use within this process
+        :param envelope: envelope received from the gateway
+        :return: bool stating if envelope is trusted, userUID, deviceUID, username
+        """
+        if not envelope or envelope.count(".") != 1:
+            return False, "", "", ""
+        encodedPayload, signature = envelope.split(".")
+        if not compare_digest(signature, self.__signature(encodedPayload)):
+            return False, "", "", ""
+        try:
+            payload = loads(urlsafe_b64decode(encodedPayload))
+            userUID, deviceUID, username, expiresAt, nonce = payload["U"], payload["D"], payload["N"], float(payload["E"]), payload["R"]
+        except:
+            return False, "", "", ""
+        now = time()
+        if expiresAt < now:
+            return False, "", "", ""
+        with self.__lock:
+            # nonces arrive close to expiry order, so the expired ones are popped off the front, an early expiry queued behind a later one just waits for it
+            while self.__nonceExpiries and self.__nonceExpiries[0][0] < now:
+                self.__seenNonces.discard(self.__nonceExpiries.popleft()[1])
+            if nonce in self.__seenNonces:
+                return False, "", "", ""
+            self.__seenNonces.add(nonce)
+            self.__nonceExpiries.append((expiresAt, nonce))
+        return True, userUID, deviceUID, username
+
+    def __signature(self, encodedPayload: str) -> str:
+        """
+        HMAC-SHA256 of the encoded payload
+        :param encodedPayload: base64 payload
+        :return: base64 signature
+        """
+        return urlsafe_b64encode(newHMAC(self.__secret, encodedPayload.encode(), sha256).digest()).decode()
@@ -0,0 +1,131 @@
+from __future__ import annotations
+import socket
+from os import getppid, getpid, kill
+from signal import SIGTERM, SIGINT
+from subprocess import Popen
+from sys import executable
+from time import time, sleep
+from gevent import spawn, signal_handler
+from customisedLogs import Manager as LogManager
+
+
+class WorkerSupervisor:
+    def __init__(self, script: str, args: list[str], workers: int, logger: LogManager, restartDelay: float, restartCap: float, stableAfter: float):
+        """
+        Pre-fork supervisor keeping a fixed number of worker processes of a server script alive. Workers bind the same port with SO_REUSEPORT, so the kernel spreads connections over them.
+        A worker exiting cleanly (recycled) is replaced at once, a crashed one after a delay that doubles while it keeps crashing
+        :param script: server script started as "<script> <args> --worker <index>"
+        :param args: arguments passed on to every worker
+        :param workers: worker processes kept running
+        :param logger: LogManager object to log to
+        :param restartDelay: seconds before restarting a crashed worker
+        :param restartCap: longest delay between restarts of a worker crashing repeatedly
+        :param stableAfter: seconds a worker has to stay up for its crash delay to reset
+        """
+        self.script = script
+        self.args = args
+        self.workers = workers
+        self.logger = logger
+        self.restartDelay = restartDelay
+        self.restartCap = restartCap
+        self.stableAfter = stableAfter
+        self.recycled = 0
+        self.crashed = 0
+        self.__processes: dict[int, Popen] = {}
+        self.__stopping = False
+
+    @staticmethod
+    def supported() -> bool:
+        return hasattr(socket, "SO_REUSEPORT")
+
+    @staticmethod
+    def workerIndex(argv: list[str]) -> int | None:
+        """
+        Index of this process if started by a supervisor
+        :param argv: command line of the process
+        :return: worker index or None when not a worker
+        """
+        if "--worker" in argv[:-1]:
+            return int(argv[argv.index("--worker") + 1])
+        return None
+
+    @staticmethod
+    def listener(host: str, port: int, backlog: int = 2048) -> socket.socket:
+        """
+        Listening socket sharing its port with the other workers
+        :param host: address to bind
+        :param port: port every worker binds
+        :param backlog: pending connections queued on this worker
+        :return: bound and listening socket
+        """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.bind((host, port))
+        listener.listen(backlog)
+        return listener
+
+    @staticmethod
+    def watchParent(onOrphaned) -> None:
+        """
+        Call onOrphaned once the supervisor of this worker is gone, as when a runner kills it outright, so no worker keeps serving stale code on the shared port
+        :param onOrphaned: function stopping this worker
+        :return: None
+        """
+        parentPID = getppid()
+
+        def __watch():
+            while getppid() == parentPID:
+                sleep(1)
+            onOrphaned()
+        spawn(__watch)
+
+    def run(self) -> None:
+        """
+        Start every worker and replace them as they exit, until SIGTERM or SIGINT stops them all
+        :return: None
+        """
+        signal_handler(SIGTERM, self.stop)
+        signal_handler(SIGINT, self.stop)
+        self.logger.success("SUPERVISOR", f"{self.script} x{self.workers} (pid {getpid()})")
+        watchers = [spawn(self.__keep, index) for index in range(self.workers)]
+        for watcher in watchers:
+            watcher.join()
+
+    def stop(self) -> None:
+        """
+        Ask every worker to finish its open requests and exit
+        :return: None
+        """
+        self.__stopping = True
+        for process in list(self.__processes.values()):
+            if process.poll() is None:
+                kill(process.pid, SIGTERM)
+
+    def stats(self) -> dict[str, int]:
+        return {"WORKERS": sum(process.poll() is None for process in self.__processes.values()), "RECYCLED": self.recycled, "CRASHED": self.crashed}
+
+    def __keep(self, index: int) -> None:
+        """
+        Keep one worker slot filled. The next process of a slot starts only after the previous one exited, so the slot's node ID is never held twice
+        :param index: worker slot
+        :return: None
+        """
+        delay = self.restartDelay
+        while not self.__stopping:
+            started = time()
+            process = self.__processes[index] = Popen([executable, self.script, *self.args, "--worker", str(index)])
+            returnCode = process.wait()
+            if self.__stopping:
+                break
+            if returnCode == 0:
+                self.recycled += 1
+                self.logger.info("SUPERVISOR", f"worker {index} recycled")
+                delay = self.restartDelay
+                continue
+            self.crashed += 1
+            if time() - started > self.stableAfter:
+                delay = self.restartDelay
+            self.logger.failed("SUPERVISOR", f"worker {index} exited with {returnCode}, restarting in {delay}s")
+            sleep(delay)
+            delay = min(delay * 2, self.restartCap)
@@ -0,0 +1,7 @@
+-- Bulk item resolution inserts missing names with INSERT IGNORE and relies on
+-- the name being unique to settle concurrent inserts of the same item.
+
+DELETE duplicate FROM known_items duplicate
+    JOIN known_items kept ON duplicate.name = kept.name AND duplicate.item_uid > kept.item_uid;
+
+ALTER TABLE known_items ADD UNIQUE INDEX known_items_name (name);
@@ -0,0 +1,6 @@
+-- The in-memory item catalog of every core pulls rows changed since its last
+-- pull, using updated_at as the watermark.
+
+ALTER TABLE known_items
+    ADD COLUMN updated_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+    ADD INDEX known_items_updated_at (updated_at);
@@ -0,0 +1,4 @@
+-- Registration no longer checks for an existing username before inserting;
+-- the unique index rejects the duplicate insert instead.
+
+ALTER TABLE user_info ADD UNIQUE INDEX user_info_username (username);
@@ -0,0 +1,6 @@
+-- Purchase images are saved under the sha256 of the uploaded bytes, so the
+-- same photo uploaded twice is stored once. A purchase points at its image
+-- (savedImages/<image_hash>.jpg, thumbnails/<image_hash>.jpg) through this
+-- column; NULL when no image was saved.
+
+ALTER TABLE purchases ADD COLUMN image_hash CHAR(64) NULL DEFAULT NULL;
@@ -0,0 +1,18 @@
+-- Queued recognition jobs (/bbb_imgrecv with the ASYNC-JOB header). The upload
+-- is spooled on the CORE that accepted the job (node_id); on restart that CORE
+-- queues its unfinished jobs again. Finished jobs hold the response returned
+-- by /bbb_jobresult and are deleted after the retention period.
+
+CREATE TABLE recognition_jobs (
+    job_uid CHAR(20) NOT NULL PRIMARY KEY,
+    user_uid VARCHAR(64) NOT NULL,
+    node_id SMALLINT UNSIGNED NOT NULL,
+    state ENUM('QUEUED', 'RUNNING', 'DONE') NOT NULL,
+    status_code SMALLINT NULL,
+    status_desc VARCHAR(128) NULL,
+    result JSON NULL,
+    created_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+    updated_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+    INDEX recognition_jobs_node_state (node_id, state),
+    INDEX recognition_jobs_state_updated (state, updated_at)
+);
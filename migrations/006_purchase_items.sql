@@ -0,0 +1,79 @@
+-- Purchase line items get their own table instead of the JSON lists in
+-- purchases.items/purchases.expiry. One row per item of a purchase, with its
+-- expiry date when known and the state of its expiry notification.
+--   (user_uid, expires, ...) serves /bbb_expiring, a user's items expiring
+--                            between two dates, paged by keyset
+--   (item_uid)               finds every purchase of an item
+--   (notified, notify_at, ...) is the expiry schedulers' keyset over notify_at,
+--                            each reading the range of shards it owns
+-- shard is CRC32(user_uid) % 1024 (Constants.expiryShards), fixed per row, so
+-- the rows a scheduler notifies follow from the count of running schedulers
+-- alone and never from which process wrote them.
+--
+-- Recognised names of older purchases are matched to known_items by name;
+-- names never stored in known_items have no UID and are not carried over.
+-- Purchases with a 20 character IDAllocator UID get created_at from the
+-- millisecond timestamp leading the UID, and their items an expiry date of
+-- created_at plus the item's duration ("30 D", "2 W", "3 M", "2 Y") and a
+-- notify_at one day before it at 09:00 (Constants.notifyLeadDays/notifyHour).
+-- Notifications already due are marked sent so they do not all fire at once.
+-- Older purchases have no recorded purchase date and keep no expiry.
+--
+-- The shard count 1024, the 1 day lead and the 09:00 notify hour in the
+-- backfill below are copies of Constants.expiryShards, notifyLeadDays and
+-- notifyHour, which this SQL cannot read. Check them against internal/Enum.py
+-- before running and edit them to match. The app never recomputes shard or
+-- notify_at of stored rows, so a mismatched shard is never loaded by its
+-- owner and a mismatched notify_at fires at the old time.
+
+CREATE TABLE purchase_items (
+    purchase_uid VARCHAR(64) NOT NULL,
+    item_uid VARCHAR(64) NOT NULL,
+    user_uid VARCHAR(64) NOT NULL,
+    shard SMALLINT UNSIGNED NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    expires DATE NULL,
+    notify_at DATETIME(3) NULL,
+    notified TINYINT(1) NOT NULL DEFAULT 0,
+    PRIMARY KEY (purchase_uid, item_uid),
+    INDEX purchase_items_user_expires (user_uid, expires, purchase_uid, item_uid),
+    INDEX purchase_items_item (item_uid),
+    INDEX purchase_items_due (notified, notify_at, purchase_uid, item_uid, shard)
+);
+
+ALTER TABLE purchases
+    ADD COLUMN created_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6);
+
+-- the first 10 Crockford base32 characters hold the timestamp and 2 node bits,
+-- mapped onto the digits CONV reads (0-9, A-V) by shifting the letters past I, L, O and U
+UPDATE purchases
+    SET created_at = FROM_UNIXTIME((CONV(
+        REPLACE(REPLACE(REPLACE(REPLACE(REPLACE(REPLACE(REPLACE(REPLACE(REPLACE(REPLACE(REPLACE(REPLACE(REPLACE(REPLACE(UPPER(LEFT(purchase_uid, 10)),
+            'J', 'I'), 'K', 'J'), 'M', 'K'), 'N', 'L'), 'P', 'M'), 'Q', 'N'), 'R', 'O'), 'S', 'P'), 'T', 'Q'), 'V', 'R'), 'W', 'S'), 'X', 'T'), 'Y', 'U'), 'Z', 'V'),
+        32, 10) DIV 4) / 1000)
+    WHERE CHAR_LENGTH(purchase_uid) = 20;
+
+INSERT IGNORE INTO purchase_items (purchase_uid, item_uid, user_uid, shard, name, expires, notify_at, notified)
+    SELECT purchase_uid, item_uid, user_uid, CRC32(user_uid) % 1024, name, expires,
+        TIMESTAMP(expires - INTERVAL 1 DAY, '09:00:00'),
+        IFNULL(TIMESTAMP(expires - INTERVAL 1 DAY, '09:00:00') < NOW(), 0)
+    FROM (
+        SELECT purchase_uid, item_uid, user_uid, name, CASE unit
+            WHEN 'D' THEN purchased + INTERVAL amount DAY
+            WHEN 'W' THEN purchased + INTERVAL amount WEEK
+            WHEN 'M' THEN purchased + INTERVAL amount MONTH
+            WHEN 'Y' THEN purchased + INTERVAL amount YEAR
+        END AS expires
+        FROM (
+            SELECT purchases.purchase_uid, known_items.item_uid, purchases.user_uid, known_items.name, DATE(purchases.created_at) AS purchased,
+                IF(CHAR_LENGTH(purchases.purchase_uid) = 20 AND known_items.duration REGEXP '^[0-9]+ ?[DWMYdwmy]$', CAST(REGEXP_SUBSTR(known_items.duration, '[0-9]+') AS UNSIGNED), NULL) AS amount,
+                UPPER(RIGHT(known_items.duration, 1)) AS unit
+            FROM purchases
+            JOIN JSON_TABLE(purchases.items, '$[*]' COLUMNS (name VARCHAR(255) PATH '$')) recognised
+            JOIN known_items ON known_items.name = recognised.name
+        ) durations
+    ) expiries;
+
+ALTER TABLE purchases
+    DROP COLUMN items,
+    DROP COLUMN expiry;
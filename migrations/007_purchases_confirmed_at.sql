@@ -0,0 +1,5 @@
+-- Set by /bbb_confirmPurchase when the user confirms the final item list of a
+-- purchase, NULL while only the recognised items are stored.
+
+ALTER TABLE purchases
+    ADD COLUMN confirmed_at DATETIME(3) NULL;
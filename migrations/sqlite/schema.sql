@@ -0,0 +1,93 @@
+-- Whole schema for the embedded SQLite backend: the MySQL base tables with every
+-- migration up to 007 applied. Run by SQLiteDatabase.bootstrap (sqlite_bootstrap.py)
+-- on an empty or existing file; every statement is guarded so running it again
+-- only adds what is missing. Keep in step with the numbered MySQL migrations.
+--
+-- DATETIME/TIMESTAMP columns hold local time as 'YYYY-MM-DD HH:MM:SS.SSS' text,
+-- the layout the backend writes Python datetimes in. MySQL's
+-- ON UPDATE CURRENT_TIMESTAMP is done by the *_touch triggers.
+
+CREATE TABLE IF NOT EXISTS user_info (
+    user_uid VARCHAR(64) NOT NULL PRIMARY KEY,
+    username VARCHAR(255) NOT NULL,
+    created DATETIME NOT NULL,
+    name VARCHAR(255) NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS user_info_username ON user_info (username);
+
+CREATE TABLE IF NOT EXISTS user_connection_auth (
+    user_uid VARCHAR(64) NOT NULL PRIMARY KEY,
+    internal_jwt VARCHAR(1024) NOT NULL,
+    pass_hash VARCHAR(255) NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS user_device_auth (
+    device_uid VARCHAR(64) NOT NULL PRIMARY KEY,
+    user_uid VARCHAR(64) NOT NULL,
+    external_jwt VARCHAR(1024) NOT NULL,
+    user_agent VARCHAR(512) NOT NULL,
+    address VARCHAR(64) NOT NULL
+);
+CREATE INDEX IF NOT EXISTS user_device_auth_user ON user_device_auth (user_uid);
+
+CREATE TABLE IF NOT EXISTS ip_penalties (
+    address VARCHAR(64) NOT NULL PRIMARY KEY,
+    expires DATETIME NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS known_items (
+    item_uid VARCHAR(64) NOT NULL PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    duration VARCHAR(16) NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'))
+);
+CREATE UNIQUE INDEX IF NOT EXISTS known_items_name ON known_items (name);
+CREATE INDEX IF NOT EXISTS known_items_updated_at ON known_items (updated_at);
+CREATE TRIGGER IF NOT EXISTS known_items_touch AFTER UPDATE ON known_items
+    FOR EACH ROW WHEN NEW.updated_at = OLD.updated_at
+BEGIN
+    UPDATE known_items SET updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime') WHERE item_uid = NEW.item_uid;
+END;
+
+CREATE TABLE IF NOT EXISTS purchases (
+    purchase_uid VARCHAR(64) NOT NULL PRIMARY KEY,
+    user_uid VARCHAR(64) NOT NULL,
+    image_hash CHAR(64) NULL DEFAULT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')),
+    confirmed_at DATETIME NULL
+);
+CREATE INDEX IF NOT EXISTS purchases_user ON purchases (user_uid);
+
+CREATE TABLE IF NOT EXISTS recognition_jobs (
+    job_uid CHAR(20) NOT NULL PRIMARY KEY,
+    user_uid VARCHAR(64) NOT NULL,
+    node_id SMALLINT NOT NULL,
+    state TEXT NOT NULL CHECK (state IN ('QUEUED', 'RUNNING', 'DONE')),
+    status_code SMALLINT NULL,
+    status_desc VARCHAR(128) NULL,
+    result TEXT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')),
+    updated_at TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'))
+);
+CREATE INDEX IF NOT EXISTS recognition_jobs_node_state ON recognition_jobs (node_id, state);
+CREATE INDEX IF NOT EXISTS recognition_jobs_state_updated ON recognition_jobs (state, updated_at);
+CREATE TRIGGER IF NOT EXISTS recognition_jobs_touch AFTER UPDATE ON recognition_jobs
+    FOR EACH ROW WHEN NEW.updated_at = OLD.updated_at
+BEGIN
+    UPDATE recognition_jobs SET updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime') WHERE job_uid = NEW.job_uid;
+END;
+
+CREATE TABLE IF NOT EXISTS purchase_items (
+    purchase_uid VARCHAR(64) NOT NULL,
+    item_uid VARCHAR(64) NOT NULL,
+    user_uid VARCHAR(64) NOT NULL,
+    shard SMALLINT NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    expires DATE NULL,
+    notify_at DATETIME NULL,
+    notified INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (purchase_uid, item_uid)
+);
+CREATE INDEX IF NOT EXISTS purchase_items_user_expires ON purchase_items (user_uid, expires, purchase_uid, item_uid);
+CREATE INDEX IF NOT EXISTS purchase_items_item ON purchase_items (item_uid);
+CREATE INDEX IF NOT EXISTS purchase_items_due ON purchase_items (notified, notify_at, purchase_uid, item_uid, shard);
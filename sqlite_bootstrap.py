@@ -0,0 +1,12 @@
+from argparse import ArgumentParser
+
+from internal.Enum import RequiredFiles
+from internal.SQLiteDatabase import SQLiteDatabase
+
+
+parser = ArgumentParser(description="Create or update the embedded SQLite database used when Constants.storageBackend is SQLITE")
+parser.add_argument("path", nargs="?", default=RequiredFiles.sqliteFile.value)
+parser.add_argument("--schema", default=RequiredFiles.sqliteSchemaFile.value)
+args = parser.parse_args()
+tables = SQLiteDatabase.bootstrap(args.path, args.schema)
+print(f"{args.path}: {', '.join(tables)}")
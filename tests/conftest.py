@@ -0,0 +1,34 @@
+from gevent import monkey
+monkey.patch_all()
+
+import sys
+from pathlib import Path
+from re import sub, MULTILINE
+from types import ModuleType
+
+import pytest
+from customisedLogs import Manager as LogManager
+
+REPO_FOLDER = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_FOLDER))
+
+# internal.Enum reads internal/SecretEnum.py, which is never committed, so a checkout without one runs on the blank template pointed at this folder
+if not (REPO_FOLDER / "internal" / "SecretEnum.py").is_file():
+    secretEnum = ModuleType("internal.SecretEnum")
+    template = (REPO_FOLDER / "internal" / "SecretEnum.py.sam").read_text()
+    exec(sub(r"^(\s*possibleFolderLocation = ).*$", lambda match: f"{match.group(1)}[{str(REPO_FOLDER)!r}]", template, flags=MULTILINE), secretEnum.__dict__)
+    sys.modules["internal.SecretEnum"] = secretEnum
+
+from internal.Enum import Constants, RequiredFiles, SQLiteQueries
+from internal.Metrics import Metrics
+from internal.SQLiteDatabase import SQLiteDatabase
+
+
+@pytest.fixture
+def database(tmp_path) -> SQLiteDatabase:
+    """
+    Embedded database with the full schema in a fresh file
+    """
+    path = str(tmp_path / "bbb.sqlite3")
+    SQLiteDatabase.bootstrap(path, str(REPO_FOLDER / RequiredFiles.sqliteSchemaFile.value))
+    return SQLiteDatabase(path, SQLiteQueries, LogManager(), Metrics("bbb_test", Constants.metricBuckets.value), Constants.sqliteWorkers.value, Constants.sqliteBusyTimeout.value)
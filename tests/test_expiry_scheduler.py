@@ -0,0 +1,128 @@
+from datetime import date, datetime, timedelta
+from queue import Empty
+from time import sleep
+
+from customisedLogs import Manager as LogManager
+
+from internal.Enum import Constants, Queries
+from internal.ExpiryScheduler import ExpiryScheduler
+from internal.NotificationSink import QueueSink
+
+
+def newScheduler(database, sink, owners: int = 1, owner: int = 0, loadInterval: float = 60, retryDelay: float = 0) -> ExpiryScheduler:
+    """
+    Scheduler notifying one day ahead at midnight, so items expiring today or earlier are due at once
+    """
+    return ExpiryScheduler(database, sink, LogManager(), Constants.expiryShards.value, owners, owner, 1, 0, 3600, loadInterval, 1000, 500, retryDelay)
+
+
+def storeItems(database, scheduler: ExpiryScheduler, userUID: str, purchaseUID: str, itemToDaysAgo: dict[str, int]) -> list[tuple]:
+    """
+    Write purchase_items rows expiring the given days before today, without scheduling them
+    """
+    expiryDict = {itemUID: {"NAME": itemUID.upper(), "EXPIRES": (date.today() - timedelta(days=daysAgo)).isoformat()} for itemUID, daysAgo in itemToDaysAgo.items()}
+    rows = scheduler.itemRows(userUID, purchaseUID, expiryDict)
+    database.executeMany(Queries.insertPurchaseItem, rows)
+    return rows
+
+
+def drain(sink: QueueSink, wait: float) -> list[dict]:
+    """
+    Every notification delivered until none arrived for the given seconds
+    """
+    delivered = []
+    while True:
+        try:
+            delivered += sink.batches.get(timeout=wait)
+        except Empty:
+            return delivered
+
+
+def notifiedFlags(database) -> list[int]:
+    return [notified for notified, in database.fetchSQL("SELECT notified from purchase_items", [])]
+
+
+def test_due_items_are_sent_in_notify_order(database):
+    sink = QueueSink()
+    scheduler = newScheduler(database, sink)
+    storeItems(database, scheduler, "USER", "PURCHASE", {"a": 1, "b": 3, "c": 2})
+    scheduler.start()
+    assert [notification["ITEM_UID"] for notification in drain(sink, 3)] == ["b", "c", "a"]
+    assert scheduler.stats()["NOTIFIED"] == 3
+    assert notifiedFlags(database) == [1, 1, 1]
+
+
+def test_rows_are_claimed_before_sending(database):
+    sinks = [QueueSink(), QueueSink()]
+    schedulers = [newScheduler(database, sink) for sink in sinks]
+    storeItems(database, schedulers[0], "USER", "PURCHASE", {f"item{index}": 1 for index in range(20)})
+    for scheduler in schedulers:
+        scheduler.start()
+    delivered = drain(sinks[0], 3) + drain(sinks[1], 0.1)
+    assert sorted(notification["ITEM_UID"] for notification in delivered) == sorted(f"item{index}" for index in range(20))
+    assert sum(scheduler.stats()["STALE"] for scheduler in schedulers) == 20
+
+
+def test_failed_send_is_retried_without_releasing_the_claim(database):
+    class RefusingOnceSink(QueueSink):
+        def __init__(self):
+            super().__init__()
+            self.refused = 0
+
+        def send(self, notifications: list[dict]) -> bool:
+            if not self.refused:
+                self.refused = len(notifications)
+                return False
+            return super().send(notifications)
+
+    sink = RefusingOnceSink()
+    scheduler = newScheduler(database, sink)
+    storeItems(database, scheduler, "USER", "PURCHASE", {"a": 1, "b": 2})
+    scheduler.start()
+    assert sorted(notification["ITEM_UID"] for notification in drain(sink, 4)) == ["a", "b"]
+    assert sink.refused == 2
+    assert scheduler.stats()["RETRIED"] == 2
+    assert scheduler.stats()["NOTIFIED"] == 2
+    assert notifiedFlags(database) == [1, 1]
+
+
+def test_schedulers_load_only_their_shards(database):
+    sinks = [QueueSink(), QueueSink()]
+    schedulers = [newScheduler(database, sink, 2, owner) for owner, sink in enumerate(sinks)]
+    userUIDs = [f"USER{index}" for index in range(40)]
+    for userUID in userUIDs:
+        storeItems(database, schedulers[0], userUID, f"PURCHASE{userUID}", {"a": 1})
+    for scheduler in schedulers:
+        scheduler.start()
+    delivered = [drain(sinks[0], 3), drain(sinks[1], 0.1)]
+    for scheduler, notifications in zip(schedulers, delivered):
+        assert notifications
+        assert all(scheduler.firstShard <= scheduler.shardOf(notification["USER_UID"]) < scheduler.endShard for notification in notifications)
+        assert scheduler.stats()["LOADED"] == len(notifications)
+    assert sorted(notification["USER_UID"] for notifications in delivered for notification in notifications) == sorted(userUIDs)
+
+
+def test_loads_continue_from_the_last_row_loaded(database):
+    sink = QueueSink()
+    scheduler = newScheduler(database, sink, loadInterval=0.05)
+    notifyAt = datetime.now().replace(microsecond=0) + timedelta(minutes=10)
+    database.executeMany(Queries.insertPurchaseItem, [("PURCHASE", f"item{index}", "USER", scheduler.shardOf("USER"), "ITEM", date.today().isoformat(), notifyAt) for index in range(5)])
+    scheduler.start()
+    sleep(0.5)
+    assert scheduler.stats()["LOADED"] == 5
+    database.executeMany(Queries.insertPurchaseItem, [("PURCHASE", "late", "USER", scheduler.shardOf("USER"), "ITEM", date.today().isoformat(), notifyAt + timedelta(minutes=1))])
+    sleep(0.5)
+    assert scheduler.stats()["LOADED"] == 6
+    assert scheduler.stats()["SCHEDULED"] == 6
+
+
+def test_written_rows_of_other_shards_are_scheduled_by_the_writer(database):
+    sinks = [QueueSink(), QueueSink()]
+    schedulers = [newScheduler(database, sink, 2, owner) for owner, sink in enumerate(sinks)]
+    for scheduler in schedulers:
+        scheduler.start()
+    userUID = next(f"USER{index}" for index in range(100) if not schedulers[0].firstShard <= schedulers[0].shardOf(f"USER{index}") < schedulers[0].endShard)
+    rows = storeItems(database, schedulers[0], userUID, "PURCHASE", {"a": 1})
+    assert schedulers[0].track(rows) == 1
+    assert [notification["USER_UID"] for notification in drain(sinks[0], 3)] == [userUID]
+    assert drain(sinks[1], 0.1) == []